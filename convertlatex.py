@@ -10,9 +10,14 @@ import multiprocessing as mp
 import subprocess
 import argparse
 import time
+import shlex
 import datetime
 from subprocess import PIPE
 from core.funcs import *
+from core.schedule import *
+from core.manifest import *
+from core.converter import *
+from core.mathcache import *
 
 global timeout
 global erroroutputpath
@@ -21,6 +26,23 @@ global outpath
 path = ''
 outpath = ''
 timeout = 240
+backend = 'latexml'
+daemon_settings = (None, None)
+# this worker's latexml_daemon (--backend daemon), started on first use
+daemon = None
+# --bisect: recover the equations of papers that fail to convert
+bisect = False
+bisect_min = 5
+math_cache_path = None
+# (filename, sanitized_parts) of the paper this worker last converted a
+# chunk of (--chunk)
+chunk_paper = (None, None)
+cache_version = ''
+# this worker's mathml_cache (--math-cache), opened on first use
+math_cache = None
+# [equations, cache hits, LaTeX bytes and MathML bytes not converted] of the
+# file being converted
+cache_counts = [0, 0, 0, 0]
 def writesanitized(sanitized, clean_file_name):
     """Writes sanitized document text to clean_file_name"""
     global erroroutputpath
@@ -28,83 +50,489 @@ def writesanitized(sanitized, clean_file_name):
     with open(outfile, 'w') as fh:
         fh.write(sanitized)
 
+def writexhtml(xml, xhtml, clean_file_name):
+    """Writes converted XHTML (and the LaTeXML XML, if any) of clean_file_name
+    to the output folder"""
+    global outpath
+    xhtml = re.sub(r'(href\=\").*?(LaTeXML\.css)(\")',r'\1\2\3',xhtml)
+    xhtml = re.sub(r'(href=\").*?(ltx-article\.css)(\")',r'\1\2\3',xhtml)
+    if xml:
+        with open(os.path.join(outpath, clean_file_name+'.txt'),'w') as fh:
+            fh.write(xml)
+    with open(os.path.join(outpath, clean_file_name+'.xhtml'),'w') as fh:
+        fh.write(xhtml)
+
+def convert_document(document, seconds=None):
+    """Converts a sanitized document with the selected backend, within
+    seconds (default: the timeout).
+    Returns (xml, xhtml) as bytes, or raises conversion_error"""
+    global backend
+    global daemon
+    global daemon_settings
+    global timeout
+    seconds = seconds or timeout
+    if backend=='daemon':
+        if daemon is None:
+            command, maxtasks = daemon_settings
+            daemon = latexml_daemon(command,maxtasks)
+        return daemon.convert(document,seconds)
+    return run_latexml(document,seconds)
+
+def convert_tables(preamble, equations, seconds):
+    """Converts equations within seconds. Returns (head, tables, tail) as
+    split_tables does, or raises conversion_error, also if there is not one
+    table per equation"""
+    xml, xhtml = convert_document(sanitized_document(preamble,equations),seconds)
+    head, tables, tail = split_tables(xhtml.decode())
+    if len(tables)!=len(equations):
+        raise conversion_error("LaTeX/XHTML equation count mismatch")
+    return head, tables, tail
+
+def bisect_tables(preamble, equations, seconds, deadline):
+    """Converts the two halves of equations, which failed as a whole, each
+    within half of seconds (but no less than bisect_min), and bisects the
+    halves that fail again. An equation that fails on its own, or is not
+    reached before deadline, becomes an error_table.
+    Returns (head, tables, tail, failures), head and tail being None if no
+    part converted"""
+    global bisect_min
+    seconds = max(seconds/2.0,bisect_min)
+    middle = len(equations)//2
+    head = tail = None
+    tables = []
+    failures = 0
+    for part in (equations[:middle],equations[middle:]):
+        remaining = min(seconds,deadline-time.time())
+        if remaining<=0:
+            tables.extend(error_table("Conversion skipped - recovery timeout") for equation in part)
+            failures += len(part)
+            continue
+        try:
+            part_head, part_tables, part_tail = convert_tables(preamble,part,remaining)
+        except conversion_error as error:
+            if len(part)==1:
+                tables.append(error_table(str(error)))
+                failures += 1
+                continue
+            part_head, part_tables, part_tail, part_failures = bisect_tables(preamble,part,seconds,deadline)
+            failures += part_failures
+        tables.extend(part_tables)
+        if head is None:
+            head, tail = part_head, part_tail
+    return head, tables, tail, failures
+
+def recover_xhtml(filename, preamble, equations, error):
+    """Bisects the equations of a paper that failed to convert with error,
+    spending at most twice the timeout on it (a hanging equation alone costs
+    about one timeout, half of it at each level). Writes the XHTML, its
+    tables renumbered in order, if any equation converted. Returns the
+    message to log"""
+    global timeout
+    head, tables, tail, failures = bisect_tables(preamble,equations,timeout,time.time()+2*timeout)
+    message = "{}: {} - {} of {} equations recovered".format(filename,error,len(tables)-failures,len(tables))
+    print(message)
+    if head is not None:
+        clean_file_name = os.path.splitext(os.path.basename(filename))[0]
+        writexhtml('',join_tables(head,renumber_tables(tables),tail),clean_file_name)
+    return message
+
+def genxhtml_chunk(task):
+    """Converts one chunk of a large paper (--chunk): the equations of its
+    sanitized document from index*size on, size of them (all the rest, for
+    the last chunk), with the preamble of the whole paper.
+    Returns (filename, index, (head, tables, tail) or None if the chunk
+    failed, failures, message, cache_counts)"""
+    global cache_counts
+    global timeout
+    global chunk_paper
+    filename, index, size, last = task
+    cache_counts = [0, 0, 0, 0]
+    # the chunks of a paper are queued together, so a worker usually gets
+    # several of them in a row
+    if chunk_paper[0]!=filename:
+        chunk_paper = (filename, sanitized_parts_from_file(filename))
+    parts = chunk_paper[1]
+    if parts is None:
+        return filename, index, None, 0, "Error - no body found", cache_counts
+    preamble, equations = parts
+    chunk = equations[index*size:] if last else equations[index*size:(index+1)*size]
+    if not chunk:
+        return filename, index, (None, [], None), 0, "", cache_counts
+    try:
+        if math_cache_path:
+            xml, xhtml = convert_cached(preamble,chunk)
+        else:
+            xml, xhtml = convert_document(sanitized_document(preamble,chunk))
+        head, tables, tail = split_tables(xhtml.decode())
+        # the tables of every chunk are joined, so one that does not line
+        # up would shift all the equations after it
+        if len(tables)!=len(chunk):
+            raise conversion_error("LaTeX/XHTML equation count mismatch")
+    except conversion_error as error:
+        if not bisect:
+            return filename, index, None, 0, str(error), cache_counts
+        if len(chunk)==1:
+            return filename, index, (None, [error_table(str(error))], None), 1, str(error), cache_counts
+        head, tables, tail, failures = bisect_tables(preamble,chunk,timeout,time.time()+2*timeout)
+        return filename, index, (head, tables, tail), failures, str(error), cache_counts
+    return filename, index, (head, tables, tail), 0, "", cache_counts
+
+def chunk_tasks(counts, size):
+    """Tasks of genxhtml_chunk for papers with more than size display
+    equations, given {filename: display equations}"""
+    tasks = []
+    for filename, count in sorted(counts.items(),key=lambda item: item[1],reverse=True):
+        chunks = (count+size-1)//size
+        for index in range(chunks):
+            tasks.append((filename,index,size,index==chunks-1))
+    return tasks
+
+def write_chunks(filename, chunks):
+    """Writes a paper from the results of all of its chunks, its tables in
+    order and renumbered (no .txt). The paper fails if a chunk failed (and
+    was not bisected) or no chunk converted any equation.
+    Returns the message to log"""
+    clean_file_name = os.path.splitext(os.path.basename(filename))[0]
+    results = [chunks[index] for index in sorted(chunks)]
+    errors = [message for result, failures, message in results if message]
+    if any(result is None for result, failures, message in results):
+        message = "{}: {}".format(filename,errors[0])
+        print(message)
+        writesanitized(sanitized_doc_from_file(filename),clean_file_name)
+        return message
+    heads = [result[0] for result, failures, message in results if result[0] is not None]
+    tails = [result[2] for result, failures, message in results if result[2] is not None]
+    tables = [table for result, failures, message in results for table in result[1]]
+    if not heads:
+        message = "{}: {} - no equations converted".format(filename,errors[0] if errors else "Conversion failed")
+        print(message)
+        writesanitized(sanitized_doc_from_file(filename),clean_file_name)
+        return message
+    # each chunk was numbered from 1
+    writexhtml('',join_tables(heads[0],renumber_tables(tables),tails[-1]),clean_file_name)
+    if not errors:
+        return ""
+    failures = sum(failures for result, failures, message in results)
+    message = "{}: {} - {} of {} equations recovered".format(filename,errors[0],len(tables)-failures,len(tables))
+    print(message)
+    writesanitized(sanitized_doc_from_file(filename),clean_file_name)
+    return message
+
+def cache_lookup(preamble, equations):
+    """Looks the equations of a sanitized document up in the MathML cache.
+    Returns (keys, found, missing): found is {key: table} of the equations
+    cached, missing {key: equation} of the others (each once), or None if
+    the document has to be converted whole (some equation cannot be cached,
+    or none is)"""
+    global math_cache
+    global math_cache_path
+    global cache_version
+    if math_cache is None:
+        math_cache = mathml_cache(math_cache_path)
+    keys = equation_keys(preamble, equations, cache_version)
+    found = math_cache.get_many(key for key, equation in zip(keys,equations) if cacheable(equation))
+    missing = {}
+    for key, equation in zip(keys,equations):
+        if key not in found and key not in missing:
+            missing[key] = equation
+    if not all(cacheable(equation) for equation in equations) or len(missing)==len(equations):
+        missing = None
+    return keys, found, missing
+
+def store_tables(keys, tables, equations):
+    """Caches the converted tables of the equations that can be cached,
+    numbered as if each were the only equation. Returns the (key, table)
+    pairs stored"""
+    global math_cache
+    items = [(key,renumber_tables([table])[0]) for key, table, equation in zip(keys,tables,equations)
+        if cacheable(equation)]
+    math_cache.put_many(items)
+    return items
+
+def assemble_cached(head, tail, keys, equations, found, missing):
+    """XHTML of the tables found for keys, renumbered in order, so the ids
+    and equation numbers are those of a conversion of the whole document.
+    Adds what the cache saved to cache_counts"""
+    global cache_counts
+    cache_counts[1] = len(equations)-len(missing)
+    cache_counts[2] = sum(len(equation.encode()) for equation in equations)-sum(len(equation.encode()) for equation in missing.values())
+    cache_counts[3] = sum(len(found[key].encode()) for key in keys)-sum(len(found[key].encode()) for key in missing)
+    return join_tables(head,renumber_tables([found[key] for key in keys]),tail)
+
+def convert_cached(preamble, equations):
+    """Converts a sanitized document, taking the equations found in the
+    MathML cache from there. Only the missing equations are converted (the
+    whole document if some equation cannot be cached, or the tables of the
+    partial one do not line up), and the tables converted are cached.
+    Only a document converted whole has its LaTeXML XML returned (b''
+    otherwise).
+    Returns (xml, xhtml) as bytes, or raises conversion_error"""
+    global cache_counts
+    keys, found, missing = cache_lookup(preamble,equations)
+    cache_counts[0] = len(equations)
+    if missing is not None:
+        head, tail = default_head, default_tail
+        if missing:
+            xml, xhtml = convert_document(sanitized_document(preamble,list(missing.values())))
+            head, tables, tail = split_tables(xhtml.decode())
+            if len(tables)==len(missing):
+                found.update(store_tables(list(missing),tables,list(missing.values())))
+        if all(key in found for key in keys):
+            # the XML of the missing equations alone is not kept
+            return b'', assemble_cached(head,tail,keys,equations,found,missing).encode()
+    xml, xhtml = convert_document(sanitized_document(preamble,equations))
+    head, tables, tail = split_tables(xhtml.decode())
+    if len(tables)==len(equations):
+        store_tables(keys,tables,equations)
+    return xml, xhtml
+
 def genxhtml(filename):
     """Conversion function using subprocess"""
     global outpath
     global timeout
     clean_file_name = os.path.splitext(os.path.basename(filename))[0]
     outfname = os.path.join(outpath, clean_file_name+'.xhtml')
-    outfname = os.path.join(outpath, clean_file_name+'.xhtml')
-    outrawname = os.path.join(outpath, clean_file_name+'.txt')
 
     if os.path.isfile(outfname):
         # print("{}: Already generated".format(filename))
         return ""
     # print("{}: Start".format(filename))
-    with open(filename, mode='r', encoding='latin-1') as f1:
-        text = f1.read()
-    output = generate_sanitized_document(text)
-    if len(output) == 0:
+    parts = sanitized_parts_from_file(filename)
+    if parts is None:
         print("{}: Error - no body found".format(filename))
         return "{}: Error - no body found".format(filename)
+    output = sanitized_document(*parts)
     try:
-        proc = subprocess.Popen(["latexml", "-"], stderr=PIPE, stdout=PIPE,
-        stdin=PIPE)
-        stdout, stderr = proc.communicate(output.encode(), timeout=timeout)
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        print("{}: MathML conversion failed - timeout".format(filename))
+        if math_cache_path:
+            stdout, stdout2 = convert_cached(*parts)
+        else:
+            stdout, stdout2 = convert_document(output)
+        if len(stdout2.strip())==0:
+            raise conversion_error("Conversion failed")
+        if bisect and len(split_tables(stdout2.decode())[1])!=len(parts[1]):
+            raise conversion_error("LaTeX/XHTML equation count mismatch")
+    except conversion_error as error:
         writesanitized(output,clean_file_name)
-        return "{}: MathML conversion failed - timeout".format(filename)
-    except:
-        print("{}: Conversion failed".format(filename))
-        writesanitized(output,clean_file_name)
-        return "{}: Conversion failed".format(filename)
-    try:
-        proc = subprocess.Popen(["latexmlpost", "--format=xhtml", "-"],
-        stderr=PIPE, stdout=PIPE, stdin=PIPE)
-        stdout2, stderr = proc.communicate(stdout, timeout=timeout)
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        print("{}: MathML postprocessing failed - timeout".format(filename))
-        writesanitized(output,clean_file_name)
-        return "{}: MathML postprocessing failed - timeout".format(filename)
-    # try:
-    #     outdir = os.path.join(outpath + clean_file_name)
-    #     validate_folder(outdir)
-    #     proc = subprocess.Popen(["latexmlpost", "--format=html5", "--destination="+os.path.join(outdir,clean_file_name)+".html", "--mathimages", "-"],
-    #     stderr=PIPE, stdout=PIPE, stdin=PIPE)
-    #     stdout3, stderr = proc.communicate(stdout, timeout=timeout)
-    # except subprocess.TimeoutExpired:
-    #     proc.kill()
-    #     print("{}: MathML postprocessing failed - timeout".format(filename))
-    #     writesanitized(output,clean_file_name)
-    #     return "{}: MathML postprocessing failed - timeout".format(filename)
-    if len(stdout2.strip())==0:
-        print("{}: Conversion failed".format(filename))
-        writesanitized(output,clean_file_name)
-        return "{}: Conversion failed".format(filename)
-    stdout2 = stdout2.decode()
-    stdout2 = re.sub(r'(href\=\").*?(LaTeXML\.css)(\")',r'\1\2\3',stdout2)
-    stdout2 = re.sub(r'(href=\").*?(ltx-article\.css)(\")',r'\1\2\3',stdout2)
-    with open(outrawname,'w') as fh:
-        fh.write(stdout.decode())
-    with open(outfname,'w') as fh:
-        fh.write(stdout2)
+        if bisect and len(parts[1])>1:
+            return recover_xhtml(filename,parts[0],parts[1],error)
+        print("{}: {}".format(filename,error))
+        return "{}: {}".format(filename,error)
+    writexhtml(stdout.decode(),stdout2.decode(),clean_file_name)
     return ""
 
+def genxhtml_counted(filename):
+    """genxhtml, also returning the cache_counts of the file"""
+    global cache_counts
+    cache_counts = [0, 0, 0, 0]
+    message = genxhtml(filename)
+    return message, cache_counts
+
+def paper_preamble(filename):
+    """Returns (filename, preamble of its sanitized document), the preamble
+    being None if the output exists already, there is no body or the math
+    of the sanitized document does not read back as its equations (a stray
+    $ would run into the next paper of a batch)"""
+    global outpath
+    clean_file_name = os.path.splitext(os.path.basename(filename))[0]
+    if os.path.isfile(os.path.join(outpath, clean_file_name+'.xhtml')):
+        return filename, None
+    parts = sanitized_parts_from_file(filename)
+    if parts is None or grab_math(sanitized_document(*parts))!=parts[1]:
+        return filename, None
+    return filename, tuple(parts[0])
+
+def batch_papers(pool, filelist, batch_size):
+    """Groups papers with the same preamble into batches of at most
+    batch_size. Returns (papers left alone, batches)"""
+    groups = {}
+    single = []
+    for filename, preamble in pool.imap(paper_preamble,filelist,chunksize=16):
+        if preamble is None:
+            single.append(filename)
+        else:
+            groups.setdefault(preamble,[]).append(filename)
+    batches = []
+    for preamble, filenames in groups.items():
+        for i in range(0,len(filenames),batch_size):
+            batch = filenames[i:i+batch_size]
+            if len(batch)>1:
+                batches.append(batch)
+            else:
+                single.extend(batch)
+    return single, batches
+
+def convert_batch(preamble, papers, seconds):
+    """Converts the equations of several papers (a list of equation lists)
+    as one document within seconds, each paper following a batch_marker
+    paragraph. If the batch fails, its halves are converted separately, each
+    within half of seconds (but no less than bisect_min), down to single
+    papers, which are left to be converted on their own.
+    Returns {index in papers: (head, tables, tail)} of the papers whose
+    tables line up with their equations"""
+    global bisect_min
+    if len(papers)<2:
+        return {}
+    body = []
+    for index, equations in enumerate(papers):
+        body += [batch_marker.format(index)]+equations
+    split = None
+    try:
+        xml, xhtml = convert_document(sanitized_document(preamble,body),seconds)
+        split = split_batch(xhtml.decode(),len(papers))
+    except conversion_error:
+        pass
+    if split is None:
+        seconds = max(seconds/2.0,bisect_min)
+        middle = len(papers)//2
+        converted = convert_batch(preamble,papers[:middle],seconds)
+        for index, result in convert_batch(preamble,papers[middle:],seconds).items():
+            converted[middle+index] = result
+        return converted
+    head, tables, tail = split
+    return {index: (head,paper_tables,tail) for index, (equations, paper_tables) in enumerate(zip(papers,tables))
+        if len(paper_tables)==len(equations)}
+
+def genxhtml_batch(filenames):
+    """Converts papers that share a preamble as a single document (see
+    convert_batch) and splits the XHTML back up at the markers, renumbering
+    each paper's tables from the start. No .txt is written for them. With
+    --math-cache, only the equations of each paper missing from the cache
+    are put into the batch, and papers with all of them cached are not
+    converted at all. Papers whose math would run into the next paper's, or
+    whose tables do not line up with their equations, are converted on
+    their own with genxhtml.
+    Returns ([(filename, genxhtml_counted result)], papers the batch converted)"""
+    global cache_counts
+    global timeout
+    # (filename, equations, equations converted, cache_lookup or None)
+    papers = []
+    body = []
+    batch_equations = []
+    results = []
+    done = set()
+    preamble = None
+    for filename in filenames:
+        parts = sanitized_parts_from_file(filename)
+        if parts is None:
+            continue
+        preamble, equations = parts
+        sent, lookup = equations, None
+        if math_cache_path:
+            lookup = cache_lookup(preamble,equations)
+            keys, found, missing = lookup
+            if missing=={}:
+                cache_counts = [len(equations), 0, 0, 0]
+                clean_file_name = os.path.splitext(os.path.basename(filename))[0]
+                writexhtml('',assemble_cached(default_head,default_tail,keys,equations,found,missing),clean_file_name)
+                results.append((filename,("",cache_counts)))
+                done.add(filename)
+                continue
+            if missing is not None:
+                sent = list(missing.values())
+        paper_body = body+[batch_marker.format(len(papers))]+sent
+        # a paper that would run into the others is left out
+        if grab_math(sanitized_document(preamble,paper_body))==batch_equations+sent:
+            papers.append((filename,equations,sent,lookup))
+            body = paper_body
+            batch_equations += sent
+    converted = convert_batch(preamble,[sent for filename, equations, sent, lookup in papers],timeout)
+    for index, (filename, equations, sent, lookup) in enumerate(papers):
+        if index not in converted:
+            continue
+        head, tables, tail = converted[index]
+        cache_counts = [0, 0, 0, 0]
+        # numbered from 1 again, as if converted alone. The XML holds the
+        # whole batch, so it is not kept
+        xhtml = join_tables(head,renumber_tables(tables),tail)
+        if lookup is not None:
+            keys, found, missing = lookup
+            cache_counts[0] = len(equations)
+            if missing is None:
+                store_tables(keys,tables,equations)
+            else:
+                found.update(store_tables(list(missing),tables,sent))
+                xhtml = assemble_cached(head,tail,keys,equations,found,missing)
+        clean_file_name = os.path.splitext(os.path.basename(filename))[0]
+        writexhtml('',xhtml,clean_file_name)
+        results.append((filename,("",cache_counts)))
+        done.add(filename)
+    for filename in filenames:
+        if filename not in done:
+            results.append((filename,genxhtml_counted(filename)))
+    return results, len(done)
+
+def converted_results(pool, filelist, chunks, batches, cost_file=None):
+    """Converts the papers of filelist with genxhtml, the chunks of large
+    papers (chunk_tasks) with genxhtml_chunk and the batches of small ones
+    with genxhtml_batch, all queued on the pool up front: chunks first, then
+    papers largest first, then batches. Yields (filename, (message,
+    cache_counts)) of each paper as it is finished, a chunked one once all
+    of its chunks are in, and prints how many papers the batches converted"""
+    expected = {}
+    for filename, index, size, last in chunks:
+        expected[filename] = expected.get(filename,0)+1
+    pending = {}
+    paper_counts = {}
+    batch_total = 0
+    batched = 0
+    groups = [('chunk',genxhtml_chunk,chunks,False),('paper',genxhtml_counted,filelist,True),
+        ('batch',genxhtml_batch,batches,False)]
+    for tag, item, result in imap_tagged(pool,groups,cost_file):
+        if tag=='paper':
+            yield item, result
+        elif tag=='batch':
+            results, count = result
+            batch_total += len(results)
+            batched += count
+            for paper in results:
+                yield paper
+        else:
+            filename, index, chunk, failures, message, counts = result
+            pending.setdefault(filename,{})[index] = (chunk,failures,message)
+            paper_counts[filename] = [total+count for total, count in zip(paper_counts.get(filename,[0, 0, 0, 0]),counts)]
+            if len(pending[filename])==expected[filename]:
+                yield filename, (write_chunks(filename,pending.pop(filename)),paper_counts.pop(filename))
+    if batches:
+        print("Batches: {} of {} papers converted in {} batches".format(batched,batch_total,len(batches)))
+
 def main():
     start_time = time.time()
     parser = argparse.ArgumentParser(description='Conversion of sanitized LaTeX documents to XHTML')
     parser.add_argument("directory",help="Path to directory of .tex files")
     parser.add_argument("xhtml_dir",help="Path to xhtml output directory")
     parser.add_argument("--timeout",help="Specify custom timeout")
+    parser.add_argument("--backend",choices=['latexml','daemon'],default='latexml',
+    help="latexml starts latexml and latexmlpost for every paper; daemon (experimental: core/latexml_worker.pl is untested against LaTeXML and writes no .txt) keeps a LaTeXML process per worker and sends it one paper after another")
+    parser.add_argument("--daemon-command",
+    help="Command of the persistent converter (default: perl core/latexml_worker.pl)")
+    parser.add_argument("--daemon-maxtasks",type=int,default=50,
+    help="Papers after which a persistent converter is restarted, to return memory LaTeXML leaked")
+    parser.add_argument("--math-cache",
+    help="SQLite file of converted equations (created if missing); equations found there are not converted again. No .txt is written for papers assembled from it")
+    parser.add_argument("--batch",type=int,default=0,
+    help="Convert papers with at most this many display equations together with others that have the same packages (no .txt is written for them); a batch that fails is split in halves")
+    parser.add_argument("--batch-size",type=int,default=20,
+    help="Papers per batch (--batch)")
+    parser.add_argument("--bisect",action='store_true',
+    help="When a paper fails to convert, convert halves of its equations (recursively) and put placeholders in place of the equations that fail on their own")
+    parser.add_argument("--bisect-min",type=float,default=5,
+    help="Seconds each part is given at least when bisecting (--bisect)")
+    parser.add_argument("--chunk",type=int,default=0,
+    help="Split papers with more than this many display equations into chunks of as many, converted in parallel (no .txt is written for them)")
+    parser.add_argument("--costs",
+    help="Timings from a previous run (written back afterwards), used to start the slowest files first")
     args = parser.parse_args()
     origdir = os.getcwd()
     global path
     global outpath
     global erroroutputpath
     global timeout
+    global backend
+    global daemon_settings
+    global math_cache_path
+    global cache_version
+    global bisect
+    global bisect_min
     path = args.directory
     outpath = args.xhtml_dir
     if not os.path.isdir(path):
@@ -113,6 +541,21 @@ def main():
     if args.timeout:
         timeout = int(args.timeout)
         print("New timeout: {}s".format(timeout))
+    backend = args.backend
+    bisect = args.bisect
+    bisect_min = args.bisect_min
+    if args.daemon_command:
+        # paths are resolved before changing to the output folder
+        command = [os.path.abspath(part) if os.path.exists(part) else part for part in shlex.split(args.daemon_command)]
+    else:
+        command = None
+    daemon_settings = (command, args.daemon_maxtasks)
+    if args.math_cache:
+        math_cache_path = os.path.abspath(args.math_cache)
+        cache = mathml_cache(math_cache_path)
+        print("MathML cache: {} equations in {}".format(len(cache),math_cache_path))
+        cache.close()
+        cache_version = converter_version((command or daemon_command) if backend=='daemon' else None)
     outpath = os.path.join(os.path.abspath(outpath),'')
     validate_folder(outpath)
     os.chdir(outpath)
@@ -126,11 +569,36 @@ def main():
     pool = mp.Pool(processes=mp.cpu_count())
     print("Initialized {} threads".format(mp.cpu_count()))
     print("Beginning processing...")
-    outlist = pool.map(genxhtml,filelist)
+    chunks = []
+    if args.chunk:
+        listed = set(filelist)
+        large = {filename: count for filename, count in display_counts(path,min_display=args.chunk+1).items()
+            if filename in listed and not os.path.isfile(os.path.join(outpath,os.path.splitext(os.path.basename(filename))[0]+'.xhtml'))}
+        chunks = chunk_tasks(large,args.chunk)
+        filelist = [filename for filename in filelist if filename not in large]
+        print("Converting {} papers in {} chunks".format(len(large),len(chunks)))
+    batches = []
+    if args.batch:
+        small = set(manifest_files(path,min_display=1,max_display=args.batch))
+        single, batches = batch_papers(pool,[filename for filename in filelist if filename in small],args.batch_size)
+        filelist = [filename for filename in filelist if filename not in small]+single
+    outlist = converted_results(pool,filelist,chunks,batches,args.costs)
+    totals = [0, 0, 0, 0]
+    cached_papers = 0
     with open(outpath[:-1]+".log",'w') as fh:
-        for message in outlist:
+        for filename, (message, counts) in outlist:
             if len(message)>0:
                 fh.write(message+'\n')
+            totals = [total+count for total, count in zip(totals,counts)]
+            if counts[0] and counts[1]==counts[0]:
+                cached_papers += 1
+        if math_cache_path:
+            equations, hits, latex_saved, mathml_saved = totals
+            report = ("MathML cache: {} of {} equations ({:.1f}%) found, {} papers not converted, "
+                "{:.1f} MB of LaTeX not converted, {:.1f} MB of MathML reused").format(hits,equations,
+                100.0*hits/max(equations,1),cached_papers,latex_saved/2**20,mathml_saved/2**20)
+            print(report)
+            fh.write(report+'\n')
         end_time = time.time()
         total_time = str(datetime.timedelta(seconds=int(end_time-start_time)))
         fh.write("TIME (hh:mm:ss): {}\n".format(total_time))
@@ -0,0 +1,248 @@
+"""LaTeXML conversion backends for convertlatex
+
+run_latexml converts a document the way convertlatex always has, with a
+fresh latexml and a fresh latexmlpost process. Both reload LaTeXML's
+bindings and package definitions, which for short papers takes longer than
+the conversion itself. latexml_daemon instead keeps one converter process
+alive (core/latexml_worker.pl, or anything speaking the same protocol,
+such as utils/fake_latexml.py) and sends it one document after another.
+
+Protocol, over the converter's stdin and stdout:
+
+    request    b'<length>\\n' followed by length bytes of UTF-8 LaTeX
+    response   b'ok <xml length> <xhtml length>\\n' followed by the LaTeXML
+               XML (may be empty) and the XHTML, or b'error <length>\\n'
+               followed by the error log
+
+The converter reads requests until stdin is closed.
+"""
+import os
+import re
+import time
+import select
+import subprocess
+from subprocess import PIPE
+from html import escape
+
+worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),'latexml_worker.pl')
+daemon_command = ['perl',worker_script]
+
+# proctex.makeobjs pairs each display equation with one of these
+table_pattern = re.compile(r'(?s)\<table.*?\<\/table\>')
+# ids LaTeXML gives by position: S0.E3 (numbered), S0.Ex2 (unnumbered),
+# S0.EGx1 (equation groups) and the ids under them (S0.E3.m1, ...)
+position_id = re.compile(r'\bS0\.([A-Za-z]+)(\d+)\b')
+# the equation number tag of a numbered equation, (3) for S0.E3
+equation_tag = re.compile(r'(<span[^<>]*\bltx_tag_equation\b[^<>]*>\()(\d+)(\)</span>)')
+# wraps tables assembled without any conversion (all of them cached)
+default_head = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<html xmlns="http://www.w3.org/1999/xhtml"><head><title></title></head>'
+    '<body><div class="ltx_page_main"><div class="ltx_page_content"><article class="ltx_document">\n')
+default_tail = '\n</article></div></div></body></html>\n'
+
+# paragraph separating the papers of a batch (convertlatex.py --batch)
+batch_marker = 'HoptexBatchPaper{:06d}'
+
+class conversion_error(Exception):
+    """A failed conversion. The message is the one convertlatex logs"""
+    pass
+
+def run_latexml(document,timeout):
+    """Converts document with latexml and latexmlpost.
+    Returns (xml, xhtml) as bytes"""
+    try:
+        proc = subprocess.Popen(["latexml", "-"], stderr=PIPE, stdout=PIPE,
+        stdin=PIPE)
+        stdout, stderr = proc.communicate(document.encode(), timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        raise conversion_error("MathML conversion failed - timeout")
+    except:
+        raise conversion_error("Conversion failed")
+    try:
+        proc = subprocess.Popen(["latexmlpost", "--format=xhtml", "-"],
+        stderr=PIPE, stdout=PIPE, stdin=PIPE)
+        stdout2, stderr = proc.communicate(stdout, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        raise conversion_error("MathML postprocessing failed - timeout")
+    return stdout, stdout2
+
+def split_tables(xhtml):
+    """Returns (head, tables, tail) of converted XHTML: the equation tables,
+    and the markup before the first and after the last of them"""
+    tables = table_pattern.findall(xhtml)
+    if not tables:
+        return xhtml, [], ''
+    start = xhtml.find(tables[0])
+    end = xhtml.rfind(tables[-1])+len(tables[-1])
+    return xhtml[:start], tables, xhtml[end:]
+
+def join_tables(head, tables, tail):
+    """Inverse of split_tables, one table per line"""
+    return head+'\n'.join(tables)+tail
+
+def split_batch(xhtml, count):
+    """Splits the XHTML of a batch of count papers, each preceded by a
+    batch_marker paragraph, into (head, [tables of each paper], tail), the
+    head and tail being those of the whole batch. Returns None if a marker
+    is missing"""
+    starts = []
+    for i in range(count):
+        start = xhtml.find(batch_marker.format(i),starts[-1] if starts else 0)
+        if start<0:
+            return None
+        starts.append(start)
+    # the head stops at the paragraph holding the first marker
+    paragraph = xhtml.rfind('<div',0,starts[0])
+    head = xhtml[:paragraph] if paragraph>=0 else default_head
+    papers = []
+    for start, end in zip(starts,starts[1:]+[len(xhtml)]):
+        papers.append(table_pattern.findall(xhtml,start,end))
+    tail = split_tables(xhtml[starts[-1]:])[2] or default_tail
+    return head, papers, tail
+
+def renumber_tables(tables, counters=None):
+    """Renumbers the positional ids and equation number tags of converted
+    tables in order, as LaTeXML would number them had they been converted
+    together. counters ({id prefix: last number used}) is where numbering
+    continues from, and is updated. Returns the renumbered tables"""
+    if counters is None:
+        counters = {}
+    renumbered = []
+    for table in tables:
+        numbers = {}
+        for prefix, number in position_id.findall(table):
+            if (prefix, number) not in numbers:
+                counters[prefix] = counters.get(prefix,0)+1
+                numbers[(prefix,number)] = str(counters[prefix])
+        table = position_id.sub(lambda match: 'S0.'+match.group(1)+numbers[match.groups()],table)
+        table = equation_tag.sub(lambda match: match.group(1)+numbers.get(('E',match.group(2)),match.group(2))+match.group(3),table)
+        renumbered.append(table)
+    return renumbered
+
+def error_table(message):
+    """Placeholder for an equation that could not be converted: a table
+    without <math>, which proctex.makeobjs pairs with the equation all the
+    same (and gives empty MathML)"""
+    return ('<table class="ltx_equation ltx_eqn_table hoptex_error"><tr><td class="ltx_eqn_cell">'
+        '<span class="ltx_ERROR">{}</span></td></tr></table>').format(escape(message))
+
+def converter_version(command=None):
+    """Identifies the converter (latexml's version, and the persistent
+    converter's command if there is one), so results of another converter
+    are not reused"""
+    try:
+        proc = subprocess.run(["latexml", "--VERSION"], stdout=PIPE, stderr=PIPE, timeout=60)
+        version = (proc.stdout+proc.stderr).decode('utf-8','replace').strip()
+    except (OSError, subprocess.SubprocessError):
+        version = ''
+    if command:
+        version += '\t'+' '.join(os.path.basename(part) for part in command)
+    return version
+
+class latexml_daemon:
+    """A long-lived converter process. It is started on the first convert,
+    and restarted after it dies, overruns a timeout or has converted
+    maxtasks documents (LaTeXML leaks memory on some papers)"""
+    def __init__(self,command=None,maxtasks=None):
+        self.command = command or daemon_command
+        self.maxtasks = maxtasks
+        self.process = None
+        self.buffer = b''
+        self.tasks = 0
+
+    def start(self):
+        self.process = subprocess.Popen(self.command,stdin=PIPE,stdout=PIPE,stderr=subprocess.DEVNULL)
+        # requests are written with send, which must never block
+        os.set_blocking(self.process.stdin.fileno(),False)
+        self.buffer = b''
+        self.tasks = 0
+
+    def stop(self,kill=False):
+        if self.process is None:
+            return
+        if not kill:
+            try:
+                self.process.stdin.close()
+                self.process.wait(5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        for stream in (self.process.stdin,self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        self.process = None
+
+    def send(self,data,deadline):
+        """Writes data to the converter, waiting until deadline for it to
+        read what does not fit in the pipe"""
+        fd = self.process.stdin.fileno()
+        data = memoryview(data)
+        while data:
+            remaining = deadline-time.time()
+            if remaining<=0:
+                raise TimeoutError
+            _, ready, _ = select.select([],[fd],[],remaining)
+            if not ready:
+                raise TimeoutError
+            try:
+                written = os.write(fd,data)
+            except BlockingIOError:
+                continue
+            data = data[written:]
+
+    def fill(self,deadline):
+        """Adds whatever the converter has written to the buffer, waiting
+        until deadline for it to write something"""
+        remaining = deadline-time.time()
+        if remaining<=0:
+            raise TimeoutError
+        ready, _, _ = select.select([self.process.stdout],[],[],remaining)
+        if not ready:
+            raise TimeoutError
+        chunk = os.read(self.process.stdout.fileno(),1<<16)
+        if not chunk:
+            raise EOFError
+        self.buffer += chunk
+
+    def read_line(self,deadline):
+        while b'\n' not in self.buffer:
+            self.fill(deadline)
+        line, self.buffer = self.buffer.split(b'\n',1)
+        return line
+
+    def read_exact(self,length,deadline):
+        while len(self.buffer)<length:
+            self.fill(deadline)
+        data, self.buffer = self.buffer[:length], self.buffer[length:]
+        return data
+
+    def convert(self,document,timeout):
+        """Converts document. Returns (xml, xhtml) as bytes, or raises
+        conversion_error"""
+        if self.process is None or self.process.poll() is not None:
+            self.stop(kill=True)
+            self.start()
+        data = document.encode()
+        deadline = time.time()+timeout
+        try:
+            self.send(str(len(data)).encode()+b'\n'+data,deadline)
+            fields = self.read_line(deadline).split()
+            parts = [self.read_exact(int(length),deadline) for length in fields[1:]]
+        except TimeoutError:
+            self.stop(kill=True)
+            raise conversion_error("MathML conversion failed - timeout")
+        except (OSError, ValueError, EOFError):
+            self.stop(kill=True)
+            raise conversion_error("Conversion failed - converter exited")
+        self.tasks += 1
+        if self.maxtasks and self.tasks>=self.maxtasks:
+            self.stop()
+        if fields[0]!=b'ok' or len(parts)!=2:
+            raise conversion_error("Conversion failed")
+        return parts[0], parts[1]
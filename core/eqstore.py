@@ -0,0 +1,251 @@
+"""Memory-mapped equation store
+
+An equation TSV loaded into a dict costs every consumer a full read and a
+lot of memory per worker. A store holds the same rows in one binary file:
+
+    header    magic, version, flags, record count and section offsets
+    records   u32 length + tab separated, escaped UTF-8 fields: eqid,
+              sub_ids, text and key (left out when it equals text)
+    eqid index   sorted u64 hashes of eqid.lower(), then the u64 offsets
+                 of their records
+    key index    sorted u64 hashes of key, then the u64 offsets of their
+                 records
+
+key is what the consumers look equations up by (the flattened equation for
+single display equations, the text itself for multiline and inline ones).
+Where keys repeat, the key index lists the record enumerate_docs kept in
+its dictionary first: the last one for display stores, the first one for
+inline stores. Opening a store only maps the file and reads the header,
+lookups are binary searches in the mapped hash arrays, and workers forked
+after opening share its pages (unlike a dict, looking an equation up does
+not write to any of them).
+"""
+import os
+import sys
+import mmap
+import bisect
+import struct
+import hashlib
+from array import array
+from core.tsvcodec import *
+from core.normalize import *
+
+store_magic = b'HOPTEXEQ'
+store_version = 2
+inline_flag = 1
+
+header_format = struct.Struct('<8sIIQQQQ')
+length_format = struct.Struct('<I')
+
+def hash64(text):
+    """Stable 64-bit hash of a string"""
+    digest = hashlib.blake2b(text.encode('utf-8','surrogateescape'),digest_size=8).digest()
+    return int.from_bytes(digest,'little')
+
+def is_equation_store(path):
+    """True if path is an equation store rather than a TSV"""
+    try:
+        with open(path,mode='rb') as fh:
+            return fh.read(len(store_magic))==store_magic
+    except OSError:
+        return False
+
+def lookup_key(row,inline=False):
+    """The key consumers look the equation of a TSV row up by, as
+    enumerate_docs builds its dictionary"""
+    if inline:
+        return row[-1].strip()
+    if len(row)==2:
+        return normalize_equation(row[1]).flat or ''
+    return row[-1]
+
+def write_store(path,rows,inline=False):
+    """Writes (eqid, sub_ids, text, key) rows to a store at path.
+    Returns the number of records"""
+    eqid_entries = []
+    key_entries = []
+    temp_path = path+'.tmp'
+    with open(temp_path,mode='wb') as fh:
+        fh.write(header_format.pack(store_magic,store_version,0,0,0,0,0))
+        data_offset = fh.tell()
+        for eqid, sub_ids, text, key in rows:
+            offset = fh.tell()
+            fields = (eqid,sub_ids,text) if key==text else (eqid,sub_ids,text,key)
+            payload = '\t'.join(map(tsv_escape,fields))
+            payload = payload.encode('utf-8','surrogateescape')
+            fh.write(length_format.pack(len(payload)))
+            fh.write(payload)
+            eqid_entries.append((hash64(eqid.lower()),offset))
+            key_entries.append((hash64(key),offset))
+        index_offsets = []
+        eqid_entries.sort()
+        if inline:
+            key_entries.sort()
+        else:
+            key_entries.sort(key=lambda entry: (entry[0],-entry[1]))
+        for entries in (eqid_entries,key_entries):
+            fh.write(b'\0'*(-fh.tell()%8))
+            index_offsets.append(fh.tell())
+            for column in (0,1):
+                values = array('Q',(entry[column] for entry in entries))
+                if sys.byteorder!='little':
+                    values.byteswap()
+                fh.write(values.tobytes())
+        fh.seek(0)
+        fh.write(header_format.pack(store_magic,store_version,inline_flag if inline else 0,
+            len(eqid_entries),data_offset,index_offsets[0],index_offsets[1]))
+    os.replace(temp_path,path)
+    return len(eqid_entries)
+
+def import_tsv(tsv,path,inline=False):
+    """Builds a store from an equation TSV (enumerate_eqs or
+    enumerate_inline_eqs output)"""
+    def rows():
+        for row in read_tsv_rows(tsv):
+            if len(row)==2:
+                yield (row[0],'',row[1],lookup_key(row,inline))
+            elif len(row)==3:
+                yield (row[0],row[1],row[2],lookup_key(row,inline))
+    return write_store(path,rows(),inline)
+
+def export_tsv(path,tsv):
+    """Writes a store back out as an equation TSV"""
+    store = equation_store(path)
+    with open_tsv(tsv) as fh:
+        for eqid, sub_ids, text, key in store:
+            if sub_ids:
+                fh.write(format_row([eqid,sub_ids,text]))
+            else:
+                fh.write(format_row([eqid,text]))
+    store.close()
+    return len(store)
+
+class equation_store:
+    """Read-only view of a store. Behaves like the key -> eqid dictionary
+    enumerate_docs builds from the TSV"""
+    def __init__(self,path):
+        self.path = path
+        with open(path,mode='rb') as fh:
+            self.data = mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+        magic, version, flags, count, data_offset, eqid_offset, key_offset = header_format.unpack_from(self.data,0)
+        if magic!=store_magic:
+            raise ValueError("{}: not an equation store".format(path))
+        if version!=store_version:
+            raise ValueError("{}: equation store version {}, rebuild it with utils/eqstore.py".format(path,version))
+        self.inline = bool(flags & inline_flag)
+        self.count = count
+        self.data_offset = data_offset
+        self.views = []
+        self.eqid_index = self.index_at(eqid_offset)
+        self.key_index = self.index_at(key_offset)
+
+    def index_at(self,offset):
+        """The (hashes, record offsets) arrays of the index at offset"""
+        size = self.count*8
+        columns = []
+        for start in (offset,offset+size):
+            if sys.byteorder=='little':
+                view = memoryview(self.data)[start:start+size]
+                self.views.append(view)
+                column = view.cast('Q')
+                self.views.append(column)
+            else:
+                column = array('Q',self.data[start:start+size])
+                column.byteswap()
+            columns.append(column)
+        return tuple(columns)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.data.close()
+
+    def raw_record(self,offset):
+        """The still escaped fields of the record at offset, and the offset
+        of the next record"""
+        length, = length_format.unpack_from(self.data,offset)
+        start = offset+length_format.size
+        return self.data[start:start+length].split(b'\t'), start+length
+
+    def decode(self,raw):
+        """[eqid, sub_ids, text, key] from the fields of raw_record"""
+        fields = [tsv_unescape(field.decode('utf-8','surrogateescape')) for field in raw]
+        if len(fields)==3:
+            fields.append(fields[2])
+        return fields
+
+    def record_at(self,offset):
+        """Returns [eqid, sub_ids, text, key] of the record at offset, and
+        the offset of the next record"""
+        raw, offset = self.raw_record(offset)
+        return self.decode(raw), offset
+
+    def __iter__(self):
+        offset = self.data_offset
+        for _ in range(self.count):
+            fields, offset = self.record_at(offset)
+            yield fields
+
+    def candidates(self,index,value):
+        """Offsets of the records whose index entry has hash value"""
+        hashes, offsets = index
+        position = bisect.bisect_left(hashes,value)
+        while position<self.count and hashes[position]==value:
+            yield offsets[position]
+            position += 1
+
+    def by_eqid(self,eqid):
+        """The record with this EQID (case-insensitive), or None"""
+        eqid = eqid.lower()
+        for offset in self.candidates(self.eqid_index,hash64(eqid)):
+            fields, _ = self.record_at(offset)
+            if fields[0].lower()==eqid:
+                return fields
+        return None
+
+    def find_key(self,key,first=False):
+        """raw_record fields of the record with this key that the dictionary
+        would hold (with first, the earliest record with this key), or None.
+        Keys are compared escaped, so only the result is decoded"""
+        if key is None:
+            return None
+        target = tsv_escape(key).encode('utf-8','surrogateescape')
+        found = None
+        for offset in self.candidates(self.key_index,hash64(key)):
+            raw, _ = self.raw_record(offset)
+            # the key is the last field, text when it was left out
+            if raw[-1]==target:
+                if not first:
+                    return raw
+                if found is None or offset<found[0]:
+                    found = (offset,raw)
+        if found is None:
+            return None
+        return found[1]
+
+    def by_key(self,key,first=False):
+        """The record with this key that the dictionary would hold (with
+        first, the earliest record with this key), or None"""
+        raw = self.find_key(key,first)
+        if raw is None:
+            return None
+        return self.decode(raw)
+
+    def get(self,key,default=None):
+        raw = self.find_key(key)
+        if raw is None:
+            return default
+        return tsv_unescape(raw[0].decode('utf-8','surrogateescape'))
+
+    def __contains__(self,key):
+        return self.find_key(key) is not None
+
+    def __getitem__(self,key):
+        raw = self.find_key(key)
+        if raw is None:
+            raise KeyError(key)
+        return tsv_unescape(raw[0].decode('utf-8','surrogateescape'))
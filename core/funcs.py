@@ -1,8 +1,12 @@
 import glob
 import os
 import re
+import bisect
+import mmap
+import contextlib
 import multiprocessing as mp
 import gc
+from core import tsvcodec
 
 global a
 global b
@@ -49,6 +53,12 @@ r10 = r'\\q{0,1}quad'
 
 to_remove = [r1,r2,r3,r4,r5,r6,r7,r8,r9,r10]
 
+to_remove_patterns = [re.compile(expr) for expr in to_remove]
+
+whitespace_pattern = re.compile(r'\s')
+
+row_break = re.compile(r'(?:\\\\)+')
+
 multiline_list = [cb,cc,cd,ce,ci]
 
 expr_list = [a,b,c,d,e,f,g,h,i]
@@ -65,19 +75,440 @@ edoc = r"\\end{document}"
 
 body_pattern = r'(?s)\\begin{document}.*?\\end{document}'
 
+# LEXER
+# lex_latex scans a document once and splits it into typed segments: text,
+# display math of each kind, inline $...$ math and \(...\) math. The grab_*
+# functions below are views over the resulting latex_index, and return what
+# the old chain of regexes (remove_comments, grab_body, clean_inline_math,
+# non_capture_math) returned.
+
+body_start = '\\begin{document}'
+body_end = '\\end{document}'
+comment_start = '\\begin{comment}'
+comment_end = '\\end{comment}'
+
+# group names of the display environments, as in cap_expr_list
+display_kinds = {'equation':'equation','multline':'multline','gather':'gather',
+    'align':'align','flalign':'flalign','math':'dmath','eqnarray':'eqnarray'}
+
+display_start = re.compile(r'\\begin\{('+'|'.join(display_kinds)+r')\*?\}|\\\[|\$\$')
+
+display_end = dict((env,re.compile(r'\\end\{'+env+r'\*?\}')) for env in display_kinds)
+
+inline_submatch = re.compile(r'\$.+?\$')
+
+class stripped_text:
+    """A document with spans cut out of it. pieces are the (start, end) spans
+    of source that are kept, so offsets in text map back to source"""
+    def __init__(self,source,pieces=None):
+        if pieces is None:
+            pieces = [(0,len(source))]
+        self.source = source
+        self.pieces = pieces
+        self.starts = []
+        length = 0
+        for start, end in pieces:
+            self.starts.append(length)
+            length += end-start
+        if len(pieces)==1:
+            self.text = source[pieces[0][0]:pieces[0][1]]
+        else:
+            self.text = ''.join(source[start:end] for start, end in pieces)
+
+    def source_spans(self,start,end):
+        """The spans of source that make up text[start:end]"""
+        spans = []
+        index = bisect.bisect_right(self.starts,start)-1
+        while start<end:
+            piece_start, piece_end = self.pieces[index]
+            offset = piece_start+start-self.starts[index]
+            length = min(end-start,piece_end-offset)
+            spans.append((offset,offset+length))
+            start += length
+            index += 1
+        return spans
+
+    def cut(self,spans):
+        """Returns the text without the given sorted spans"""
+        kept = []
+        last = 0
+        for start, end in list(spans)+[(len(self.text),len(self.text))]:
+            if start>last:
+                for piece in self.source_spans(last,start):
+                    if kept and kept[-1][1]==piece[0]:
+                        kept[-1] = (kept[-1][0],piece[1])
+                    else:
+                        kept.append(piece)
+            last = max(last,end)
+        return stripped_text(self.source,kept)
+
+    def slice(self,start,end):
+        return self.cut([(0,start),(end,len(self.text))])
+
+    def original_offset(self,pos):
+        """Offset in source of position pos of text"""
+        index = bisect.bisect_right(self.starts,pos)-1
+        if index<0:
+            return pos
+        return self.pieces[index][0]+pos-self.starts[index]
+
+def comment_spans(text):
+    """Returns the sorted (start, end) spans of text that are comments.
+    \\% is not a comment. A line that starts with % goes with its newline, a
+    comment ending in a bare % runs on into the next line, and other comments
+    keep their newline"""
+    spans = []
+    length = len(text)
+    i = text.find('%')
+    while i!=-1:
+        end = text.find('\n',i)
+        if end==-1:
+            break
+        if i>0 and text[i-1]=='\n' and end>i+1:
+            spans.append((i,end+1))
+            i = text.find('%',end+1)
+            continue
+        if i>0 and text[i-1]=='\\':
+            i = text.find('%',i+1)
+            continue
+        if end==i+1:
+            spans.append((i,end+1))
+            i = text.find('%',end+1)
+            continue
+        joins = []
+        while end!=-1 and text[end-1]=='%' and end-1>i and text[end-2]!='\\':
+            joins.append((end-1,end+1))
+            start = end+1
+            while start<length and text[start]=='%':
+                line_end = text.find('\n',start)
+                if line_end==-1:
+                    break
+                joins.append((start,line_end+1))
+                start = line_end+1
+            end = text.find('\n',start)
+        if end==-1:
+            # nothing ends the comment, so only the joined lines go
+            spans.extend(joins)
+            break
+        spans.append((i,end))
+        i = text.find('%',end+1)
+    return spans
+
+def strip_comments(document):
+    """Cuts comments and comment environments out of a stripped_text"""
+    document = document.cut(comment_spans(document.text))
+    text = document.text
+    spans = []
+    start = text.find(comment_start)
+    while start!=-1:
+        end = text.find(comment_end,start+len(comment_start))
+        if end==-1:
+            break
+        end += len(comment_end)
+        spans.append((start,end))
+        start = text.find(comment_start,end)
+    if spans:
+        document = document.cut(spans)
+    return document
+
+def active_dollars(text):
+    """Positions of the $ signs in text that are not escaped as \\$"""
+    dollars = []
+    i = text.find('$')
+    while i!=-1:
+        j = i
+        while j>0 and text[j-1]=='\\':
+            j -= 1
+        if (i-j)%2==0:
+            dollars.append(i)
+        i = text.find('$',i+1)
+    return dollars
+
+def inline_runs(text,dollars):
+    """Inline math in text, as matched by inline_pattern. Each run of
+    directly adjacent $...$ groups is returned as a list of (start, end)"""
+    runs = []
+    active = set(dollars)
+    length = len(text)
+    index = 0
+    while index<len(dollars):
+        start = dollars[index]
+        if start==0 or start-1 in active:
+            index += 1
+            continue
+        run = []
+        position = index
+        while True:
+            current = dollars[position]
+            if current+1>=length or current+1 in active or position+1>=len(dollars):
+                run = None
+                break
+            close = dollars[position+1]
+            run.append((current,close+1))
+            if close+1>=length:
+                run = None
+                break
+            if close+1 not in active:
+                break
+            position += 2
+        if run is None:
+            index += 1
+            continue
+        runs.append(run)
+        while index<len(dollars) and dollars[index]<run[-1][1]:
+            index += 1
+    return runs
+
+def double_dollars(dollars):
+    """Positions of the $$ pairs among dollars"""
+    active = set(dollars)
+    return [i for i in dollars if i+1 in active]
+
+def dollar_display_end(text,doubles,start):
+    """End of the $$...$$ display that opens at start, or -1"""
+    if start+2>=len(text) or text[start+2]=='^':
+        return -1
+    close = bisect.bisect_left(doubles,start+3)
+    if close==len(doubles):
+        return -1
+    return doubles[close]+2
+
+def insert_spaces(text,positions):
+    """Inserts a space before each of the sorted positions of text"""
+    pieces = []
+    last = 0
+    for position in positions:
+        pieces.append(text[last:position])
+        last = position
+    pieces.append(text[last:])
+    return ' '.join(pieces)
+
+class latex_index:
+    """Segment index of a document, built by lex_latex.
+    text is the document with comments removed, adjacent inline equations
+    separated and $$...$$ padded with spaces, as clean_inline_math does.
+    display, inline and paren hold (kind, start, end) spans of text. segments
+    holds every top level span in order, with 'text' spans between them.
+    original_offset maps offsets in text back to the document"""
+    def __init__(self,document):
+        self.document = document
+        source = document.text
+        runs = inline_runs(source,active_dollars(source))
+        junctions = [part[0] for run in runs for part in run[1:]]
+        split = insert_spaces(source,junctions)
+        doubles = double_dollars(active_dollars(split))
+        padding = []
+        index = 0
+        while index<len(doubles):
+            end = dollar_display_end(split,doubles,doubles[index])
+            if end==-1:
+                index += 1
+                continue
+            padding.append(doubles[index])
+            padding.append(end)
+            index = bisect.bisect_left(doubles,end)
+        self.text = insert_spaces(split,padding)
+        # positions in text of the inserted spaces
+        self.inserted = sorted([position+i for i, position in enumerate(padding)]+
+            [position+i+bisect.bisect_right(padding,position+i) for i, position in enumerate(junctions)])
+        self.lex()
+
+    def lex(self):
+        text = self.text
+        dollars = active_dollars(text)
+        active = set(dollars)
+        doubles = double_dollars(dollars)
+        self.display = []
+        match = display_start.search(text)
+        while match:
+            start = match.start()
+            end = -1
+            if match.group(1):
+                kind = display_kinds[match.group(1)]
+                closing = display_end[match.group(1)].search(text,match.end())
+                if closing:
+                    end = closing.end()
+            elif match.group(0)=='$$':
+                kind = 'dollarsign'
+                if start in active and start+1 in active:
+                    end = dollar_display_end(text,doubles,start)
+            else:
+                kind = 'bracket'
+                if start==0 or text[start-1]!='\\':
+                    end = text.find('\\]',match.end())
+                    if end!=-1:
+                        end += 2
+            if end==-1:
+                match = display_start.search(text,start+1)
+                continue
+            self.display.append((kind,start,end))
+            match = display_start.search(text,end)
+        self.inline = [('inline',run[0][0],run[-1][1]) for run in inline_runs(text,dollars)]
+        self.paren = []
+        start = text.find('\\(')
+        while start!=-1:
+            if start>0 and text[start-1]=='\\':
+                start = text.find('\\(',start+1)
+                continue
+            end = text.find('\\)',start+2)
+            if end==-1:
+                break
+            self.paren.append(('paren',start,end+2))
+            start = text.find('\\(',end+2)
+        self.segments = []
+        last = 0
+        for kind, start, end in sorted(self.display+self.inline+self.paren,key=lambda span: span[1]):
+            if start<last:
+                continue
+            if start>last:
+                self.segments.append(('text',last,start))
+            self.segments.append((kind,start,end))
+            last = end
+        if last<len(text):
+            self.segments.append(('text',last,len(text)))
+
+    def original_offset(self,pos):
+        """Offset in the original document of position pos of text"""
+        pos -= bisect.bisect_left(self.inserted,pos)
+        return self.document.original_offset(pos)
+
+    def spans(self,items):
+        return [self.text[start:end] for kind, start, end in items]
+
+    def split(self,items):
+        """text split around items, as re.split with a group returns it"""
+        pieces = []
+        last = 0
+        for kind, start, end in items:
+            pieces.append(self.text[last:start])
+            pieces.append(self.text[start:end])
+            last = end
+        pieces.append(self.text[last:])
+        return pieces
+
+    def inline_equations(self):
+        """(start, end) of each equation grab_inline_math returns, in order"""
+        spans = []
+        for kind, start, end in self.inline:
+            for match in inline_submatch.finditer(self.text,start,end):
+                spans.append((match.start(),match.end()))
+        return spans
+
+def rewrite_spans(text,replacements):
+    """text rebuilt in one pass, with text[start:end] replaced by new for
+    each (start, end, new) of the sorted, non-overlapping replacements"""
+    pieces = []
+    last = 0
+    for start, end, new in replacements:
+        pieces.append(text[last:start])
+        pieces.append(new)
+        last = end
+    pieces.append(text[last:])
+    return ''.join(pieces)
+
+def body_span(text):
+    """(start, end) of the first \\begin{document}...\\end{document}, or None"""
+    start = text.find(body_start)
+    if start==-1:
+        return None
+    end = text.find(body_end,start+len(body_start))
+    if end==-1:
+        return None
+    return (start,end+len(body_end))
+
+def lex_latex(text,body=True):
+    """Builds the latex_index of a document. With body, only the part between
+    \\begin{document} and \\end{document} is indexed, as in grab_math"""
+    document = strip_comments(stripped_text(text))
+    if body:
+        span = body_span(document.text)
+        if span:
+            document = strip_comments(document.slice(*span))
+        else:
+            document = document.slice(0,0)
+    return latex_index(document)
+
+# BYTES MODE
+# Cheap questions about a file (is there a body? could it hold any math?) are
+# answered on an mmap of the file with bytes patterns, without decoding it.
+# Removing comments can join two lines (%\n and comment environments), so a
+# token is only known to be absent if it is not in the file and nothing can
+# be joined.
+
+bytes_math_start = re.compile(rb'\$|\\\[|\\begin\{(?:'+'|'.join(display_kinds).encode()+rb')\*?\}')
+
+@contextlib.contextmanager
+def mapped_document(filename):
+    """Maps a file read-only. Yields the mapping (b'' for empty files)"""
+    with open(filename,mode='rb') as fh:
+        if os.fstat(fh.fileno()).st_size==0:
+            yield b''
+            return
+        mapping = mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            yield mapping
+        finally:
+            mapping.close()
+
+def decode_document(data):
+    """Decodes a mapping (or bytes) the way open(..., encoding='latin-1')
+    would, \r\n and \r becoming \n"""
+    return str(data,'latin-1').replace('\r\n','\n').replace('\r','\n')
+
+def decode_body(data,span):
+    """Decodes only the body of data, span being its body_offsets (an empty
+    body if None). Data with carriage returns is decoded whole, as the byte
+    offsets do not hold once newlines are translated; lex_latex finds the
+    body in it again"""
+    if data.find(b'\r')!=-1:
+        return decode_document(data)
+    if span is None:
+        return ''
+    return decode_document(data[span[0]:span[1]])
+
+def may_join(data):
+    """True if removing comments from data could join text together"""
+    return data.find(b'%\n')!=-1 or data.find(comment_start.encode())!=-1
+
+def may_contain(data,token):
+    """False if data cannot contain token once comments are removed"""
+    return data.find(token)!=-1 or may_join(data)
+
+def may_have_math(data):
+    """False if data cannot contain display or inline math"""
+    return bytes_math_start.search(data) is not None or may_join(data)
+
+def body_offsets(data):
+    """(start, end) byte offsets of the document body of data, as grab_body
+    finds it, or None. Only decodes data if it has comments, and then without
+    translating newlines, so that offsets in the text are byte offsets"""
+    if data.find(b'%')==-1 and data.find(comment_start.encode())==-1:
+        start = data.find(body_start.encode())
+        if start==-1:
+            return None
+        end = data.find(body_end.encode(),start+len(body_start))
+        if end==-1:
+            return None
+        return (start,end+len(body_end))
+    document = strip_comments(stripped_text(str(data,'latin-1')))
+    span = body_span(document.text)
+    if span is None:
+        return None
+    return (document.original_offset(span[0]),document.original_offset(span[1]-1)+1)
+
 # Functions used throughout the hoptex library go here
 
 def grab_body(text):
     text = remove_comments(text)
-    match = re.search(body_pattern,text)
-    if match:
-        return match.group(0)
+    span = body_span(text)
+    if span:
+        return text[span[0]:span[1]]
     else:
         return ''
 
 def remove_inline_math(text):
-    text = re.sub(inline_pattern,'',text)
-    return text
+    runs = inline_runs(text,active_dollars(text))
+    return stripped_text(text).cut([(run[0][0],run[-1][1]) for run in runs]).text
 
 def is_math(text):
     if re.match(non_capture_math,text):
@@ -93,7 +524,7 @@ def is_multiline(text):
 
 def remove_whitespace(text):
     """Believe it or not, this function removes whitespace from text"""
-    text = re.sub(r'\s','',text)
+    text = whitespace_pattern.sub('',text)
     return text
 
 def split_multiline(text):
@@ -109,10 +540,10 @@ def enforce_newlines(text):
     return text
 
 def sanitize_equation(text, complete=False):
-    for expr in to_remove:
-        text = re.sub(expr,'',text)
+    for pattern in to_remove_patterns:
+        text = pattern.sub('',text)
     if complete:
-        text = re.sub(r'(?:\\\\)+','',text)
+        text = row_break.sub('',text)
     return text
 
 def standardize_equation(text):
@@ -128,7 +559,7 @@ def flatten_equation(text):
 
 def split_multiline(text):
     text = flatten_equation(text)
-    newtextlist = re.split(r'(?:\\\\)+',text)
+    newtextlist = row_break.split(text)
     return newtextlist
 
 
@@ -137,16 +568,15 @@ def load_document(filename):
         text = fh.read()
     return text
 
-def generate_sanitized_document(text):
-    """Generates LaTeXML document containing only usepackage statements,
-    begin & end document statements, and math found between the begin and end
-    document statements.
-    Returns string of the new text document
-    """
+def sanitized_parts(text):
+    """Splits the document generate_sanitized_document builds from text into
+    its preamble (\\documentclass, \\usepackage and \\begin{document}) and
+    its display math. Returns (preamble, equations), or None if text has no
+    body"""
     text = remove_comments(text)
     text = remove_inline_math(text)
     if not (re.search(bdoc,text) and re.search(edoc,text)):
-        return ""
+        return None
     body = grab_math(text)
     packages = re.findall(r'(?s)\\usepackage(?:\[.*?\])?\{.*?\}',text)
     docclass = re.search(r'\\documentclass(?:\[.*?\])?\{.*?\}',text)
@@ -157,14 +587,38 @@ def generate_sanitized_document(text):
     else:
         docclass = '\\documentclass{article}\n'
     preamble = [docclass] + packages + ['\\begin{document}\n']
+    return preamble, body
+
+def sanitized_document(preamble, equations):
+    """Joins a preamble from sanitized_parts and display math into a
+    LaTeXML document"""
     postamble = ["\\end{document}"]
-    output = '\n\n'.join(preamble+body+postamble)
-    return output
+    return '\n\n'.join(preamble+equations+postamble)
+
+def generate_sanitized_document(text):
+    """Generates LaTeXML document containing only usepackage statements,
+    begin & end document statements, and math found between the begin and end
+    document statements.
+    Returns string of the new text document
+    """
+    parts = sanitized_parts(text)
+    if parts is None:
+        return ""
+    return sanitized_document(*parts)
+
+def sanitized_parts_from_file(filename):
+    """sanitized_parts of a .tex file"""
+    with mapped_document(filename) as data:
+        if not (may_contain(data,body_start.encode()) and may_contain(data,body_end.encode())):
+            return None
+        text = decode_document(data)
+    return sanitized_parts(text)
 
 def sanitized_doc_from_file(filename):
-    with open(filename,mode='r',encoding='latin-1') as fh:
-        text = fh.read()
-    return generate_sanitized_document(text)
+    parts = sanitized_parts_from_file(filename)
+    if parts is None:
+        return ""
+    return sanitized_document(*parts)
 
 def gettexfiles(path):
     """Returns list of absolute paths to .tex files in a folder at path"""
@@ -176,11 +630,7 @@ def gettexfiles(path):
 
 def remove_comments(text):
     """Takes LaTeX document text & returns document without any comments"""
-    text = re.sub(r'(?<=\n)%.+?\n','',text)
-    text = re.sub(r'(?<!\\)%\n','',text)
-    text = re.sub(r'(?<!\\)%.*?\n','\n',text)
-    text = re.sub(r'(?s)\\begin\{comment\}.*?\\end\{comment\}','',text)
-    return text
+    return strip_comments(stripped_text(text)).text
 
 def remove_comment_newlines(text):
     """Removes percentages immediately followed by newlines"""
@@ -188,44 +638,32 @@ def remove_comment_newlines(text):
     return text
 
 def clean_inline_math(text):
-    text = remove_comments(text)
-    text = re.sub(r'(?<!\\)((?:\\\\)*)(\\\$)','\1escapeddollarsign',text)
-    matches = re.findall(inline_pattern,text)
-    for match in matches:
-        sub_eqs = re.findall(r'(?s)\$.+?\$',match)
-        if len(sub_eqs)>0:
-            new_inline_text = ' '.join(sub_eqs)
-            text  = text.replace(match,new_inline_text)
-    text = re.sub(ch,r' \1 ',text)
-    text = re.sub('escapeddollarsign',r'\\\$',text)
-    return text
+    """Removes comments, separates adjacent inline equations ($a$$b$ becomes
+    $a$ $b$) and pads $$...$$ with spaces"""
+    return lex_latex(text,body=False).text
 
 def grab_math(text, split=False):
     """Returns list of display math in the LaTeX document
     Enabling the split option returns the interspersed text, as separate
     entries in the list (e.g. text, eq, text, eq)"""
-    text = grab_body(text)
-    text = clean_inline_math(text)
+    index = lex_latex(text)
     if(split):
-        matches = re.split(non_capture_math,text)
-        return matches
+        return index.split(index.display)
     else:
-        matches = re.findall(non_capture_math,text)
-        return matches
+        return index.spans(index.display)
 
 def grab_inline_math(text, split=False):
     """Inline equivalent of grab_math"""
-    text = grab_body(text)
-    text = clean_inline_math(text)
+    index = lex_latex(text)
     matchlist = []
-    matches = re.findall(inline_pattern,text)
+    matches = index.spans(index.inline)
     if split:
-        textlist = re.split(inline_pattern,text)
+        textlist = index.split(index.inline)
         newtextlist = []
         matches = set(matches)
         for text in textlist:
             if text in matches:
-                submatches = re.findall(r'\$.+?\$',text)
+                submatches = inline_submatch.findall(text)
                 for submatch in submatches:
                     newtextlist.append(submatch)
             else:
@@ -233,44 +671,35 @@ def grab_inline_math(text, split=False):
         return newtextlist
     else:
         for match in matches:
-            submatches = re.findall(r'\$.+?\$',match)
+            submatches = inline_submatch.findall(match)
             for submatch in submatches:
                 matchlist.append(submatch)
         return matchlist
 
 def grab_math_from_file(filename, split=False):
     """Combines grab_math and the prerequisite opening & reading in of .tex files"""
-    with open(filename,mode='r',encoding='latin-1') as fh:
-        text = fh.read()
+    with mapped_document(filename) as data:
+        if not split and not may_have_math(data):
+            return []
+        text = decode_body(data,body_offsets(data))
     return grab_math(text, split)
 
 def grab_inline_math_from_file(filename):
     """Inline equivalent of grab_math_from_file"""
-    with open(filename,mode='r',encoding='latin-1') as fh:
-        text = fh.read()
+    with mapped_document(filename) as data:
+        if data.find(b'$')==-1:
+            return []
+        text = decode_body(data,body_offsets(data))
     return grab_inline_math(text)
 
 def hasmath(filename):
     """Returns tuple of the filename and the number of display mode math
     equations in the text"""
-    with open(filename, mode='r', encoding='latin-1') as f1:
-        text = f1.read()
-    text = remove_comments(text)
-    finds = grab_math(text)
-    return (filename, len(finds))
-
-def getmathfiles(path):
-    """Returns a list of files that have math in them"""
-    filelist = glob.glob(os.path.join(path,'*.tex'))
-    outlist = []
-    pool = mp.Pool(processes=mp.cpu_count())
-    filelist = pool.map(hasmath,filelist)
-    for texfile in filelist:
-        if texfile[1]:
-            outlist.append(os.path.abspath(texfile[0]))
-    pool.close()
-    pool.join()
-    return outlist
+    with mapped_document(filename) as data:
+        if not may_have_math(data):
+            return (filename, 0)
+        text = decode_body(data,body_offsets(data))
+    return (filename, len(lex_latex(text).display))
 
 def validate_folder(folder_path):
     """Checks that the given folder exists - if not, it creates the destination folder"""
@@ -287,8 +716,8 @@ def read_tsv(filename):
 
 def mask(text):
     """Converts the equation into a tsv-friendly format"""
-    return repr(text)[1:-1]
+    return tsvcodec.tsv_escape(text)
 
 def unmask(text):
     """Converts the 'masked' equation back to its original form"""
-    return text.encode().decode('unicode-escape')
+    return tsvcodec.tsv_unescape(text)
@@ -0,0 +1,44 @@
+#!/usr/bin/env perl
+# latexml_worker.pl - persistent LaTeXML converter for convertlatex.py
+# (--backend daemon). LaTeXML is loaded once, then every document framed on
+# stdin is converted to XHTML; see core/converter.py for the protocol.
+use strict;
+use warnings;
+use LaTeXML;
+use LaTeXML::Common::Config;
+
+binmode(STDIN);
+binmode(STDOUT);
+$| = 1;
+
+my $config = LaTeXML::Common::Config->new(
+  format    => 'xhtml',
+  whatsin   => 'document',
+  whatsout  => 'document',
+  verbosity => -1);
+my $converter = LaTeXML->get_converter($config);
+$converter->prepare_session($config);
+
+sub reply {
+  my ($status, @parts) = @_;
+  foreach my $part (@parts) {
+    utf8::encode($part); }
+  print STDOUT join(' ', $status, map { length($_) } @parts), "\n", @parts;
+  return; }
+
+while (defined(my $header = <STDIN>)) {
+  chomp($header);
+  my $remaining = int($header);
+  my $source    = '';
+  while ($remaining > 0) {
+    my $read = read(STDIN, $source, $remaining, length($source));
+    last unless $read;
+    $remaining -= $read; }
+  last if $remaining > 0;
+  utf8::decode($source);
+  my $response = eval { $converter->convert("literal:$source") };
+  if (!$response || !defined($$response{result}) || ($$response{status_code} || 0) >= 3) {
+    reply('error', $@ || ($response && $$response{log}) || 'conversion failed'); }
+  else {
+    # the XML is not kept by the combined conversion, only the XHTML
+    reply('ok', '', $$response{result}); } }
@@ -0,0 +1,53 @@
+"""Bounded least-recently-used memo shared by demacro (--memo) and
+core/normalize (--norm-cache)
+
+An unbounded dict grows with every distinct key a large run sees, so each
+memo keeps at most size entries and drops the one used longest ago. The
+entries can be saved to a pickle and loaded again by a later run.
+"""
+import os
+import pickle
+from collections import OrderedDict
+
+class lru_memo:
+    """Bounded least-recently-used mapping"""
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self.items[key]
+        except KeyError:
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items)>self.size:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+    def load(self, path):
+        """Adds the entries saved at path, if any. Returns how many"""
+        if not path or not os.path.isfile(path):
+            return 0
+        try:
+            with open(path,mode='rb') as fh:
+                items = pickle.load(fh)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            print("{}: unreadable cache, ignoring it".format(path))
+            return 0
+        for key, value in items:
+            self.put(key,value)
+        return len(items)
+
+    def save(self, path):
+        temp_path = path+'.tmp'
+        with open(temp_path,mode='wb') as fh:
+            pickle.dump(list(self.items.items()),fh,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path,path)
@@ -0,0 +1,137 @@
+"""Corpus manifest: a SQLite index of the .tex files in a folder
+
+Every stage used to lex the whole corpus just to find the files with display
+math. The manifest records, per file, its size, mtime, content hash, display
+and inline equation counts and the offsets of the document body. It lives
+next to the folder (papers/ is indexed in papers.manifest.sqlite), is built
+in parallel the first time, and afterwards only files whose size or mtime
+changed are read again (and only re-lexed if their content changed).
+"""
+import os
+import glob
+import hashlib
+import sqlite3
+import multiprocessing as mp
+from core.funcs import *
+from core.schedule import *
+
+manifest_suffix = '.manifest.sqlite'
+
+schema = """CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    hash TEXT,
+    display INTEGER,
+    inline INTEGER,
+    body_start INTEGER,
+    body_end INTEGER)"""
+
+def manifest_path(path):
+    """Location of the manifest of the folder at path"""
+    return os.path.normpath(os.path.abspath(path))+manifest_suffix
+
+def open_manifest(path):
+    """Connects to the manifest of a folder, creating it if needed. Falls back
+    to an in-memory manifest if the file cannot be written"""
+    try:
+        db = sqlite3.connect(manifest_path(path),timeout=60)
+        db.execute(schema)
+        db.commit()
+    except sqlite3.Error as inst:
+        print("{}: cannot write manifest ({}), scanning without it".format(path,inst))
+        db = sqlite3.connect(':memory:')
+        db.execute(schema)
+    return db
+
+def count_math(text):
+    """Returns (display, inline, body_start, body_end) for a document. The
+    body offsets are those of \\begin{document} and the end of
+    \\end{document} in text, or None if there is no body"""
+    index = lex_latex(text)
+    inline = sum(len(inline_submatch.findall(match)) for match in index.spans(index.inline))
+    body = index.document
+    if body.text:
+        return (len(index.display),inline,body.original_offset(0),body.original_offset(len(body.text)-1)+1)
+    return (len(index.display),inline,None,None)
+
+def scan_file(task):
+    """Reads and hashes a file, and lexes its body unless its hash is
+    old_hash. Returns (filename, hash, counts), counts being None when
+    unchanged. The body offsets are byte offsets in the file"""
+    filename, old_hash = task
+    with mapped_document(filename) as data:
+        digest = hashlib.sha1(data).hexdigest()
+        if digest==old_hash:
+            return (filename,digest,None)
+        span = body_offsets(data)
+        if not may_have_math(data):
+            return (filename,digest,(0,0)+(span or (None,None)))
+        text = decode_body(data,span)
+    return (filename,digest,count_math(text)[:2]+(span or (None,None)))
+
+def update_manifest(path,processes=None):
+    """Brings the manifest of a folder up to date with its .tex files.
+    Returns the open connection"""
+    db = open_manifest(path)
+    folder = os.path.abspath(path)
+    known = {}
+    for name, size, mtime, digest in db.execute("SELECT name, size, mtime, hash FROM files"):
+        known[name] = (size,mtime,digest)
+    current = {}
+    for filename in glob.glob(os.path.join(folder,'*.tex')):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        current[os.path.basename(filename)] = (stat.st_size,stat.st_mtime_ns)
+    removed = [name for name in known if name not in current]
+    changed = [name for name in current if name not in known or known[name][:2]!=current[name]]
+    if removed:
+        db.executemany("DELETE FROM files WHERE name=?",[(name,) for name in removed])
+    if changed:
+        print("{}: indexing {} of {} files".format(path,len(changed),len(current)))
+        sizes = dict((name,current[name][0]) for name in changed)
+        tasks = [(os.path.join(folder,name),known[name][2] if name in known else None)
+            for name in largest_first(changed,sizes=sizes)]
+        pool = mp.Pool(processes=processes or mp.cpu_count())
+        for filename, digest, counts in pool.imap_unordered(scan_file,tasks,chunksize=8):
+            name = os.path.basename(filename)
+            size, mtime = current[name]
+            if counts is None:
+                db.execute("UPDATE files SET size=?, mtime=? WHERE name=?",(size,mtime,name))
+            else:
+                db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?)",
+                    (name,size,mtime,digest)+counts)
+        pool.close()
+        pool.join()
+    db.commit()
+    return db
+
+def manifest_files(path,min_display=0,min_inline=0,max_display=None):
+    """Returns absolute paths of the .tex files of a folder with at least the
+    given numbers of display and inline equations (and at most max_display
+    display equations), largest first"""
+    db = update_manifest(path)
+    folder = os.path.abspath(path)
+    if max_display is None:
+        rows = db.execute("SELECT name FROM files WHERE display>=? AND inline>=? ORDER BY size DESC",
+            (min_display,min_inline)).fetchall()
+    else:
+        rows = db.execute("SELECT name FROM files WHERE display>=? AND display<=? AND inline>=? ORDER BY size DESC",
+            (min_display,max_display,min_inline)).fetchall()
+    db.close()
+    return [os.path.join(folder,name) for name, in rows]
+
+def display_counts(path,min_display=0):
+    """Returns {absolute path: display equations} of the .tex files of a
+    folder with at least min_display display equations"""
+    db = update_manifest(path)
+    folder = os.path.abspath(path)
+    rows = db.execute("SELECT name, display FROM files WHERE display>=?",(min_display,)).fetchall()
+    db.close()
+    return {os.path.join(folder,name): display for name, display in rows}
+
+def getmathfiles(path):
+    """Returns a list of files that have math in them"""
+    return manifest_files(path,min_display=1)
@@ -0,0 +1,89 @@
+"""Equation-level MathML cache (convertlatex.py --math-cache)
+
+A large share of display equations recur across papers, and convertlatex
+used to convert every one of them again. The cache keeps the converted
+<table> of each equation, keyed by a hash of the converter version, the
+paper's \\documentclass and \\usepackage lines and the equation itself with
+its \\label removed and spacing collapsed (paragraph breaks and \\verb
+content are kept apart). It is a SQLite file shared by the pool workers;
+fragments are stored zlib-compressed. A table is stored numbered as if its
+equation were the only one in the paper (S0.E1, tag (1)), and renumbered
+where it is used (see converter.renumber_tables).
+
+Equations that reference others (\\ref, \\eqref, ...) render differently
+depending on the rest of the paper, so they are never cached.
+"""
+import re
+import zlib
+import sqlite3
+import hashlib
+
+schema = """CREATE TABLE IF NOT EXISTS fragments (
+    key BLOB PRIMARY KEY,
+    fragment BLOB)"""
+
+label_pattern = re.compile(r'\\label\s*\{[^{}]*\}')
+# a blank line (a paragraph break in \text{} or \parbox)
+paragraph_break = re.compile(r'\n\s*\n')
+# content whose spacing is kept as it is
+verbatim_pattern = re.compile(r'\\verb|\\begin\s*\{verbatim')
+reference_pattern = re.compile(r'\\(?:eq|page|auto|c|C)?ref\b')
+
+def cache_text(equation):
+    """The form of an equation the cache key is computed from: without its
+    \\label, and with each run of spaces and single newlines collapsed to
+    one space, blank lines to one blank line (but spacing kept as it is if
+    there is \\verb or verbatim content)"""
+    equation = label_pattern.sub('',equation)
+    if verbatim_pattern.search(equation):
+        return equation
+    return '\n\n'.join(' '.join(paragraph.split()) for paragraph in paragraph_break.split(equation))
+
+def cacheable(equation):
+    return not reference_pattern.search(equation)
+
+def equation_keys(preamble, equations, version):
+    """Cache keys of equations converted with preamble (see
+    sanitized_parts) by the converter identified by version"""
+    context = hashlib.sha1('\n'.join([version]+[line.strip() for line in preamble]).encode('utf-8','surrogatepass'))
+    keys = []
+    for equation in equations:
+        digest = context.copy()
+        digest.update(b'\n')
+        digest.update(cache_text(equation).encode('utf-8','surrogatepass'))
+        keys.append(digest.digest())
+    return keys
+
+class mathml_cache:
+    """Converted equation tables by key"""
+    def __init__(self,path):
+        self.db = sqlite3.connect(path,timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(schema)
+        self.db.commit()
+
+    def get_many(self,keys,batch=500):
+        """Returns {key: table} for the keys that are cached"""
+        keys = list(set(keys))
+        found = {}
+        for i in range(0,len(keys),batch):
+            chunk = keys[i:i+batch]
+            rows = self.db.execute('SELECT key, fragment FROM fragments WHERE key IN ({})'.format(
+                ','.join('?'*len(chunk))),chunk)
+            for key, fragment in rows:
+                found[bytes(key)] = zlib.decompress(fragment).decode('utf-8')
+        return found
+
+    def put_many(self,items):
+        """Stores (key, table) pairs"""
+        rows = [(key,zlib.compress(table.encode('utf-8'))) for key, table in items]
+        if not rows:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO fragments VALUES (?,?)',rows)
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM fragments').fetchone()[0]
+
+    def close(self):
+        self.db.close()
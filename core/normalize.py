@@ -0,0 +1,74 @@
+"""Equation normalization shared by enumerate_eqs, enumerate_docs and
+generatetsv
+
+normalize_equation does what standardize_equation, flatten_equation and
+split_multiline do between them, with one compiled alternation for the
+environment instead of trying each pattern of cap_expr_list in turn. The
+result is memoized in a bounded cache (core/lru.py), which a stage can save to disk
+(--norm-cache) so the next stage starts with the equations it has seen.
+"""
+import re
+import hashlib
+from core.funcs import *
+from core.lru import *
+
+multiline_kinds = ('multline','gather','align','flalign','eqnarray')
+
+def dispatch_pattern(patterns):
+    """Joins the named patterns of cap_expr_list into one alternation. The
+    math group of each kind is renamed to <kind>_math"""
+    parts = []
+    for pattern in patterns:
+        kind = re.match(r'\(\?s\)\(\?P<(\w+)>',pattern).group(1)
+        parts.append(pattern[len('(?s)'):].replace('(?P<math>','(?P<'+kind+'_math>'))
+    return re.compile('|'.join(parts),re.S)
+
+equation_pattern = dispatch_pattern(cap_expr_list)
+
+def content_hash(text):
+    """Stable 20 byte digest of text, which stands in for it as a key"""
+    return hashlib.sha1(text.encode('utf-8','surrogatepass')).digest()
+
+class normalized_equation:
+    """kind is the group name of the environment (None if text is not a
+    display equation), body the sanitized contents (standardize_equation),
+    flat the body without whitespace (flatten_equation), rows flat split on
+    \\\\ (split_multiline) and hash a stable digest of flat"""
+    def __init__(self,text):
+        match = equation_pattern.match(text)
+        if match:
+            self.kind = match.lastgroup
+            self.body = sanitize_equation(match.group(self.kind+'_math'))
+            self.flat = remove_whitespace(self.body)
+            self.rows = row_break.split(self.flat)
+        else:
+            self.kind = None
+            self.body = None
+            self.flat = None
+            self.rows = []
+        self.hash = content_hash(self.flat if self.flat is not None else text)
+
+    @property
+    def multiline(self):
+        return self.kind in multiline_kinds
+
+cache_size = 500000
+
+equation_cache = lru_memo(cache_size)
+
+def normalize_equation(text):
+    """Returns the (cached) normalized_equation of text"""
+    record = equation_cache.get(text)
+    if record is None:
+        record = normalized_equation(text)
+        equation_cache.put(text,record)
+    return record
+
+def load_normalize_cache(path):
+    if path:
+        count = equation_cache.load(path)
+        print("Loaded {} normalized equations".format(count))
+
+def save_normalize_cache(path):
+    if path:
+        equation_cache.save(path)
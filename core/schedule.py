@@ -0,0 +1,132 @@
+"""Size-aware scheduling of per-file work over a multiprocessing pool
+
+pool.map splits its list into a few large chunks up front, so a chunk that
+happens to hold several 5 MB papers finishes long after every other worker
+is idle. imap_scheduled hands out the largest files first, one per task,
+bundles small files into batches so they do not cost a round trip each,
+and yields results as soon as they finish.
+"""
+import os
+import time
+
+def item_size(path):
+    """Size in bytes of a file, or of every file below a folder"""
+    if os.path.isdir(path):
+        total = 0
+        for root, folders, files in os.walk(path):
+            for fname in files:
+                try:
+                    total += os.path.getsize(os.path.join(root,fname))
+                except OSError:
+                    pass
+        return total
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def load_costs(cost_file):
+    """Reads the seconds spent on each item in a previous run"""
+    costs = {}
+    if not cost_file or not os.path.isfile(cost_file):
+        return costs
+    with open(cost_file,mode='r',encoding='utf-8') as fh:
+        for line in fh:
+            contents = line.rstrip('\n').split('\t')
+            if len(contents)==2:
+                try:
+                    costs[contents[0]] = float(contents[1])
+                except ValueError:
+                    pass
+    return costs
+
+def save_costs(cost_file,costs):
+    with open(cost_file,mode='w',encoding='utf-8') as fh:
+        for item, seconds in costs.items():
+            fh.write("{}\t{:.4f}\n".format(item,seconds))
+
+def largest_first(items,costs=None,sizes=None):
+    """Orders items by expected cost, most expensive first. Items timed in a
+    previous run use their recorded cost; the rest are estimated from their
+    size, scaled by the median seconds per byte of the timed items"""
+    if sizes is None:
+        sizes = {item: item_size(item) for item in items}
+    rate = 1.0
+    if costs:
+        rates = sorted(costs[item]/sizes[item] for item in items if item in costs and sizes[item])
+        if rates:
+            rate = rates[len(rates)//2]
+    def estimate(item):
+        if costs and item in costs:
+            return costs[item]
+        return sizes[item]*rate
+    return sorted(items,key=estimate,reverse=True)
+
+def timed_batch(task):
+    """Runs func on each item of a batch.
+    Returns [(item, result, seconds)]"""
+    func, batch = task
+    results = []
+    for item in batch:
+        start = time.time()
+        result = func(item)
+        results.append((item,result,time.time()-start))
+    return results
+
+def scheduled_tasks(func,items,costs,sizes,tiny=64*1024,batch_size=32):
+    """Tasks of timed_batch for items, largest first, items under tiny
+    bytes in batches of batch_size"""
+    ordered = largest_first(items,costs,sizes)
+    tasks = [(func,[item]) for item in ordered if sizes[item]>=tiny]
+    small = [item for item in ordered if sizes[item]<tiny]
+    for i in range(0,len(small),batch_size):
+        tasks.append((func,small[i:i+batch_size]))
+    return tasks
+
+def imap_scheduled(pool,func,items,cost_file=None,tiny=64*1024,batch_size=32):
+    """Like pool.imap_unordered(func, items), but largest items first.
+    Items under tiny bytes are sent in batches of batch_size. Yields
+    (item, result) as they finish. If cost_file is given, costs recorded
+    there are used for the ordering and updated with this run's timings"""
+    items = list(items)
+    sizes = {item: item_size(item) for item in items}
+    costs = load_costs(cost_file)
+    tasks = scheduled_tasks(func,items,costs,sizes,tiny,batch_size)
+    for results in pool.imap_unordered(timed_batch,tasks,chunksize=1):
+        for item, result, seconds in results:
+            costs[item] = seconds
+            yield(item,result)
+    if cost_file:
+        save_costs(cost_file,costs)
+
+def tagged_batch(task):
+    """timed_batch of a task from imap_tagged. Returns (tag, its results)"""
+    tag, func, batch = task
+    return tag, timed_batch((func,batch))
+
+def imap_tagged(pool,groups,cost_file=None):
+    """Runs several kinds of task over one pool. All of them are submitted
+    up front, in the order of groups, so no worker waits for the last tasks
+    of one kind before starting on the next. groups holds (tag, func,
+    items, scheduled): the items of a scheduled group are files, ordered
+    and batched as imap_scheduled does (and timed in cost_file), the others
+    are sent one per task in the order given. Yields (tag, item, result)
+    as they finish"""
+    costs = load_costs(cost_file)
+    timed = set()
+    tasks = []
+    for tag, func, items, scheduled in groups:
+        if scheduled:
+            items = list(items)
+            sizes = {item: item_size(item) for item in items}
+            tasks.extend((tag,func,batch) for func, batch in scheduled_tasks(func,items,costs,sizes))
+            timed.add(tag)
+        else:
+            tasks.extend((tag,func,[item]) for item in items)
+    for tag, results in pool.imap_unordered(tagged_batch,tasks,chunksize=1):
+        for item, result, seconds in results:
+            if tag in timed:
+                costs[item] = seconds
+            yield(tag,item,result)
+    if cost_file:
+        save_costs(cost_file,costs)
@@ -0,0 +1,121 @@
+"""Worker supervisor for long multiprocessing runs
+
+A task stuck inside mp.Pool cannot be stopped, and holds up the end of the
+whole run. supervisor hands each task to a worker process over a pipe and
+keeps the deadline of every task in the parent: a worker that overruns its
+deadline is killed and replaced, and its task is reported as timed out.
+Workers are also replaced after a fixed number of tasks, so memory leaked
+on giant documents is returned to the system.
+"""
+import time
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+def supervised_worker(func,conn):
+    """Worker loop: runs func on each task received until told to stop"""
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        try:
+            conn.send((True,func(task)))
+        except Exception as inst:
+            conn.send((False,repr(inst)))
+
+class supervisor:
+    """Pool replacement with hard per-task deadlines.
+    func must be importable by the workers, as with mp.Pool"""
+    def __init__(self,func,processes=None,deadline=None,maxtasks=None):
+        self.func = func
+        self.processes = processes or mp.cpu_count()
+        self.deadline = deadline
+        self.maxtasks = maxtasks
+
+    def start_worker(self):
+        parent, child = mp.Pipe()
+        process = mp.Process(target=supervised_worker,args=(self.func,child),daemon=True)
+        process.start()
+        child.close()
+        return [process,parent,0]
+
+    def stop_worker(self,worker,kill=False):
+        process, conn = worker[0], worker[1]
+        if not kill:
+            try:
+                conn.send(None)
+                process.join(5)
+            except (OSError, ValueError):
+                pass
+        if process.is_alive():
+            process.terminate()
+            process.join(1)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        conn.close()
+
+    def send(self,worker,item):
+        """Sends item to worker, replacing the worker if it has died.
+        Returns the worker that received the item"""
+        try:
+            worker[1].send(item)
+        except (OSError, ValueError):
+            self.stop_worker(worker,kill=True)
+            worker = self.start_worker()
+            worker[1].send(item)
+        return worker
+
+    def imap_unordered(self,iterable):
+        """Yields (item, status, result) as tasks finish. status is 'done',
+        'error' (result holds the exception) or 'timeout'. Items are only
+        drawn from iterable when a worker is free"""
+        items = iter(iterable)
+        idle = [self.start_worker() for _ in range(self.processes)]
+        busy = {}
+        exhausted = False
+        try:
+            while True:
+                while idle and not exhausted:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    worker = self.send(idle.pop(),item)
+                    deadline = time.time()+self.deadline if self.deadline else None
+                    busy[worker[1]] = (worker,item,deadline)
+                if not busy:
+                    break
+                timeout = None
+                if self.deadline:
+                    timeout = max(0,min(entry[2] for entry in busy.values())-time.time())
+                for conn in wait(list(busy),timeout):
+                    worker, item, _ = busy.pop(conn)
+                    try:
+                        success, result = conn.recv()
+                    except (EOFError, OSError):
+                        self.stop_worker(worker,kill=True)
+                        idle.append(self.start_worker())
+                        yield(item,'error','worker exited')
+                        continue
+                    worker[2] += 1
+                    if self.maxtasks and worker[2]>=self.maxtasks:
+                        self.stop_worker(worker)
+                        worker = self.start_worker()
+                    idle.append(worker)
+                    yield(item,'done' if success else 'error',result)
+                now = time.time()
+                for conn, (worker, item, deadline) in list(busy.items()):
+                    if deadline is not None and deadline<=now:
+                        del busy[conn]
+                        self.stop_worker(worker,kill=True)
+                        idle.append(self.start_worker())
+                        yield(item,'timeout',None)
+        finally:
+            for worker in idle:
+                self.stop_worker(worker)
+            for worker, _, _ in busy.values():
+                self.stop_worker(worker,kill=True)
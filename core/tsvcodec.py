@@ -0,0 +1,116 @@
+"""TSV escaping for equation files
+
+Fields are escaped with four sequences only: \\t, \\n, \\r and \\\\. Every other
+character, ASCII or not, is written as is (files are UTF-8), so escaping is a
+few str.replace calls and most fields need no unescaping at all. Files
+written this way start with tsv_header. Files without it were written with
+the old repr() based mask and are read with legacy_unescape, which (unlike
+the old unmask) keeps non-ASCII characters intact.
+"""
+import re
+import codecs
+
+tsv_header = '#hoptex-tsv\t1'
+# a backslash that does not start \t, \n or \r once the \\ are removed
+other_escape = re.compile(rb'\\(?![tnr])')
+
+def tsv_escape(text):
+    """Escapes a field for a TSV file"""
+    if '\\' in text:
+        text = text.replace('\\','\\\\')
+    if '\t' in text:
+        text = text.replace('\t','\\t')
+    if '\n' in text:
+        text = text.replace('\n','\\n')
+    if '\r' in text:
+        text = text.replace('\r','\\r')
+    return text
+
+def tsv_unescape(text):
+    """Inverse of tsv_escape. Unknown escapes are left as they are"""
+    if '\\' not in text:
+        return text
+    if '\x00' in text:
+        # every escape is two characters, so splitting on the escaped
+        # backslashes leaves \\t, \\n and \\r whole in the pieces
+        pieces = text.split('\\\\')
+        for i, piece in enumerate(pieces):
+            if '\\' in piece:
+                pieces[i] = piece.replace('\\t','\t').replace('\\n','\n').replace('\\r','\r')
+        return '\\'.join(pieces)
+    # the same, with NUL standing in for the escaped backslashes
+    text = text.replace('\\\\','\x00')
+    if '\\' in text:
+        text = text.replace('\\t','\t').replace('\\n','\n').replace('\\r','\r')
+    return text.replace('\x00','\\')
+
+def legacy_unescape(text):
+    """Decodes a field written as repr(text)[1:-1]. Characters above latin-1
+    are turned into \\u escapes first, so unicode_escape reads them back"""
+    if '\\' not in text:
+        return text
+    return codecs.decode(text.encode('latin-1','backslashreplace'),'unicode_escape')
+
+def format_row(fields):
+    """One TSV line of escaped fields"""
+    return '\t'.join(map(tsv_escape,fields))+'\n'
+
+def open_tsv(filename):
+    """Opens a TSV file for writing and writes the header"""
+    fh = open(filename,mode='w',encoding='utf-8',errors='surrogateescape',newline='\n')
+    fh.write(tsv_header+'\n')
+    return fh
+
+def read_chunks(fh,chunk_size):
+    """Yields blocks of whole lines of the binary file fh (without the last
+    newline), reading chunk_size bytes at a time"""
+    rest = b''
+    while True:
+        chunk = fh.read(chunk_size)
+        if not chunk:
+            break
+        chunk = rest+chunk
+        end = chunk.rfind(b'\n')
+        if end==-1:
+            rest = chunk
+            continue
+        rest = chunk[end+1:]
+        yield chunk[:end]
+    if rest:
+        yield rest
+
+def split_rows(chunk):
+    """Splits a block of escaped lines into rows of unescaped fields. The
+    separators are swapped for control characters first, so that the whole
+    block is unescaped by one escape_decode call instead of field by field.
+    escape_decode reads every Python escape, so blocks with any escape
+    tsv_escape does not write are unescaped field by field, as
+    tsv_unescape leaves such escapes alone"""
+    if b'\r' in chunk:
+        chunk = chunk.replace(b'\r\n',b'\n')
+    if (b'\x1e' in chunk or b'\x1f' in chunk or
+        (b'\\' in chunk and other_escape.search(chunk.replace(b'\\\\',b'')))):
+        chunk = chunk.decode('utf-8','surrogateescape')
+        return [[tsv_unescape(field) for field in line.split('\t')] for line in chunk.split('\n') if line]
+    if b'\\' in chunk:
+        chunk = chunk.replace(b'\t',b'\x1f').replace(b'\n',b'\x1e')
+        chunk = codecs.escape_decode(chunk)[0]
+    else:
+        chunk = chunk.replace(b'\t',b'\x1f').replace(b'\n',b'\x1e')
+    chunk = chunk.decode('utf-8','surrogateescape')
+    return [line.split('\x1f') for line in chunk.split('\x1e') if line]
+
+def read_tsv_rows(filename,chunk_size=1<<22):
+    """Yields the unescaped fields of each line of a TSV file written with
+    format_row. Files without tsv_header are read as old repr-style files"""
+    with open(filename,mode='rb') as fh:
+        first = fh.readline()
+        if first.rstrip(b'\r\n')==tsv_header.encode():
+            for chunk in read_chunks(fh,chunk_size):
+                yield from split_rows(chunk)
+            return
+    with open(filename,mode='r',encoding='utf-8',errors='surrogateescape',newline='\n') as fh:
+        for line in fh:
+            line = line.rstrip('\r\n')
+            if line:
+                yield [legacy_unescape(field) for field in line.split('\t')]
@@ -4,6 +4,8 @@ import sys
 import multiprocessing as mp
 import re
 from core.funcs import *
+from core.schedule import *
+from core.manifest import *
 def eqerrors(filename):
     with open(filename) as fh:
         text = fh.read()
@@ -43,7 +45,7 @@ def main():
     xhtmlfilelist = glob.glob(os.path.join(outputdir,'*.xhtml'))
     mathfilelist = getmathfiles(path)
     pool = mp.Pool(processes=mp.cpu_count())
-    coverage = pool.map(eqerrors,xhtmlfilelist)
+    coverage = [result for filename, result in imap_scheduled(pool,eqerrors,xhtmlfilelist)]
     errors, total = zip(*coverage)
     erroreqs = sum(errors)
     totaleqs = sum(total)
@@ -12,27 +12,45 @@ import os
 import time
 import sys
 import tarfile
+import gzip
+import io
+import hashlib
+import contextlib
 import multiprocessing as mp
 import shutil
 import argparse
 import datetime
 
 from core.funcs import *
+from core.supervisor import *
+from core.schedule import *
+from core.lru import *
 global diag_message
 global rcp
 global output_path
 global debug
 global debug_path
 global timeout
+global engine
+global expansion_memo
+global closure
+global deadline
+global maxtasks
+global cache_dir
+global cache_size
 
 diag_message = False
 debug = False
 debug_path = './debug/'
 timeout = 240
-
-# A truly monstrous regular expression, from a less civilized age
-
-def_pattern = r'(?s)\\(?:e|g)?def\s*(?P<name>\\[A-Za-z@\*]+|\\.)\s*(?:(?P<sep1>[^\{#]*)(?P<arg1>#1)(?P<sep2>[^\{#]*)(?:(?P<arg2>#2)(?P<sep3>[^\{#]*)(?:(?P<arg3>#3)(?P<sep4>[^\{#]*)(?:(?P<arg4>#4)(?P<sep5>[^\{#]*)(?:(?P<arg5>#5)(?P<sep6>[^\{#]*)(?:(?P<arg6>#6)(?P<sep7>[^\{#]*)(?:(?P<arg7>#7)(?P<sep8>[^\{#]*)(?:(?P<arg8>#8)(?P<sep9>[^\{#]*)(?:(?P<arg9>#9)(?P<sep10>[^\{#]*))?)?)?)?)?)?)?)?)?(?=\{)'
+engine = 'iterative'
+closure = False
+expansion_memo = None
+deadline = None
+maxtasks = 50
+cache_dir = None
+cache_size = 10*1024**3
+source_version = None
 
 math_pattern = r"\\DeclareMathOperator\*?"
 
@@ -44,8 +62,13 @@ newcommand_pattern = r'\\newcommand\*?'
 
 renewcommand_pattern = r'\\renewcommand\*?'
 
-search_pattern = r'(?P<def>'+def_pattern+')'+r'|(?P<newcommand>'+newcommand_pattern+r')'+\
-    r'|(?P<renewcommand>'+renewcommand_pattern+r')'+r'|(?P<mathoperator>'+math_pattern+r')'
+# Definition keywords recognised by scan_macro_definitions, keyed on the
+# text following the backslash
+definition_keywords = [('def','def'),('edef','def'),('gdef','def'),
+    ('newcommand','newcommand'),('renewcommand','renewcommand'),
+    ('DeclareMathOperator','mathoperator')]
+
+def_delims = re.compile(r'[{#]')
 
 macro_pattern= '|'.join([def_token,newcommand_pattern,renewcommand_pattern,math_pattern])
 
@@ -63,6 +86,14 @@ macro_token_group = r'(?<!\\)\{\s*(\\((?:re)?newcommand\*?)|\\g?def|\\DeclareMat
 
 isundefined_pattern = r'\\isundefined\s*\{\s*(\\[A-Za-z\@\*]*)\s*\}'
 
+# Stand-ins for #1-#9 when compiling substitution templates. Input is read as
+# latin-1, so these code points never occur in a document
+argument_placeholders = [chr(0xE000+i) for i in range(9)]
+
+placeholder_pattern = '[\ue000-\ue008]'
+
+unsafe_argument = re.compile(r'[#\ue000-\ue008]|\\\Z')
+
 """
 A lot of the code below is necessary because Python has been taking 5 years and counting
 to put the superior 'regex' module from PyPI into stdlib
@@ -96,6 +127,136 @@ def balanced_brackets(text):
 def balanced_braces(text):
     return balanced_delim_checker(text,"{}")
 
+class text_cursor:
+    """A text buffer and an offset into it. The take_* methods consume from the
+    offset and return what they consumed, so parsing never copies the rest of
+    the document"""
+    def __init__(self, text, pos=0):
+        self.text = text
+        self.pos = pos
+
+    def rest(self):
+        return self.text[self.pos:]
+
+    def peek(self):
+        """Returns the current character, raising IndexError at the end of
+        the buffer like text[0] would"""
+        if self.pos>=len(self.text):
+            raise IndexError('End of text')
+        return self.text[self.pos]
+
+    def take_length(self, length):
+        start = self.pos
+        self.pos = min(start+length,len(self.text))
+        return self.text[start:self.pos]
+
+    def take_balanced(self, opening, closing, pattern):
+        """Consumes a balanced opening/closing pair, ignoring escaped
+        delimiters. Unbalanced text is consumed to the end of the buffer"""
+        start = self.pos
+        if self.peek()!=opening:
+            return ''
+        depth = 0
+        escaped_end = -1
+        for match in pattern.finditer(self.text,start):
+            delim = match.group(0)
+            if delim[0]=='\\':
+                if len(delim)%2==1:
+                    escaped_end = match.end()
+                continue
+            if match.start()==escaped_end:
+                continue
+            if delim==opening:
+                depth += 1
+            else:
+                depth -= 1
+                if depth==0:
+                    self.pos = match.end()
+                    return self.text[start:self.pos]
+        self.pos = len(self.text)
+        return self.text[start:]
+
+    def take_group(self):
+        return self.take_balanced('{','}',group_delims)
+
+    def take_param(self):
+        return self.take_balanced('[',']',param_delims)
+
+    def take_whitespace(self):
+        return self.take_pattern(whitespace_run)
+
+    def take_pattern(self, pattern):
+        match = pattern.match(self.text,self.pos)
+        self.pos = match.end()
+        return match.group(0)
+
+    def take_token(self):
+        if self.peek()!='\\':
+            return ''
+        start = self.pos
+        self.pos += 1
+        if self.peek() not in control_letters:
+            self.pos += 1
+            return self.text[start:self.pos]
+        self.take_pattern(control_word)
+        return self.text[start:self.pos]
+
+    def take_match(self, match_text):
+        if self.text.startswith(match_text,self.pos):
+            self.pos += len(match_text)
+            return match_text
+        for i, character in enumerate(match_text):
+            if self.pos+i>=len(self.text):
+                raise IndexError('End of text')
+            if character!=self.text[self.pos+i]:
+                print("Matching failed:")
+                print(match_text)
+                raise ValueError('Match not found')
+
+    def take_until(self, separator):
+        """Consumes up to (not including) the next occurrence of separator,
+        raising ValueError if there is none"""
+        index = self.text.index(separator,self.pos)
+        return self.take_length(index-self.pos)
+
+    def take_word(self):
+        return self.take_pattern(word_run)
+
+    def take_general(self):
+        character = self.peek()
+        if character=="{":
+            return self.take_group()
+        elif character=="\\":
+            return self.take_token()
+        else:
+            self.pos += 1
+            return character
+
+    def take_general_alt(self):
+        if self.peek()=="{":
+            return self.take_group()
+        else:
+            return self.take_word()
+
+    def parse(self, sequence):
+        """Applies each text_cursor method in sequence, returning the list of
+        consumed strings"""
+        return [operation(self) for operation in sequence]
+
+control_letters = set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz@*')
+
+group_delims = re.compile(r'\\+|[{}]')
+
+param_delims = re.compile(r'\\+|[\[\]]')
+
+whitespace_run = re.compile(r'[\t\n %]*')
+
+control_word = re.compile(r'[A-Za-z@\*]*')
+
+word_run = re.compile(r'[^ \t\n\\]*')
+
+"""String versions of the text_cursor methods: each returns (consumed, rest)"""
+
 def take_while(text_evaluator, text):
     out = []
     for i, character in enumerate(text):
@@ -105,75 +266,20 @@ def take_while(text_evaluator, text):
             return (''.join(out),text[i:])
 
 def take_group(text):
-    group = []
-    backslash_count = 0
-    if text[0]=='{':
-        stack = []
-        for i, character in enumerate(text):
-            group.append(character)
-            if character=='\\':
-                backslash_count+=1
-                continue
-            elif character=='{':
-                if backslash_count%2==0:
-                    stack.append(character)
-            elif character=='}':
-                if backslash_count%2==0:
-                    stack.pop()
-                if len(stack)==0:
-                    break
-            backslash_count=0
-        return(''.join(group),text[i+1:])
-    else:
-        return('',text)
+    cursor = text_cursor(text)
+    return (cursor.take_group(),cursor.rest())
 
 def take_param(text):
-    group = []
-    backslash_count = 0
-    if text[0]=='[':
-        stack = []
-        for i, character in enumerate(text):
-            group.append(character)
-            if character=='\\':
-                backslash_count+=1
-                continue
-            elif character=='[':
-                if backslash_count%2==0:
-                    stack.append(character)
-            elif character==']':
-                if backslash_count%2==0:
-                    stack.pop()
-                if len(stack)==0:
-                    break
-            backslash_count=0
-        return(''.join(group),text[i+1:])
-    else:
-        return('',text)
+    cursor = text_cursor(text)
+    return (cursor.take_param(),cursor.rest())
 
 def take_whitespace(text):
-    spaces = []
-    for character in text:
-        if character in "\t\n %":
-            spaces.append(character)
-        else:
-            break
-    return (''.join(spaces), text[len(spaces):])
+    cursor = text_cursor(text)
+    return (cursor.take_whitespace(),cursor.rest())
 
 def take_token(text):
-    token = []
-    if text[0]=='\\':
-        token.append('\\')
-        if not re.match(r'[A-Za-z@\*]',text[1]):
-            token.append(text[1])
-            return (''.join(token),text[2:])
-        for i, character in enumerate(text[1:]):
-            if re.match(r'[A-Za-z@\*]',character):
-                token.append(character)
-            else:
-                break
-        return(''.join(token),text[len(token):])
-    else:
-        return('',text)
+    cursor = text_cursor(text)
+    return (cursor.take_token(),cursor.rest())
 
 def take_argument(text):
     if re.match(r'#[1-9]',text):
@@ -182,50 +288,28 @@ def take_argument(text):
         return('',text)
 
 def take_match(text,match_text):
-    match = []
-    for i, character in enumerate(match_text):
-        if character==text[i]:
-            match.append(character)
-        else:
-            print("Matching failed:")
-            print(match_text)
-            raise ValueError('Match not found')
-    return (''.join(match),text[len(match):])
-
+    cursor = text_cursor(text)
+    return (cursor.take_match(match_text),cursor.rest())
 
 def take_word(text):
-    word = []
-    for character in text:
-        if character in ' \t\n\\':
-            break
-        else:
-            word.append(character)
-    return(''.join(word),text[len(word):])
+    cursor = text_cursor(text)
+    return (cursor.take_word(),cursor.rest())
 
 def take_general(text):
-    if text[0]=="{":
-        return take_group(text)
-    elif text[0]=="\\":
-        return take_token(text)
-    else:
-        return(text[0],text[1:])
+    cursor = text_cursor(text)
+    return (cursor.take_general(),cursor.rest())
 
 def take_general_alt(text):
-    if text[0]=="{":
-        return take_group(text)
-    else:
-        return take_word(text)
+    cursor = text_cursor(text)
+    return (cursor.take_general_alt(),cursor.rest())
 
 def take_length(text,length):
     return (text[0:length],text[length:])
 
 def parse(text,sequence):
-    output = []
-    a, b = None, text
-    for operation in sequence:
-        a, b = operation(b)
-        output.append(a)
-    return (output,b)
+    cursor = text_cursor(text)
+    output = cursor.parse(sequence)
+    return (output,cursor.rest())
 
 def escape(text):
     return text.replace("\\","\\\\")
@@ -296,16 +380,22 @@ def reduce_arguments(text):
     new.append(text)
     return(''.join(new))
 
+def fill_template(template, values):
+    return ''.join([values[segment] if isinstance(segment,int) else segment
+        for segment in template])
+
 #Parsing sequences
-newcommand_sequence = [take_token, take_whitespace, take_general,
-                        take_whitespace, take_param, take_whitespace,
-                        take_param, take_whitespace, take_general]
+newcommand_sequence = [text_cursor.take_token, text_cursor.take_whitespace,
+                        text_cursor.take_general, text_cursor.take_whitespace,
+                        text_cursor.take_param, text_cursor.take_whitespace,
+                        text_cursor.take_param, text_cursor.take_whitespace,
+                        text_cursor.take_general]
 
-math_operator_sequence = [take_whitespace,take_general,
-                            take_whitespace,take_general]
+math_operator_sequence = [text_cursor.take_whitespace,text_cursor.take_general,
+                            text_cursor.take_whitespace,text_cursor.take_general]
 
 
-def_input_sequence = [take_token,take_whitespace]
+def_input_sequence = [text_cursor.take_token,text_cursor.take_whitespace]
 
 renewcommand_sequence = newcommand_sequence
 
@@ -324,17 +414,18 @@ class macro:
         self.arg_count = 0
         self.valid = True
         self.contains_macro_defs = False
+        self.templates = {}
 
     def macro_text(self):
         global verbose
         verbose("Replace: {}".format(self.text))
         return self.text
 
-    def load_def(self, match_obj,text):
-        #copies over to avoid mutating the original def list
+    def load_def(self, dictionary,text,start,pos):
+        """Loads a def whose parameter text text[start:pos] was read by
+        scan_def_header into dictionary. The definition is read from text at pos"""
         global verbose
-        dictionary = match_obj.groupdict()
-        self.parameter_text = match_obj.group(0)
+        self.parameter_text = text[start:pos]
         self.sep1 = dictionary['sep1']
         self.sep2 = dictionary['sep2']
         self.sep3 = dictionary['sep3']
@@ -356,7 +447,7 @@ class macro:
         self.name = dictionary['name']
         self.arg_count = num_valid([self.arg1,self.arg2,self.arg3,
         self.arg4,self.arg5,self.arg6,self.arg7,self.arg8,self.arg9])
-        self.definition = take_group(text)[0]
+        self.definition = text_cursor(text,pos).take_group()
         self.type = "\\def"
         self.text = self.parameter_text + self.definition
         match_pattern = re.escape(self.name)
@@ -380,8 +471,8 @@ class macro:
         verbose(self.definition)
         verbose("end def")
 
-    def load_mathoperator(self,text, starting):
-        results = parse(text,math_operator_sequence)[0]
+    def load_mathoperator(self,text, starting,pos=0):
+        results = text_cursor(text,pos).parse(math_operator_sequence)
         self.text = starting + ''.join(results)
         if starting[-1]=='*':
             self.asterisk = '*'
@@ -395,9 +486,9 @@ class macro:
         verbose(self.arg2)
         verbose("End mathoperator")
 
-    def load_newcommand(self,text):
+    def load_newcommand(self,text,pos=0):
         try:
-            results = parse(text,newcommand_sequence)[0]
+            results = text_cursor(text,pos).parse(newcommand_sequence)
         except:
             self.valid = False
             return
@@ -434,9 +525,9 @@ class macro:
         verbose(self.definition)
         verbose("End newcommand")
 
-    def load_renewcommand(self,text):
+    def load_renewcommand(self,text,pos=0):
         try:
-            results = parse(text,newcommand_sequence)[0]
+            results = text_cursor(text,pos).parse(newcommand_sequence)
         except:
             self.valid = False
             return
@@ -473,84 +564,93 @@ class macro:
         verbose("End renewcommand")
         self.definition = re.sub(re.escape(self.name)+r'(?![A-Za-z\@\*])','',self.definition)
 
+    def argument_values(self, arglist, default_arg=''):
+        """Returns the values of #1, #2, ... for a use of the macro"""
+        if self.type=='\\def':
+            return list(arglist)
+        verbose("{} arglist: {}".format(self.type[1:].capitalize(),arglist))
+        if self.default:
+            if default_arg:
+                verbose("Replacing with new default: {}".format(default_arg))
+                return [default_arg[1:-1]] + list(arglist)
+            verbose("Replacing with original default")
+            return [self.default[1:-1]] + list(arglist)
+        return list(arglist)
+
+    def substitute_values(self, values):
+        """Substitutes values into the definition one argument at a time"""
+        text = re.sub(r'(\\#)#','\1 #',self.definition)
+        for i, value in enumerate(values):
+            verbose("Passed argument:")
+            verbose(value)
+            verbose("Argument index: {}".format(i))
+            text = re.sub(arg_pattern+str(i+1),escape(value),text)
+        return reduce_arguments(text)
+
+    def compile_template(self, count):
+        """Runs substitute_values once with placeholder arguments, and splits
+        the result into literal segments and argument slots, so that later
+        uses only need a join. Returns None if the placeholders do not come
+        through the ## reduction intact"""
+        text = re.sub(r'(\\#)#','\1 #',self.definition)
+        if count>len(argument_placeholders) or re.search(placeholder_pattern,text):
+            return None
+        placeholders = argument_placeholders[:count]
+        for i, placeholder in enumerate(placeholders):
+            text = re.sub(arg_pattern+str(i+1),placeholder,text)
+        reduced = reduce_arguments(text)
+        for placeholder in placeholders:
+            if text.count(placeholder)!=reduced.count(placeholder):
+                return None
+        segments = []
+        for piece in re.split('('+placeholder_pattern+')',reduced):
+            if piece and piece in placeholders:
+                segments.append(placeholders.index(piece))
+            elif piece:
+                segments.append(piece)
+        return segments
+
+    def template(self, count):
+        """Returns the compiled template for count argument values"""
+        if count not in self.templates:
+            self.templates[count] = self.compile_template(count)
+        return self.templates[count]
+
     def substitute_arguments(self, arglist, default_arg=''):
         """Accepts a list of the values of args, returns definition with args"""
-        text = self.definition
-        text = re.sub(r'(\\#)#','\1 #',text)
-        if self.type=='\\def':
-            for i, arg in enumerate(arglist):
-                verbose("definition")
-                verbose(text)
-                verbose("Passed argument:")
-                verbose(arg)
-                verbose("Argument index: {}".format(i))
-                new_pattern = arg_pattern+str(i+1)
-                text = re.sub(new_pattern,escape(arg),text)
-                # text = text.replace('#'+str(i+1),arg)
-            text = reduce_arguments(text)
-            return(text)
-        elif self.type=='\\newcommand' or self.type=='\\newcommand*':
-            verbose("Newcommand arglist: {}".format(arglist))
-            if self.default:
-                if default_arg:
-                    verbose("Replacing with new default: {}".format(default_arg))
-                    text = re.sub(arg_pattern+'1',escape(default_arg[1:-1]),
-                    text)
-                else:
-                    verbose("Replacing with original default")
-                    text = re.sub(arg_pattern+'1',escape(self.default[1:-1]),
-                    text)
-                for i, arg in enumerate(arglist):
-                    text = re.sub(arg_pattern+str(i+2),escape(arg),text)
-                text = reduce_arguments(text)
-                return text
-            else:
-                for i, arg in enumerate(arglist):
-                    text = re.sub(arg_pattern+str(i+1),escape(arg),text)
-                    # text = text.replace('#'+str(i+1),arg)
-                text = reduce_arguments(text)
-                return text
-        elif self.type=='\\renewcommand' or self.type=='\\renewcommand*':
-            verbose("Renewcommand arglist: {}".format(arglist))
-            if self.default:
-                if default_arg:
-                    verbose("Replacing with new default")
-                    text = re.sub(arg_pattern+'1',escape(default_arg[1:-1]),
-                    text)
-                    # text = text.replace('#1',default_arg[1:-1])
-                else:
-                    verbose("Replacing with original default")
-                    text = re.sub(arg_pattern+'1',escape(self.default[1:-1]),text)
-                    # text = text.replace('#1',self.default[1:-1])
-                for i, arg in enumerate(arglist):
-                    text = re.sub(arg_pattern+str(i+2),escape(arg),text)
-                    # text = text.replace('#'+str(i+2),arg)
-                text = reduce_arguments(text)
-                return text
-            else:
-                for i, arg in enumerate(arglist):
-                    text = re.sub(arg_pattern+str(i+1),escape(arg),text)
-                    # text = text.replace('#'+str(i+1),arg)
-                text = reduce_arguments(text)
+        global expansion_memo
+        if self.type not in ('\\def','\\newcommand','\\renewcommand'):
+            return None
+        values = self.argument_values(arglist, default_arg)
+        if expansion_memo is not None:
+            key = (self.name, self.definition, tuple(values))
+            text = expansion_memo.get(key)
+            if text is not None:
                 return text
+        template = self.template(len(values))
+        if template is None or any(unsafe_argument.search(value) for value in values):
+            text = self.substitute_values(values)
         else:
-            pass
+            text = fill_template(template,values)
+        if expansion_memo is not None:
+            expansion_memo.put(key,text)
+        return text
 
-    def parse_expression(self,text):
+    def parse_arguments(self,cursor):
+        """Parses one use of the macro at the position of cursor, advancing
+        the cursor past its arguments. Returns (arglist, default_arg)"""
         parsed = []
-        verbose(self.type)
-        verbose(self.name)
         if self.type=='\\def':
-            a, b = parse(text,def_input_sequence)
+            a = cursor.parse(def_input_sequence)
             if a[0]!=self.name:
                 verbose("ERROR: MISMATCHED TOKEN")
                 verbose("EXPECTED: {}, MATCHED: {}DELIM".format(self.name,a[0]))
                 Exception("Parsing failed")
             if self.arg_count==0:
-                return (self.definition, b)
+                return (parsed,'')
             else:
                 if self.sep1:
-                    a, b = take_match(b, self.sep1)
+                    cursor.take_match(self.sep1)
                 arglist = [self.arg1,self.arg2,self.arg3,self.arg4,
                 self.arg5,self.arg6,self.arg7,self.arg8,self.arg9]
                 seplist = [self.sep2,self.sep3,self.sep4,
@@ -558,65 +658,70 @@ class macro:
                 for i, argument in enumerate(arglist):
                     if argument:
                         if seplist[i]:
-                            match_index = b.index(seplist[i])
-                            # match_index now contains the index of the separator
-                            a, b = take_length(b, match_index)
-                            parsed.append(a)
-                            a, b = take_match(b,seplist[i])
+                            parsed.append(cursor.take_until(seplist[i]))
+                            cursor.take_match(seplist[i])
                         else:
-                            a,b = take_general(b)
-                            parsed.append(a)
+                            parsed.append(cursor.take_general())
                     else:
                         break
                 verbose("PARSED: {}".format(parsed))
-            return(self.substitute_arguments(parsed),b)
+            return (parsed,'')
         elif self.type == '\\renewcommand':
             verbose("Returning renewcommand")
             verbose(self.name)
-            a, b = take_token(text)
+            cursor.take_token()
             if self.arg_count == 0:
-                return(self.definition,b)
-            a, b = take_whitespace(b)
-            default, b = take_param(b)
-            a, b = take_whitespace(b)
+                return (parsed,'')
+            cursor.take_whitespace()
+            default = cursor.take_param()
+            cursor.take_whitespace()
             num_args = self.arg_count
             if default:
                 verbose("NEW DEFAULT: {}".format(default))
                 num_args -= 1
-            parsing = [take_general, take_whitespace] * (num_args-1)
-            parsing.append(take_general)
-            results, b = parse(b,parsing)
+            parsing = [text_cursor.take_general, text_cursor.take_whitespace] * (num_args-1)
+            parsing.append(text_cursor.take_general)
+            results = cursor.parse(parsing)
             results = [results[x] for x in range(0,len(results)+1,2)]
-            return (self.substitute_arguments(results,default),b)
-        elif self.type == "\\newcommand":
+            return (results,default)
+        else:
             verbose("Returning newcommand")
             verbose(self.name)
-            a, b = take_token(text)
+            a = cursor.take_token()
             verbose(a)
             if self.arg_count == 0:
-                return(self.definition,b)
-            a, b = take_whitespace(b)
-            default, b = take_param(b)
+                return (parsed,'')
+            cursor.take_whitespace()
+            default = cursor.take_param()
             if(default):
                 verbose("NEW DEFAULT: {}".format(default))
-            a, b = take_whitespace(b)
+            cursor.take_whitespace()
             num_args = self.arg_count
             if self.default:
                 num_args -= 1
             verbose("argument count: {}".format(self.arg_count))
-            parsing = [take_general,take_whitespace]*(num_args-1)
-            parsing.append(take_general)
-            results, b = parse(b,parsing)
+            parsing = [text_cursor.take_general,text_cursor.take_whitespace]*(num_args-1)
+            parsing.append(text_cursor.take_general)
+            results = cursor.parse(parsing)
             results = [results[x] for x in range(0,len(results)+1,2)]
             verbose("results: {}".format(results))
-            # verbose("Substituted",self.substitute_arguments(results,default))
-            return(self.substitute_arguments(results,default),b)
-        elif self.type == "\\DeclareMathOperator":
-            a, b = take_token(text)
-            return("\\operatorname"+self.asterisk+self.arg2,b)
-        else:
-            a, b = take_general(text)
-            return("",b)
+            return (results,default)
+
+    def parse_expression(self,cursor):
+        """Parses one use of the macro at the position of cursor, advancing
+        the cursor past its arguments. Returns the substituted definition"""
+        verbose(self.type)
+        verbose(self.name)
+        if self.type == "\\DeclareMathOperator":
+            cursor.take_token()
+            return "\\operatorname"+self.asterisk+self.arg2
+        elif self.type not in ('\\def','\\renewcommand','\\newcommand'):
+            cursor.take_general()
+            return ""
+        arglist, default = self.parse_arguments(cursor)
+        if self.arg_count == 0:
+            return self.definition
+        return self.substitute_arguments(arglist,default)
 
 def find_main_file(folder):
     """Iterates over every document in the folder, and returns the path to the
@@ -633,6 +738,14 @@ def find_main_file(folder):
                 return os.path.join(root,filename)
     return ""
 
+def find_main_member(members):
+    """find_main_file for an in-memory member map: returns the name of the
+    member with begin/end document statements"""
+    for name, text in members.items():
+        if re.search(r'(?s)\\begin\{document\}.*?\\end\{document\}',text):
+            return name
+    return ""
+
 
 def isundefined_sub(isundefined_dict,text):
     match = re.search(isundefined_pattern,text)
@@ -648,9 +761,14 @@ def undo_isundefined_sub(isundefined_dict,text):
         text = text.replace(item,isundefined_dict[item])
     return text
 
-def load_inputs(path):
-    with open(path,mode='r',encoding='latin-1') as fh:
-        text = fh.read()+'\n'
+def load_inputs(path,members=None):
+    """Reads path and splices in its \\input files. If members is given, the
+    files are looked up in that in-memory member map instead of on disk"""
+    if members is None:
+        with open(path,mode='r',encoding='latin-1') as fh:
+            text = fh.read()+'\n'
+    else:
+        text = members[path]+'\n'
     folder = os.path.split(path)[0]
     text = remove_comments(text)
     for match in re.finditer(input_pattern,text):
@@ -662,7 +780,13 @@ def load_inputs(path):
         external = os.path.splitext(external)[0]+'.tex'
         external = os.path.join(folder,external)
         external_document = ""
-        if os.path.isfile(external):
+        if members is not None:
+            external = os.path.normpath(external)
+            if external in members:
+                external_document = members[external]
+            else:
+                print("{}: Missing input file {}".format(path,external))
+        elif os.path.isfile(external):
             with open(external,mode='r',encoding='latin-1') as fh:
                 external_document = fh.read()
         else:
@@ -702,98 +826,123 @@ def substitute_macro_groups(text):
             break
     return text
 
+def scan_def_header(text,pos):
+    """Reads the parameter text of a def whose keyword ends at pos, e.g.
+    \\foo#1.#2 up to the opening brace of the definition.
+    Returns (end, groups) with the same groups as the old def regex, or None"""
+    length = len(text)
+    groups = dict.fromkeys(['name']+['sep{}'.format(i) for i in range(1,11)]+
+        ['arg{}'.format(i) for i in range(1,10)])
+    while pos<length and text[pos].isspace():
+        pos += 1
+    if pos+1>=length or text[pos]!='\\':
+        return None
+    end = pos+1
+    while end<length and text[end] in control_letters:
+        end += 1
+    if end==pos+1:
+        end += 1
+    groups['name'] = text[pos:end]
+    pos = end
+    while pos<length and text[pos].isspace():
+        pos += 1
+    count = 0
+    while True:
+        delim = def_delims.search(text,pos)
+        if not delim:
+            return None
+        if count<9 and text.startswith('#'+str(count+1),delim.start()):
+            count += 1
+            groups['sep{}'.format(count)] = text[pos:delim.start()]
+            groups['arg{}'.format(count)] = '#'+str(count)
+            pos = delim.end()+1
+        elif delim.group(0)=='{' and (count or delim.start()==pos):
+            if count:
+                groups['sep{}'.format(count+1)] = text[pos:delim.start()]
+            return(delim.start(),groups)
+        else:
+            return None
+
+def definition_header(text,pos):
+    """Recognises a definition keyword at the backslash at pos.
+    Returns (kind, end of header, def groups) or None"""
+    for keyword, kind in definition_keywords:
+        if text.startswith(keyword,pos+1):
+            end = pos+1+len(keyword)
+            if kind=='def':
+                header = scan_def_header(text,end)
+                if header:
+                    return(kind,header[0],header[1])
+                return None
+            if text.startswith('*',end):
+                end += 1
+            return(kind,end,None)
+    return None
+
+def scan_macro_definitions(text):
+    """Walks text once, loading each macro definition in the order they
+    appear. Yields (kind, macro, start, end); scanning resumes after each definition"""
+    pos = text.find('\\')
+    while pos!=-1:
+        header = definition_header(text,pos)
+        if header is None:
+            pos = text.find('\\',pos+1)
+            continue
+        kind, end, groups = header
+        new_macro = macro()
+        if kind=='def':
+            new_macro.load_def(groups,text,pos,end)
+        elif kind=='newcommand':
+            new_macro.load_newcommand(text,pos)
+        elif kind=='renewcommand':
+            new_macro.load_renewcommand(text,pos)
+        else:
+            new_macro.load_mathoperator(text,text[pos:end],end)
+        end = pos+len(new_macro.text)
+        yield(kind,new_macro,pos,end)
+        pos = text.find('\\',max(end,pos+1))
+
 def load_and_remove_macros(macrodict,text):
     """Mutate macrodict to include new macros
     Return new_macros boolean & text"""
     new_macros = False
-    match = re.search(search_pattern,text)
     text = substitute_macro_groups(text)
-    while match:
-        if match.group('def'):
-            #def
-            # match = re.search(def_pattern,text)
-            if match==None:
-                print("DEF MATCH NOT FOUND")
-                print(text)
-                print("END DEF MATCH")
-                match = re.search(search_pattern,text)
-            new_macro = macro()
-            new_macro.load_def(match,text[match.end():])
-            macro_def = new_macro.definition
-            macro_name = re.escape(new_macro.name)
-            if re.search(macro_name+r'(?![A-Za-z\*@])',macro_def):
-                print("{}: Recursive macros detected: aborting2".format(macro_name))
-                return(new_macros,"")
-            if new_macro.valid:
-                macrodict[new_macro.name]=new_macro
-                new_macros = True
-                text = text.replace(new_macro.macro_text(),"")
-            else:
-                print("{}: Invalid def macro, aborting".format(new_macro.name))
-                return(new_macros,"")
-        elif match.group('newcommand'):
-            #newcommand(*)
-            # match = re.search(newcommand_pattern,text)
-            new_macro = macro()
-            new_macro.load_newcommand(text[match.start():])
-            # verbose("Loaded {}".format(new_macro.name))
-            macro_def = new_macro.definition
-            macro_name = re.escape(new_macro.name)
-            if re.search(macro_name+r'(?![A-Za-z\*@])',macro_def):
-                print("{}: Recursive macros detected: aborting6".format(new_macro.name))
-                print(macro_name)
-                return(new_macros,"")
-            if new_macro.valid:
-                macrodict[new_macro.name]=new_macro
-                new_macros = True
-                text = text.replace(new_macro.macro_text(),"")
-            else:
-                print("{}: Invalid newcommand macro, aborting".format(new_macro.name))
-                return(new_macros,"")
-        elif match.group('renewcommand'):
-            #renewcommand(*)
-            # match = re.search(renewcommand_pattern,text)
-            new_macro = macro()
-            new_macro.load_renewcommand(text[match.start():])
-            macro_def = new_macro.definition
-            macro_name = re.escape(new_macro.name)
-            if re.search(macro_name+r'(?![A-Za-z\*@])',macro_def):
-                print("{}: Recursive macros detected: aborting7".format(new_macro.name))
-                print(macro_name)
-                return(new_macros,"")
-            if new_macro.valid:
-                macrodict[new_macro.name]=new_macro
-                new_macros = True
-                text = text.replace(new_macro.macro_text(),"")
-            else:
-                print("{}: Invalid renewcommand macro".format(new_macro.name))
-                return(new_macros,"")
-        elif match.group('mathoperator'):
-            #DeclareMathOperator
-            # match = re.search(math_pattern,text)
-            new_macro = macro()
-            new_macro.load_mathoperator(text[match.end():],match.group(0))
-            macro_def = new_macro.definition
-            macro_name = re.escape(new_macro.name)
-            if re.search(macro_name+r'(?![A-Za-z\*@])',macro_def):
-                print("{}: Recursive macros detected: aborting4".format(new_macro.name))
-                return(new_macros,"")
-            if new_macro.valid:
-                macrodict[new_macro.name]=new_macro
-                text = text.replace(new_macro.macro_text(),"")
-                new_macros = True
-            else:
-                print("{}: Invalid math macro, aborting.".format(new_macro.name))
-                return(new_macros,"")
-        match = re.search(search_pattern,text)
+    spans = []
+    # recursive macros are found by close_macro_definitions
+    messages = {'def':"Invalid def macro, aborting",
+        'newcommand':"Invalid newcommand macro, aborting",
+        'renewcommand':"Invalid renewcommand macro",
+        'mathoperator':"Invalid math macro, aborting."}
+    for kind, new_macro, start, end in scan_macro_definitions(text):
+        invalid = messages[kind]
+        if not new_macro.valid:
+            print("{}: {}".format(new_macro.name,invalid))
+            return(new_macros,"")
+        verbose("Replace: {}".format(new_macro.text))
+        macrodict[new_macro.name]=new_macro
+        new_macros = True
+        spans.append((start,end))
+    if spans:
+        pieces = []
+        last = 0
+        for start, end in spans:
+            pieces.append(text[last:start])
+            last = end
+        pieces.append(text[last:])
+        text = ''.join(pieces)
     return(new_macros,text)
 
-def demacro_file(path):
+def demacro_file(path,members=None,text=None):
+    """Expands the macros of path (its text with \\input files spliced in, as
+    given by load_inputs if text is None)"""
     global diag_message
     global debug
     global timeout
+    global engine
+    global closure
     start_time = time.time()
-    text = load_inputs(path)
+    if text is None:
+        text = load_inputs(path,members)
     newlines  = len(re.findall(r'\n',text))
     if debug:
         timeout = 10000
@@ -810,6 +959,8 @@ def demacro_file(path):
         return text
     isundefined_dict = {}
     text = isundefined_sub(isundefined_dict,text)
+    if not close_macro_definitions(path,macrodict,text,closure):
+        return("")
     while (new_macros or changed):
         new_macros = False
         changed = False
@@ -819,57 +970,70 @@ def demacro_file(path):
                 continue
             text = sub_single_token_groups(text,item)
             substituted_macro_defs = False
-            while(True):
-                tomatch = re.escape(macrodict[item].name)
-                try:
-                    match = re.search(tomatch+r'(?![A-Za-z\@\*])',text)
-                except:
-                    ValueError("TOMATCH: {}".format(tomatch))
-                if not match:
-                    break
-                changed = True
-                if macrodict[item].arg_count==0:
-                    verbose("Regex sub: {}".format(item))
-                    escaped_name = re.escape(item)+r'(?![A-Za-z\@\*])'
-                    macro_def = escape(reduce_arguments(macrodict[item].definition))
-                    text = re.sub(escaped_name,macro_def,text)
-                else:
-                    index = match.start()
-                    before, expression = text[:index], text[index:]
-                    verbose("Substituting arguments")
+            if engine == 'single':
+                text, matched, substituted, failed = expand_macro_pass(path,
+                macrodict[item],isundefined_dict,text,start_time)
+                if text is None:
+                    return("")
+                if matched:
+                    changed = True
+                if failed:
+                    macro_blacklist.add(macrodict[item].name)
+                if substituted and macrodict[item].contains_macro_defs:
+                    substituted_macro_defs = True
+            else:
+                while(True):
+                    tomatch = re.escape(macrodict[item].name)
                     try:
-                        substituted, after = macrodict[item].parse_expression(expression)
-                    except Exception as inst:
-                        print("{}: Error: failure to parse expression {} - removing macro".format(
-                        path,macrodict[item].name
-                        ))
-                        macro_blacklist.add(macrodict[item].name)
+                        match = re.search(tomatch+r'(?![A-Za-z\@\*])',text)
+                    except:
+                        ValueError("TOMATCH: {}".format(tomatch))
+                    if not match:
                         break
-                    merging = []
-                    merging.append(before)
-                    if len(before)>0:
-                        if before[-1]=='\n':
-                            merging.append('')
-                    else:
-                        merging.append('\n')
-                    merging.append(substituted)
-                    if len(after)>0:
-                        if after[0]=='\n':
-                            merging.append('')
+                    changed = True
+                    if macrodict[item].arg_count==0:
+                        verbose("Regex sub: {}".format(item))
+                        escaped_name = re.escape(item)+r'(?![A-Za-z\@\*])'
+                        macro_def = escape(reduce_arguments(macrodict[item].definition))
+                        text = re.sub(escaped_name,macro_def,text)
                     else:
-                        merging.append('\n')
-                    merging.append(after)
-                    text = ''.join(merging)
-                if macrodict[item].contains_macro_defs:
-                    substituted_macro_defs = True
-                current_time = time.time()
-                text = isundefined_sub(isundefined_dict,text)
-                text = sub_single_token_groups(text)
-                if current_time > start_time + timeout:
-                    print("{}: Timed out ({} seconds)".format(path,int(current_time-start_time)))
-                    return("")
-                text = re.sub(r'\n{3,}','\n\n',text)
-                verbose(len(text))
+                        index = match.start()
+                        before, cursor = text[:index], text_cursor(text,index)
+                        verbose("Substituting arguments")
+                        try:
+                            substituted = macrodict[item].parse_expression(cursor)
+                            after = cursor.rest()
+                        except Exception as inst:
+                            print("{}: Error: failure to parse expression {} - removing macro".format(
+                            path,macrodict[item].name
+                            ))
+                            macro_blacklist.add(macrodict[item].name)
+                            break
+                        merging = []
+                        merging.append(before)
+                        if len(before)>0:
+                            if before[-1]=='\n':
+                                merging.append('')
+                        else:
+                            merging.append('\n')
+                        merging.append(substituted)
+                        if len(after)>0:
+                            if after[0]=='\n':
+                                merging.append('')
+                        else:
+                            merging.append('\n')
+                        merging.append(after)
+                        text = ''.join(merging)
+                    if macrodict[item].contains_macro_defs:
+                        substituted_macro_defs = True
+                    current_time = time.time()
+                    text = isundefined_sub(isundefined_dict,text)
+                    text = sub_single_token_groups(text)
+                    if current_time > start_time + timeout:
+                        print("{}: Timed out ({} seconds)".format(path,int(current_time-start_time)))
+                        return("")
+                    text = re.sub(r'\n{3,}','\n\n',text)
+                    verbose(len(text))
             init_length = len(macrodict)
             if substituted_macro_defs:
                 verbose("Searching for new macros...")
@@ -879,6 +1043,8 @@ def demacro_file(path):
                     print("{}: Error encountered when loading macros".format(path))
                     return("")
                 verbose("Finished searching")
+                if new_macros and not close_macro_definitions(path,macrodict,text,closure):
+                    return("")
             if new_macros or init_length != len(macrodict):
                 break
     text = undo_isundefined_sub(isundefined_dict,text)
@@ -889,13 +1055,437 @@ def demacro_file(path):
         return("")
     return text
 
+"""Single-pass expansion engine (demacro.py --engine single)
+
+The iterative engine searches the whole document from the start after every
+substitution, and rejoins the document around each expansion. Here each macro
+is expanded over the document in one left-to-right pass instead: expansions are
+pushed onto a stack of pending text frames so they are rescanned before the
+rest of the document, and the output is joined once at the end of the pass.
+Macros are still visited in the same order as the iterative engine, which keeps
+the output identical."""
+
+class text_stream:
+    """Stack of pending text frames, read from the top down"""
+    def __init__(self, text):
+        self.frames = [[text, 0]]
+
+    def empty(self):
+        while self.frames and self.frames[-1][1]>=len(self.frames[-1][0]):
+            self.frames.pop()
+        return len(self.frames)==0
+
+    def push(self, text):
+        """Pushes text to be read before everything that is pending. A
+        control sequence split across the end of the new frame is completed
+        from the frame below, as it would be if the texts were joined"""
+        if not text:
+            return
+        tail = re.search(r'\\[A-Za-z@\*]*\Z',text)
+        if tail and not self.empty():
+            below = self.frames[-1]
+            letters = re.compile(r'[A-Za-z@\*]+|[\s\S]').match(below[0],below[1])
+            if len(tail.group(0))==1 or letters.group(0)[0] in control_letters:
+                text += letters.group(0)
+                below[1] = letters.end()
+        self.frames.append([text, 0])
+
+    def peek(self, length):
+        """Returns up to length pending characters, and whether that is
+        everything that is left"""
+        chunks = []
+        for frame_text, pos in reversed(self.frames):
+            chunks.append(frame_text[pos:pos+length])
+            length -= len(chunks[-1])
+            if length<=0:
+                return (''.join(chunks), False)
+        return (''.join(chunks), True)
+
+    def advance(self, count):
+        while count>0:
+            frame = self.frames[-1]
+            available = len(frame[0])-frame[1]
+            if count<available:
+                frame[1] += count
+                return
+            count -= available
+            self.frames.pop()
+
+    def rest(self):
+        return ''.join(frame_text[pos:] for frame_text, pos in reversed(self.frames))
+
+def parse_from_stream(current_macro, stream):
+    """Runs parse_expression on a growing window of the pending text, so that
+    arguments cost their own length rather than the length of the document"""
+    window = 1024
+    while True:
+        text, complete = stream.peek(window)
+        cursor = text_cursor(text)
+        try:
+            substituted = current_macro.parse_expression(cursor)
+        except Exception:
+            if complete:
+                raise
+            window *= 4
+            continue
+        if cursor.pos==len(text) and not complete:
+            window *= 4
+            continue
+        stream.advance(cursor.pos)
+        return substituted
+
+def expand_macro_pass(path, current_macro, isundefined_dict, text, start_time):
+    """Expands every occurrence of current_macro in text in a single pass.
+    Returns (text, matched, substituted, failed), with text set to None
+    on timeout"""
+    global timeout
+    pattern = re.compile(re.escape(current_macro.name)+r'(?![A-Za-z\@\*])')
+    if not pattern.search(text):
+        return (text, False, False, False)
+    if current_macro.arg_count==0:
+        verbose("Regex sub: {}".format(current_macro.name))
+        definition = escape(reduce_arguments(current_macro.definition))
+        while pattern.search(text):
+            text = pattern.sub(definition,text)
+            current_time = time.time()
+            if current_time > start_time + timeout:
+                print("{}: Timed out ({} seconds)".format(path,int(current_time-start_time)))
+                return (None, True, True, False)
+        substituted = True
+        failed = False
+    else:
+        stream = text_stream(text)
+        output = []
+        substituted = False
+        failed = False
+        while not stream.empty():
+            frame = stream.frames[-1]
+            match = pattern.search(frame[0],frame[1])
+            if not match:
+                output.append(frame[0][frame[1]:])
+                stream.frames.pop()
+                continue
+            output.append(frame[0][frame[1]:match.start()])
+            frame[1] = match.start()
+            at_start = not any(output)
+            verbose("Substituting arguments")
+            try:
+                expansion = parse_from_stream(current_macro, stream)
+            except Exception as inst:
+                print("{}: Error: failure to parse expression {} - removing macro".format(
+                path,current_macro.name
+                ))
+                output.append(stream.rest())
+                failed = True
+                break
+            if at_start:
+                expansion = '\n' + expansion
+            if stream.empty():
+                expansion += '\n'
+            substituted = True
+            expansion = isundefined_sub(isundefined_dict,expansion)
+            stream.push(sub_single_token_groups(expansion))
+            current_time = time.time()
+            if current_time > start_time + timeout:
+                print("{}: Timed out ({} seconds)".format(path,int(current_time-start_time)))
+                return (None, True, substituted, failed)
+        text = ''.join(output)
+    if substituted:
+        text = isundefined_sub(isundefined_dict,text)
+        text = sub_single_token_groups(text)
+        text = re.sub(r'\n{3,}','\n\n',text)
+    return (text, True, substituted, failed)
+
+"""Macro closure (demacro.py --closure)
+
+Before the document is touched, macros used inside other macro definitions are
+expanded into those definitions, dependencies first. Expanding a macro in the
+document then no longer produces other user macros, so the outer loop of
+demacro_file no longer has to go round once per level of nesting. Cycles
+(a macro using itself included) are found here on every run, with or without
+--closure, instead of running until the document times out."""
+
+def macro_name_pattern(names):
+    """Compiles one alternation of all of the given macro names"""
+    names = sorted(names, key=len, reverse=True)
+    return re.compile('(?:'+'|'.join([re.escape(name) for name in names])+r')(?![A-Za-z\@\*])')
+
+def macro_dependencies(macrodict):
+    """Returns a dict mapping each macro name to the names of the macros its
+    definition uses (itself included), in order of first use"""
+    pattern = macro_name_pattern(macrodict)
+    graph = {}
+    for name in macrodict:
+        used = []
+        for match in pattern.finditer(macrodict[name].definition):
+            if match.group(0) not in used:
+                used.append(match.group(0))
+        graph[name] = used
+    return graph
+
+def find_macro_cycle(graph, roots):
+    """Returns a cycle reachable from roots as a list of names (first and last
+    name equal), or an empty list"""
+    state = {}
+    for root in roots:
+        if root in state:
+            continue
+        state[root] = 1
+        path = [root]
+        stack = [iter(graph[root])]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                state[path.pop()] = 2
+                stack.pop()
+            elif state.get(child)==1:
+                return path[path.index(child):] + [child]
+            elif child not in state:
+                state[child] = 1
+                path.append(child)
+                stack.append(iter(graph[child]))
+    return []
+
+def acyclic_order(graph):
+    """Returns the names of the macros that do not use a recursive macro,
+    directly or indirectly, with every macro after the macros it uses"""
+    users = dict((name, []) for name in graph)
+    remaining = {}
+    for name in graph:
+        remaining[name] = len(graph[name])
+        for dependency in graph[name]:
+            users[dependency].append(name)
+    queue = [name for name in graph if remaining[name]==0]
+    order = []
+    while queue:
+        name = queue.pop()
+        order.append(name)
+        for user in users[name]:
+            remaining[user] -= 1
+            if remaining[user]==0:
+                queue.append(user)
+    return order
+
+def bare_parameter(text):
+    """Returns True if text has a # outside of any {} group"""
+    depth = 0
+    for character in text:
+        if character=='{':
+            depth += 1
+        elif character=='}':
+            depth -= 1
+        elif character=='#' and depth<=0:
+            return True
+    return False
+
+def expand_in_definition(dependency, text):
+    """Expands the uses of dependency in the definition text of another
+    macro. Uses whose arguments reach past the end of the definition or split
+    a parameter are left alone. Returns (text, changed)"""
+    pattern = re.compile(re.escape(dependency.name)+r'(?![A-Za-z\@\*])')
+    output = []
+    changed = False
+    pos = 0
+    for match in pattern.finditer(text):
+        if match.start()<pos:
+            continue
+        if dependency.arg_count==0:
+            expansion = reduce_arguments(dependency.definition)
+            end = match.end()
+        else:
+            cursor = text_cursor(text,match.start())
+            try:
+                values = dependency.argument_values(*dependency.parse_arguments(cursor))
+            except Exception:
+                continue
+            template = dependency.template(len(values))
+            if (template is None or cursor.pos>=len(text) or
+                bare_parameter(text[match.end():cursor.pos])):
+                continue
+            expansion = fill_template(template,values)
+            end = cursor.pos
+        if '##' in expansion:
+            continue
+        output.append(text[pos:match.start()])
+        output.append(expansion)
+        pos = end
+        changed = True
+    output.append(text[pos:])
+    return (''.join(output), changed)
+
+def close_macro_definitions(path, macrodict, text, expand=True):
+    """Expands macros into the definitions of the macros that use them (with
+    expand; otherwise only looks for cycles). Returns False, after reporting
+    the cycle, if a macro used in text is recursive"""
+    graph = macro_dependencies(macrodict)
+    pattern = macro_name_pattern(macrodict)
+    used = []
+    for match in pattern.finditer(text):
+        if match.group(0) not in used:
+            used.append(match.group(0))
+    cycle = find_macro_cycle(graph, used)
+    if cycle:
+        print("{}: Recursive macros detected: {}".format(path,' -> '.join(cycle)))
+        return False
+    if not expand:
+        return True
+    position = dict((name, i) for i, name in enumerate(macrodict))
+    for name in acyclic_order(graph):
+        current_macro = macrodict[name]
+        definition = current_macro.definition
+        if not graph[name] or current_macro.contains_macro_defs or \
+            re.search(isundefined_pattern,definition):
+            continue
+        for _ in range(len(macrodict)+1):
+            changed = False
+            found = set(match.group(0) for match in pattern.finditer(definition))
+            for dependency in sorted(found, key=lambda item: position[item]):
+                if dependency==name:
+                    continue
+                definition = sub_single_token_groups(definition,dependency)
+                definition, expanded = expand_in_definition(macrodict[dependency],definition)
+                changed = changed or expanded
+            if not changed:
+                break
+        if definition!=current_macro.definition:
+            verbose("Closed {}: {}".format(name,definition))
+            current_macro.definition = definition
+            current_macro.templates = {}
+            if re.search(macro_pattern,definition):
+                current_macro.contains_macro_defs = True
+    return True
+
+"""Result cache (demacro.py --cache-dir)
+
+Results are stored under a hash of the paper's text with its \\input files
+spliced in, the demacro source and every setting that changes the output, so
+unchanged and resubmitted papers are not expanded again on later runs. Each
+entry is gzipped: a status line (ok, or failed and the reason) then the text"""
+
+class output_log:
+    """Passes printed output through while keeping the lines printed"""
+    def __init__(self,stream):
+        self.stream = stream
+        self.lines = []
+
+    def write(self,text):
+        self.stream.write(text)
+        self.lines.extend(line for line in text.split('\n') if line.strip())
+
+    def flush(self):
+        self.stream.flush()
+
+def code_version():
+    """Hash of the demacro source, so results from older code are not reused"""
+    global source_version
+    if source_version is None:
+        digest = hashlib.sha256()
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),'core')
+        for source in [__file__,os.path.join(folder,'funcs.py'),os.path.join(folder,'tsvcodec.py')]:
+            with open(source,'rb') as fh:
+                digest.update(fh.read())
+        source_version = digest.hexdigest()
+    return source_version
+
+def cache_key(text):
+    global timeout
+    global engine
+    global closure
+    digest = hashlib.sha256()
+    settings = [code_version(),str(timeout),engine,str(closure)]
+    digest.update('\t'.join(settings).encode())
+    digest.update(b'\n')
+    digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
+def cache_path(key):
+    global cache_dir
+    return os.path.join(cache_dir,key[:2],key+'.gz')
+
+def cache_get(key):
+    """Returns (text, failure reason) for a cached paper, or None"""
+    path = cache_path(key)
+    try:
+        with gzip.open(path,'rb') as fh:
+            data = fh.read().decode('utf-8')
+        os.utime(path)
+    except (OSError, EOFError, UnicodeDecodeError):
+        return None
+    header, _, text = data.partition('\n')
+    status, _, reason = header.partition('\t')
+    if status=='ok':
+        return(text,'')
+    return('',reason)
+
+def cache_put(key,text,reason=''):
+    path = cache_path(key)
+    validate_folder(os.path.dirname(path))
+    header = 'ok' if text else 'failed\t'+reason.replace('\n',' ')
+    temp = "{}.{}.tmp".format(path,os.getpid())
+    with gzip.open(temp,'wb') as fh:
+        fh.write((header+'\n'+text).encode('utf-8'))
+    os.replace(temp,path)
+
+def evict_cache(limit):
+    """Deletes the least recently used entries until the cache holds at most
+    limit bytes"""
+    global cache_dir
+    entries = []
+    total = 0
+    for root, folders, files in os.walk(cache_dir):
+        for fname in files:
+            path = os.path.join(root,fname)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime,info.st_size,path))
+            total += info.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total<=limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+def cached_demacro(main,members=None):
+    """demacro_file, consulting the result cache first if there is one.
+    Papers that time out are not cached"""
+    global cache_dir
+    if not cache_dir:
+        return demacro_file(main,members)
+    source = load_inputs(main,members)
+    key = cache_key(source)
+    entry = cache_get(key)
+    if entry:
+        text, reason = entry
+        if reason:
+            print("{}: Cached failure: {}".format(main,reason))
+        return text
+    log = output_log(sys.stdout)
+    with contextlib.redirect_stdout(log):
+        text = demacro_file(main,members,source)
+    reason = ''
+    if not text:
+        reason = log.lines[-1] if log.lines else 'returned blank document'
+        if reason.startswith(main+': '):
+            reason = reason[len(main)+2:]
+        # a timeout depends on the machine and its load, so it is retried
+        if reason.startswith('Timed out'):
+            return text
+    cache_put(key,text,reason)
+    return text
+
 def demacro_archive(path):
     main = find_main_file(path)
     if not main:
         print("{}: Main file not found".format(path))
         return
     print("Starting: {}".format(main))
-    new_text = demacro_file(main)
+    new_text = cached_demacro(main)
     if not new_text:
         print("{}: returned blank document".format(main))
     else:
@@ -969,6 +1559,183 @@ def total_extract_folder(folder,dest=''):
     untar_folder(folder,dest)
     untarballs_folder(dest,'')
 
+"""Streaming ingestion (--stream): the .tar is read sequentially and each
+submission is decompressed in memory, so nothing is extracted to disk"""
+
+def decode_member(data):
+    """Decodes a member the way open(..., encoding='latin-1') would"""
+    return data.decode('latin-1').replace('\r\n','\n').replace('\r','\n')
+
+def submission_name(fname):
+    """1506.00001.tar.gz, 1506.00001.gz -> 1506.00001"""
+    fname = os.path.basename(fname)
+    for suffix in ['.tar.gz','.tgz','.gz']:
+        if fname.endswith(suffix):
+            return fname[:-len(suffix)]
+    return fname
+
+def read_submission(name,data):
+    """Unpacks a compressed submission held in memory into a member map of
+    {name/path/to/file.tex: text}. Bare .gz submissions hold a single file"""
+    members = {}
+    try:
+        raw = gzip.decompress(data)
+    except Exception as inst:
+        print("{}: Unable to extract".format(name))
+        print(inst)
+        return members
+    try:
+        tar = tarfile.open(fileobj=io.BytesIO(raw),mode='r:')
+    except tarfile.TarError:
+        members[os.path.join(name,name+'.tex')] = decode_member(raw)
+        return members
+    with tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if os.path.splitext(member.name)[1].lower()!='.tex':
+                continue
+            path = os.path.normpath(os.path.join(name,member.name))
+            members[path] = decode_member(tar.extractfile(member).read())
+    return members
+
+def stream_archive(archive):
+    """Yields (name, compressed bytes) for every submission in a .tar,
+    reading the archive as a stream"""
+    try:
+        with tarfile.open(archive,mode='r|') as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith('.gz'):
+                    continue
+                yield(submission_name(member.name),tar.extractfile(member).read())
+    except tarfile.TarError as inst:
+        print("{}: Extraction failed".format(archive))
+        print(inst)
+
+def stream_submissions(archive):
+    """Yields (name, member map) for every submission in a .tar"""
+    for name, data in stream_archive(archive):
+        yield(name,read_submission(name,data))
+
+def demacro_members(submission):
+    """demacro_mapped for a submission held in memory"""
+    global output_path
+    global debug_path
+    name, members = submission
+    main = find_main_member(members)
+    if not main:
+        print("{}: Main file not found".format(name))
+        return
+    print("Starting: {}".format(main))
+    new_text = cached_demacro(main,members)
+    if new_text:
+        print("{}: COMPLETE".format(main))
+        with open(os.path.join(output_path,name+'.tex'),'w') as fh:
+            fh.write(new_text)
+    else:
+        print("{}: returned blank document".format(main))
+        with open(os.path.join(debug_path,name+'.tex'),'w') as fh:
+            fh.write(load_inputs(main,members))
+
+def demacro_stream(archive,dest):
+    """demacro_and_untar without extracting: e.g. 1506.tar is written to
+    dest/1506/*.tex"""
+    global output_path
+    new_name = os.path.split(os.path.splitext(archive)[0])[1]
+    output_path = os.path.join(dest,new_name)
+    validate_folder(output_path)
+    print("Streaming {}".format(archive))
+    supervised(demacro_members,stream_submissions(archive))
+
+"""Pipelined --dtar: extractor processes feed submissions through a bounded
+queue into one long-lived demacro pool, so extraction of the next archive
+overlaps demacro of the current one"""
+
+def extract_submission(folder,name,data):
+    """Unpacks a compressed submission held in memory to folder/name.
+    Returns the paper folder, or an empty string on failure"""
+    paper = os.path.join(folder,name)
+    try:
+        raw = gzip.decompress(data)
+        validate_folder(paper)
+        try:
+            tar = tarfile.open(fileobj=io.BytesIO(raw),mode='r:')
+        except tarfile.TarError:
+            with open(os.path.join(paper,name+'.tex'),'wb') as fh:
+                fh.write(raw)
+            return paper
+        with tar:
+            tar.extractall(paper)
+    except Exception as inst:
+        print("{}: Unable to extract".format(name))
+        print(inst)
+        shutil.rmtree(paper,ignore_errors=True)
+        return ""
+    return paper
+
+def extract_archives(archive_list,dest,queue,in_memory):
+    """Producer: queues (output folder, paper, member map) for each submission
+    of each archive. Papers are member maps if in_memory, else folders
+    extracted under the output folder. Ends with a None sentinel"""
+    try:
+        for archive in archive_list:
+            new_name = os.path.split(os.path.splitext(archive)[0])[1]
+            folder = os.path.join(dest,new_name)
+            validate_folder(folder)
+            print("Extracting {}".format(archive))
+            for name, data in stream_archive(archive):
+                if in_memory:
+                    queue.put((folder,name,read_submission(name,data)))
+                else:
+                    paper = extract_submission(folder,name,data)
+                    if paper:
+                        queue.put((folder,paper,None))
+            print("{}: Extraction complete".format(archive))
+    finally:
+        queue.put(None)
+
+def queued_papers(queue,producers):
+    """Yields queued papers until every producer has finished"""
+    finished = 0
+    while finished<producers:
+        item = queue.get()
+        if item is None:
+            finished += 1
+        else:
+            yield item
+
+def demacro_queued(item):
+    """Consumer: demacros one queued paper, removing its extracted folder"""
+    global output_path
+    output_path, paper, members = item
+    if members is None:
+        demacro_mapped(paper)
+        shutil.rmtree(paper,ignore_errors=True)
+    else:
+        demacro_members((paper,members))
+
+def demacro_pipelined(archive_folder,dest,in_memory=False,extractors=1,queue_size=0):
+    """demacro_and_untar_folder with extraction and demacro overlapped.
+    At most queue_size papers wait in the queue and one per worker is in
+    flight, which bounds memory (in_memory) or disk use"""
+    global debug_path
+    validate_folder(debug_path)
+    validate_folder(dest)
+    archive_list = sorted(os.path.join(archive_folder,fname) for fname in next(os.walk(archive_folder))[2] if fname.endswith('.tar'))
+    workers = mp.cpu_count()
+    queue = mp.Queue(queue_size or 2*workers)
+    producers = [mp.Process(target=extract_archives,args=(archive_list[i::extractors],dest,queue,in_memory))
+        for i in range(min(extractors,len(archive_list)))]
+    for producer in producers:
+        producer.start()
+    supervised(demacro_queued,queued_papers(queue,len(producers)))
+    for producer in producers:
+        producer.join()
+    for archive in archive_list:
+        folder = os.path.join(dest,os.path.split(os.path.splitext(archive)[0])[1])
+        for paper in next(os.walk(folder))[1]:
+            shutil.rmtree(os.path.join(folder,paper),ignore_errors=True)
+
 def demacro_mapped(folder):
     """Wrapper function for handling in/out paths & failed document output"""
     global output_path
@@ -987,6 +1754,33 @@ def demacro_mapped(folder):
             with open(debug_path+new_name+'.tex','w') as fh:
                 fh.write(text)
 
+def paper_label(item):
+    """Name of the paper in a work item of demacro_folder (folder),
+    demacro_stream (name, members) or demacro_pipelined (output, paper, members)"""
+    if isinstance(item,str):
+        return item
+    if len(item)==2:
+        return item[0]
+    return item[1]
+
+def supervised(func,items):
+    """Maps func over items in worker processes that are killed once a paper
+    runs past the hard deadline. Killed papers are listed in timed_out.txt
+    in the debug folder"""
+    global timeout
+    global deadline
+    global maxtasks
+    global debug_path
+    hard_deadline = deadline or 2*timeout
+    tasks = supervisor(func,mp.cpu_count(),hard_deadline,maxtasks)
+    for item, status, result in tasks.imap_unordered(items):
+        if status=='timeout':
+            print("{}: Killed after {} seconds".format(paper_label(item),hard_deadline))
+            with open(os.path.join(debug_path,'timed_out.txt'),'a') as fh:
+                fh.write(paper_label(item)+'\n')
+        elif status=='error':
+            print("{}: Worker failed: {}".format(paper_label(item),result))
+
 def demacro_folder(folder):
     """Demacro a folder of raw .tex directories"""
     global output_path
@@ -994,10 +1788,7 @@ def demacro_folder(folder):
     folder = os.path.abspath(folder)
     folders = next(os.walk(folder))[1]
     folderlist = [os.path.join(folder,item) for item in folders]
-    pool = mp.Pool(mp.cpu_count())
-    pool.map(demacro_mapped,folderlist)
-    pool.close()
-    pool.join()
+    supervised(demacro_mapped,largest_first(folderlist))
     folders = next(os.walk(output_path))[1]
     outfolderlist = [os.path.join(output_path,item) for item in folders]
     for fname in outfolderlist:
@@ -1048,6 +1839,13 @@ def main():
     global timeout
     global output_path
     global old_convention
+    global engine
+    global expansion_memo
+    global closure
+    global deadline
+    global maxtasks
+    global cache_dir
+    global cache_size
     parser = argparse.ArgumentParser(
     description='Expands LaTeX macros. Default: demacro a single folder of .tex files')
     parser.add_argument('input', help='Input file/directory')
@@ -1062,6 +1860,26 @@ def main():
     parser.add_argument('--tar',action='store_true',
     help='Indicate that input is a single .tar file')
     parser.add_argument('--timeout',help='Declare custom timeout')
+    parser.add_argument('--deadline',type=int,
+    help='Hard per-document limit in seconds; workers running past it are killed (default: twice the timeout)')
+    parser.add_argument('--maxtasks',type=int,default=50,
+    help='Documents processed by each worker before it is replaced (default: 50)')
+    parser.add_argument('--cache-dir',
+    help='Folder of cached results: unchanged papers are not expanded again on later runs')
+    parser.add_argument('--cache-size',type=float,default=10240,
+    help='Size limit of the cache in MB; least recently used results are evicted (default: 10240)')
+    parser.add_argument('--stream',action='store_true',
+    help='With --tar/--dtar: read archives in memory instead of extracting them to disk')
+    parser.add_argument('--extractors',type=int,default=1,
+    help='With --dtar: number of archives extracted in parallel (default: 1)')
+    parser.add_argument('--queue',type=int,default=0,
+    help='With --dtar: papers extracted ahead of the demacro pool (default: 2 per core)')
+    parser.add_argument('--engine',choices=['iterative','single'],default='iterative',
+    help='Macro expansion engine: iterative (default) or single-pass')
+    parser.add_argument('--closure',action='store_true',
+    help='Expand macros into each other\'s definitions before expanding the document')
+    parser.add_argument('--memo',type=int,default=0,
+    help='Number of repeated macro expansions to memoize per worker (default: off)')
     parser.add_argument('--folder',action='store_true',
     help='Indicate that input is folder corresponding to a single .tex document')
     parser.add_argument('--file',action='store_true',
@@ -1074,6 +1892,12 @@ def main():
     input_path = args.input
     output_path = args.output
     old_convention = args.old_convention
+    engine = args.engine
+    closure = args.closure
+    deadline = args.deadline
+    maxtasks = args.maxtasks
+    if args.memo>0:
+        expansion_memo = lru_memo(args.memo)
     if args.debug:
         debug_path = args.debug
     validate_folder(debug_path)
@@ -1086,12 +1910,20 @@ def main():
     if args.timeout:
         timeout = int(args.timeout)
         print("New timeout: {} s".format(timeout))
-    if args.dtar:
+    if args.cache_dir:
+        cache_dir = os.path.abspath(args.cache_dir)
+        cache_size = int(args.cache_size*1024**2)
+        validate_folder(cache_dir)
+    if args.dtar and old_convention:
         demacro_and_untar_folder(input_path,output_path)
+    elif args.dtar:
+        demacro_pipelined(input_path,output_path,args.stream,max(args.extractors,1),args.queue)
     elif args.dgz:
         folder_name = os.path.basename(os.path.normpath(input_path))
         untarballs(input_path,os.path.join(output_path,folder_name))
         demacro_folder(os.path.join(output_path,folder_name))
+    elif args.tar and args.stream:
+        demacro_stream(input_path,output_path)
     elif args.tar:
         demacro_and_untar(input_path,output_path)
     elif args.folder:
@@ -1105,6 +1937,8 @@ def main():
     else:
         text = demacro_file(input_path)
         print(text)
+    if cache_dir:
+        evict_cache(cache_size)
     end_time = time.time()
     total_time = str(datetime.timedelta(seconds=int(end_time-start_time)))
     print(total_time)
@@ -6,40 +6,109 @@ import argparse
 import os
 import multiprocessing as mp
 from core.funcs import *
+from core.schedule import *
+from core.normalize import *
+from core.eqstore import *
 from multiprocessing import Manager
 import multiprocessing as mp
 from glob import glob
 import shutil
+import tempfile
 import gc
 
+def output_path(filename):
+    """Where the enumerated filename is written. With --parent the folders
+    below directory are mirrored in outpath"""
+    global directory
+    global outpath
+    global parent
+    if parent:
+        return os.path.join(outpath,os.path.relpath(filename,directory))
+    return os.path.join(outpath,os.path.basename(filename))
+
+# bytes that read back differently once decoded (\r) or written as UTF-8
+reencoded_bytes = re.compile(rb'[\r\x80-\xff]')
+
+def copy_unchanged(filename):
+    """Puts filename as it is at its output path (unless that is filename
+    itself), as a hard link with --link"""
+    global link
+    target = output_path(filename)
+    if os.path.abspath(target)==os.path.abspath(filename):
+        return
+    os.makedirs(os.path.dirname(target),exist_ok=True)
+    if os.path.lexists(target):
+        os.remove(target)
+    if link:
+        try:
+            os.link(filename,target)
+            return
+        except OSError:
+            pass
+    shutil.copy2(filename,target)
+
+def write_output(filename,newtext):
+    """Writes newtext to the output path of filename. The text goes to a
+    temporary file that replaces the output, so an interrupted run leaves
+    no partial files and a hard link to the input is never written through"""
+    target = output_path(filename)
+    os.makedirs(os.path.dirname(target),exist_ok=True)
+    temp = target+'.tmp'
+    with open(temp,mode='w',encoding='utf-8') as fh:
+        fh.write(newtext)
+    os.replace(temp,target)
+
+def is_done(filename):
+    """True if a previous run already wrote the output of filename"""
+    target = output_path(filename)
+    if os.path.abspath(target)==os.path.abspath(filename):
+        return False
+    try:
+        return os.path.getmtime(target)>=os.path.getmtime(filename)
+    except OSError:
+        return False
+
 def substitute_eqid(filename):
     """Substitutes equations in document with their respective inline
     equations"""
     global eqdict
-    global outpath
     global inline
-    no_math = True
-    with open(filename,mode='r',encoding='latin-1') as fh:
-        text = fh.read()
-    text = clean_inline_math(text)
+    global parent
+    global link
+    with mapped_document(filename) as data:
+        if inline and data.find(b'$')==-1:
+            print("{}: no inline math".format(filename))
+            if parent:
+                copy_unchanged(filename)
+            return
+        original = decode_document(data)
+        # the file would be written back byte for byte if its text is
+        # unchanged, so --link can link it instead
+        verbatim = reencoded_bytes.search(data) is None
+    text = clean_inline_math(original)
+    index = lex_latex(text)
+    # (start, end, eqid) of each equation found, applied in one pass below
+    replacements = []
     if(inline):
-        textlist = grab_inline_math(text,split=True)
-        for i, x in enumerate(textlist):
-            if x in eqdict:
-                textlist[i] = eqdict[x]
-                no_math = False
-        if no_math:
+        for start, end in index.inline_equations():
+            eqid = eqdict.get(index.text[start:end])
+            if eqid is not None:
+                replacements.append((start,end,eqid))
+        if not replacements:
             print("{}: no inline math".format(filename))
+            if parent:
+                copy_unchanged(filename)
             return
-        newtext = ''.join(textlist)
+        newtext = rewrite_spans(index.text,replacements)
     else:
-        # math = grab_math(text)
-        for equation in grab_math(text):
-            flat_eq = flatten_equation(equation)
-            if flat_eq in eqdict:
-                text = text.replace(equation,eqdict[flat_eq])
-            elif equation in eqdict:
-                text = text.replace(equation,eqdict[equation])
+        for kind, start, end in index.display:
+            equation = index.text[start:end]
+            eqid = eqdict.get(normalize_equation(equation).flat)
+            if eqid is None:
+                eqid = eqdict.get(equation)
+            if eqid is not None:
+                # the offsets of the span in text, which keeps the preamble
+                replacements.append((index.original_offset(start),index.original_offset(end-1)+1,eqid))
             else:
                 for expr in to_remove:
                     if re.search(expr,equation):
@@ -47,25 +116,36 @@ def substitute_eqid(filename):
                         break
                 else:
                     print("Enumeration error: {}: Single line".format(filename))
-        newtext = text
-    if outpath:
-        filename = os.path.join(outpath,os.path.basename(filename))
-    with open(filename,mode='w',encoding='utf-8') as fh:
-        fh.write(newtext)
+        newtext = rewrite_spans(text,replacements)
+        if link and verbatim and newtext==original:
+            copy_unchanged(filename)
+            return
+    write_output(filename,newtext)
 
 def main():
     global eqdict
+    global directory
     global outpath
     global inline
+    global parent
+    global link
     parser = argparse.ArgumentParser(description=\
     'Usage for equation enumeration')
     parser.add_argument("directory",help="Path to directory of .tex files, or demacro (if the flag is specified)")
     parser.add_argument("tsv",
-    help="Path to .tsv of enumerated equations (output of enumerateeqs.py)")
+    help="Path to .tsv of enumerated equations (output of enumerateeqs.py), or an equation store built from it")
     parser.add_argument("--parent", action='store_true',
     help="Use flag if the specified directory is the parent of .tex file directories")
     parser.add_argument("--outpath",help="Path to output directory (WARNING: if this flag is not used with an output directory, it will overwrite the .tex files in place)")
     parser.add_argument("--inline", action='store_true', help="Use flag if enumerating inline equations")
+    parser.add_argument("--norm-cache",
+    help="File to load normalized equations from and save them to, shared with enumerate_eqs and generatetsv")
+    parser.add_argument("--link", action='store_true',
+    help="Hard link files whose output would be identical to them (and, with --parent, files that are not .tex) into outpath instead of writing them; the output is the same as without it")
+    parser.add_argument("--resume", action='store_true',
+    help="Skip files whose output is newer than the file, i.e. written by an interrupted earlier run")
+    parser.add_argument("--costs",
+    help="Timings from a previous run (written back afterwards), used to start the slowest files first")
     args = parser.parse_args()
     tsv = os.path.abspath(args.tsv)
     directory = os.path.join(os.path.abspath(args.directory),'')
@@ -75,58 +155,72 @@ def main():
         outpath = directory
     parent = args.parent
     inline = args.inline
-    print("Generating equation dictionary...")
-    eqdict = {}
-    counter = 0
-    if inline:
-        with open(tsv,mode='r',encoding='latin-1') as fh:
-            for line in fh:
-                eqid, equation = line.strip().split('\t')
-                equation = equation.encode().decode('unicode_escape').strip()
-                if equation not in eqdict:
-                    eqdict[equation] = eqid
-                counter += 1
-    else:
-            with open(tsv,mode='r',encoding='latin-1') as fh:
-                for line in fh:
-                    contents = line.strip().split('\t')
-                    if len(contents)==2:
-                        eqid, equation = contents
-                        equation  = unmask(equation)
-                        eqdict[flatten_equation(equation)] = eqid
-                    elif len(contents)==3:
-                        eqid, sub_ids, equation = contents
-                        equation = unmask(equation)
-                        eqdict[equation] = eqid
-    print("Equation dictionary loaded.")
-    print("{} entries".format(len(eqdict)))
-    pool = mp.Pool(mp.cpu_count())
-    if(parent):
-        filelist = []
-        print("Iterating over folders in {}".format(directory))
-        if outpath != directory:
-            folderlist = next(os.walk(directory))[1]
-            for subfolder in folderlist:
-                print("Copying {}".format(subfolder))
-                shutil.copytree(os.path.join(directory,subfolder),os.path.join(outpath,subfolder))
+    link = args.link
+    load_normalize_cache(args.norm_cache)
+    store_folder = None
+    eqdict = None
+    try:
+        if is_equation_store(tsv):
+            print("Opening equation store...")
+            store_path = tsv
         else:
-            outpath = directory
-        for root, folders, files in os.walk(outpath):
-            for filename in files:
-                filelist.append(os.path.join(root,filename))
-        pool.map(substitute_eqid,filelist)
-        pool.close()
-        pool.join()
-    else:
-        if not os.path.exists(outpath):
-            os.makedirs(outpath)
-        print("Finding all .tex files...")
-        filelist = gettexfiles(directory)
-        print("Found {} files".format(len(filelist)))
-        print("Writing files...")
-        pool.map(substitute_eqid,filelist)
-        pool.close()
-        pool.join()
+            # a dict here would be copied into every worker as soon as its
+            # refcounts are touched, a mapped store is shared by all of them
+            print("Generating equation store...")
+            store_folder = tempfile.mkdtemp(prefix='hoptex-eqs-')
+            store_path = os.path.join(store_folder,'equations.eqs')
+            import_tsv(tsv,store_path,inline)
+        save_normalize_cache(args.norm_cache)
+        eqdict = equation_store(store_path)
+        if eqdict.inline!=inline:
+            print("Warning: {} was not built for {} equations".format(tsv,'inline' if inline else 'display'))
+        print("Equation dictionary loaded.")
+        print("{} entries".format(len(eqdict)))
+        pool = mp.Pool(mp.cpu_count())
+        if(parent):
+            # output is written straight to the mirrored path of each file in
+            # outpath, files that are not .tex are only copied or linked
+            filelist = []
+            skipped = 0
+            print("Iterating over folders in {}".format(directory))
+            for root, folders, files in os.walk(directory):
+                if outpath!=directory and os.path.join(root,'').startswith(outpath):
+                    folders[:] = []
+                    continue
+                for filename in files:
+                    filename = os.path.join(root,filename)
+                    if args.resume and is_done(filename):
+                        skipped += 1
+                    elif filename.endswith('.tex'):
+                        filelist.append(filename)
+                    else:
+                        copy_unchanged(filename)
+            if skipped:
+                print("Skipping {} files already written".format(skipped))
+            print("Found {} .tex files".format(len(filelist)))
+            for filename, result in imap_scheduled(pool,substitute_eqid,filelist,args.costs):
+                pass
+            pool.close()
+            pool.join()
+        else:
+            if not os.path.exists(outpath):
+                os.makedirs(outpath)
+            print("Finding all .tex files...")
+            filelist = gettexfiles(directory)
+            if args.resume:
+                filelist = [filename for filename in filelist if not is_done(filename)]
+            print("Found {} files".format(len(filelist)))
+            print("Writing files...")
+            for filename, result in imap_scheduled(pool,substitute_eqid,filelist,args.costs):
+                pass
+            pool.close()
+            pool.join()
+    finally:
+        # the temporary store is removed however the run ends
+        if eqdict is not None:
+            eqdict.close()
+        if store_folder:
+            shutil.rmtree(store_folder,ignore_errors=True)
 
 if __name__ == '__main__':
     main()
@@ -5,6 +5,8 @@ import os
 import multiprocessing as mp
 import fnmatch
 from core.funcs import *
+from core.tsvcodec import *
+from core.normalize import *
 import time
 
 # Delimiters for assembling
@@ -13,16 +15,102 @@ eeq = "\\end{equation}"
 balign = "\\begin{align}"
 ealign = "\\end{align}"
 
+# set by --norm-cache, workers then send their normalized equations back
+share_cache = False
+
 def grab_eqs_and_filename(filename):
     return((filename,grab_math_from_file(filename)))
 
+def normalized_equations(equations):
+    """Normalizes, splits and hashes the display equations of one file.
+    Returns a (hash, text, kind, rows) tuple per equation. For a single line
+    equation hash is that of its flattened form and text the standardized
+    equation. For a multiline one hash is that of the equation as found,
+    text the equation and rows a (hash, text) pair per row"""
+    records = []
+    for equation in equations:
+        record = normalize_equation(equation)
+        if record.kind is None:
+            continue
+        if record.multiline:
+            rows = []
+            for sub_eq in record.rows:
+                sub_eq = remove_whitespace(sanitize_equation(sub_eq,complete=True))
+                rows.append((content_hash(sub_eq),beq+sub_eq+eeq))
+            records.append((content_hash(equation),equation,record.kind,tuple(rows)))
+        else:
+            # standardized, no whitespace
+            records.append((record.hash,beq+record.body+eeq,record.kind,None))
+    return records
+
+def enumerate_file(filename):
+    """Pool worker: the normalized_equations of a file, and with
+    --norm-cache the (equation, normalized_equation) pairs for the parent's
+    cache"""
+    global share_cache
+    equations = grab_math_from_file(filename)
+    records = normalized_equations(equations)
+    if share_cache:
+        return records, [(equation, normalize_equation(equation)) for equation in equations]
+    return records, []
+
+class equation_ids:
+    """EQIDs of the equations seen so far, keyed by content hash. single
+    maps to (eqid, text), multiline to (eqid, sub_ids, text)"""
+    def __init__(self):
+        self.single = {}
+        self.multiline = {}
+        self.single_count = 0
+        self.multiline_count = 0
+
+    def single_id(self,key,text):
+        if key not in self.single:
+            self.single[key] = ("EQDS"+str(self.single_count)+"Q",text)
+            self.single_count += 1
+        return self.single[key][0]
+
+    def add(self,records):
+        """Merges the normalized_equations of a file"""
+        for key, text, kind, rows in records:
+            if rows is None:
+                self.single_id(key,text)
+            else:
+                sub_ids = [self.single_id(row_key,row_text) for row_key, row_text in rows]
+                self.multiline[key] = ("EQDM"+str(self.multiline_count)+"Q",",".join(sub_ids),text)
+                self.multiline_count += 1
+
+    def load(self,tsv):
+        """Continues the numbering of a previously written TSV"""
+        for linesplit in read_tsv_rows(tsv):
+            if len(linesplit)==2:
+                eqid, text = linesplit
+                key = normalize_equation(text).hash
+                if key in self.single:
+                    # keep every row of the old TSV, even if its flat form repeats
+                    key = content_hash(eqid)
+                self.single[key] = (eqid,text)
+                self.single_count += 1
+            elif len(linesplit)==3:
+                eqid, sub_ids, text = linesplit
+                self.multiline[content_hash(text)] = (eqid,sub_ids,text)
+                self.multiline_count += 1
+
+    def write(self,filename):
+        with open_tsv(filename) as fh:
+            for EQID, eqtext in self.single.values():
+                fh.write(format_row([EQID,eqtext]))
+            for EQID, sub_ids, eqtext in self.multiline.values():
+                fh.write(format_row([EQID,sub_ids,eqtext]))
+
 def main():
+    global share_cache
     parser = argparse.ArgumentParser(description='Usage for equation enumeration')
     parser.add_argument("directory",help="Path to directory of .tex files")
     parser.add_argument("outfile",help="Path to output file")
     parser.add_argument("--xhtml", help="Path to directory of xhtml files")
     parser.add_argument("--tsv", help="Path to tsv to continue loading ")
     parser.add_argument("--parent", action="store_true", help="Set to true if this is a folder of folders of .tex files")
+    parser.add_argument("--norm-cache", help="File to load normalized equations from and save them to, shared with enumerate_docs and generatetsv")
     args = parser.parse_args()
     directory = os.path.join(os.path.abspath(args.directory),'')
     outpath = os.path.abspath(args.outfile)
@@ -32,22 +120,22 @@ def main():
     tsv_write_mode = 'w'
     if(args.xhtml):
         xhtml = os.path.abspath(args.xhtml)
+    load_normalize_cache(args.norm_cache)
+    share_cache = bool(args.norm_cache)
     matches = []
     unique_eqs = {}
-    unique_meqs = {}
+    ids = equation_ids()
     print("Starting timer...")
     start = time.time()
     # 'resuming' a tsv
     # allows enumeration to continue from a previously written tsv
     # still writes the new tsv to the output destination
     if(tsv):
-        print("Loading equations...")
-        with open(tsv,mode='r',encoding='latin-1') as fh:
-            for line in fh:
-                linesplit = line.split('\t')
-                eqid = linesplit[0]
-                text = unmask(linesplit[1]).strip()
-                unique_eqs[text] = eqid
+        if(xhtml):
+            print("--tsv is not supported with --xhtml, ignoring it")
+        else:
+            print("Loading equations...")
+            ids.load(tsv)
     print("Seeking .tex files...")
     # if this is a parent directory of several folders of .tex files
     if(parent):
@@ -81,7 +169,6 @@ def main():
     pool = mp.Pool(processes=mp.cpu_count())
     print("Grabbing math from files...")
     eqcount = len(unique_eqs)
-    meqcount = 0
     # code for creating the 3-column tsv with matching xhtml docs
     if(xhtml):
         all_math = pool.imap(grab_eqs_and_filename,matches)
@@ -106,48 +193,19 @@ def main():
         pool.close()
         pool.join()
         print("WRITING TO FILE: {}".format(outpath))
-        with open(outpath,mode='w') as fh:
+        with open_tsv(outpath) as fh:
             for x in unique_eqs:
-                fh.write(unique_eqs[x][0]+'\t'+repr(x)[1:-1].replace("\t","\\t")+'\t'+repr(unique_eqs[x][1])[1:-1].replace("\t","\\t")+'\n')
+                fh.write(format_row([unique_eqs[x][0],x,unique_eqs[x][1]]))
     else:
-        all_math = pool.imap(grab_math_from_file,matches)
-        for document_equations in all_math:
-            for equation in document_equations:
-                std_eq = standardize_equation(equation)
-                # removed delimiters
-                snt_eq = sanitize_equation(equation)
-                # removed environment-specific tags
-                flt_eq = flatten_equation(equation)
-                # standardized, no whitespace
-                for expr in cap_expr_list:
-                    match = re.match(expr,equation)
-                    if match:
-                        if expr in multiline_list:
-                            split_eqs = split_multiline(equation)
-                            sub_ids = []
-                            for sub_eq in split_eqs:
-                                sub_eq = remove_whitespace(sanitize_equation(sub_eq,complete=True))
-                                if sub_eq not in unique_eqs:
-                                    unique_eqs[sub_eq] = ("EQDS"+str(eqcount)+"Q",beq+sub_eq+eeq)
-                                    eqcount += 1
-                                sub_ids.append(unique_eqs[sub_eq][0])
-                            unique_meqs[equation] = ("EQDM"+str(meqcount)+"Q",",".join(sub_ids),equation)
-                            meqcount += 1
-                            break
-                        else:
-                            if flt_eq not in unique_eqs:
-                                unique_eqs[flt_eq] = ("EQDS"+str(eqcount)+"Q",beq+std_eq+eeq)
-                                eqcount += 1
-                            break
-        with open(outpath,mode='w') as fh:
-            for x in unique_eqs:
-                EQID, eqtext = unique_eqs[x]
-                fh.write(EQID+'\t'+mask(eqtext)+'\n')
-            for x in unique_meqs:
-                EQID, sub_ids, eqtext = unique_meqs[x]
-                fh.write(EQID+'\t'+sub_ids+'\t'+mask(eqtext)+'\n')
-    print("{} single line equations".format(len(unique_eqs)))
-    print("{} multiline equations".format(len(unique_meqs)))
+        # the workers normalize and hash, the parent only numbers
+        for records, cached in pool.imap(enumerate_file,matches):
+            ids.add(records)
+            for equation, record in cached:
+                equation_cache.put(equation,record)
+        ids.write(outpath)
+    save_normalize_cache(args.norm_cache)
+    print("{} single line equations".format(len(unique_eqs) if xhtml else len(ids.single)))
+    print("{} multiline equations".format(len(ids.multiline)))
     # print("{} seconds".format(int(time.time()-start)))
     pool.close()
     pool.join()
@@ -4,6 +4,7 @@ import os
 import multiprocessing as mp
 import fnmatch
 from core.funcs import *
+from core.tsvcodec import *
 from collections import Counter
 import time
 
@@ -23,12 +24,10 @@ def main():
     unique_eqs = {}
     if tsv:
         print("Loading equations")
-        with open(tsv,mode='r',encoding='latin-1') as fh:
-            for line in fh:
-                linesplit = line.split('\t')
-                eqid = linesplit[0]
-                text = unmask(linesplit[1]).strip()
-                unique_eqs[text] = eqid
+        for linesplit in read_tsv_rows(tsv):
+            eqid = linesplit[0]
+            text = linesplit[1].strip()
+            unique_eqs[text] = eqid
     if(parent):
         folderlist = next(os.walk(directory))[1]
         matches = []
@@ -46,7 +45,7 @@ def main():
     eqcount = 0
     filecount = 0
     math_equations = pool.imap(grab_inline_math_from_file,matches)
-    with open(outfile,'w') as fh:
+    with open_tsv(outfile) as fh:
         for doceqs in math_equations:
             for equation in doceqs:
                 if equation not in unique_eqs:
@@ -54,7 +53,7 @@ def main():
                     eqcount += 1
             filecount += 1
         for x in unique_eqs:
-            fh.write(unique_eqs[x]+'\t'+mask(x)+'\n')
+            fh.write(format_row([unique_eqs[x],x]))
     print("{} unique equations".format(len(unique_eqs)))
     print("{} new equations".format(eqcount))
 
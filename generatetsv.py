@@ -25,6 +25,9 @@ import shutil
 import json
 from collections import Counter
 from core.funcs import *
+from core.tsvcodec import *
+from core.normalize import *
+from core.eqstore import *
 
 class eqn:
     def __init__(self,text,eqid):
@@ -52,15 +55,35 @@ def load_json(filepath):
         data = json.load(fh)
     return data
 
+def stored_keys(store):
+    """Yields the keys of the single display equations of a store in the
+    order a TSV would have put them in eq_dict (where keys repeat, the first
+    record is kept)"""
+    for eqid, sub_ids, text, key in store:
+        if not sub_ids and store.by_key(key,first=True)[0]==eqid:
+            yield key
+
+def stored_eqn(table,store,key):
+    """Returns the eqn for key in table, creating it from the store record
+    on first use. Raises KeyError if the store has no such key"""
+    if key not in table:
+        fields = store.by_key(key,first=True)
+        if fields is None:
+            raise KeyError(key)
+        table[key] = eqn(fields[2].strip(),fields[0])
+    return table[key]
+
 def main():
     global output_tsv
     parser = argparse.ArgumentParser(
     description="Generate EQID/LaTeX/MathML TSV"
     )
-    parser.add_argument('disp_tsv',help='Path to display mode TSV')
+    parser.add_argument('disp_tsv',help='Path to display mode TSV, or an equation store built from it')
     parser.add_argument('jsonfolder',
     help='Path to corresponding directory of TSVs')
     parser.add_argument('output_tsv',help='Path to output TSV')
+    parser.add_argument('--norm-cache',
+    help='File to load normalized equations from and save them to, shared with enumerate_eqs and enumerate_docs')
     args = parser.parse_args()
     input_tsv = args.disp_tsv
     json_path = args.jsonfolder
@@ -68,21 +91,28 @@ def main():
     filelist = []
     eq_dict = {}
     meq_dict = {}
-    print("Loading TSV")
-    with open(input_tsv,'r') as fh:
-        for line in fh:
-            linesplit = line.rstrip('\n').split('\t')
-            if len(linesplit)==2:
-                eqid = linesplit[0]
-                text = unmask(linesplit[1].strip())
-                flat_eq = flatten_equation(text)
-                if flat_eq not in eq_dict:
-                    eq_dict[flat_eq] = eqn(text,eqid)
-            if len(linesplit)==3:
-                eqid = linesplit[0]
-                text = unmask(linesplit[2].strip())
-                if text not in meq_dict:
-                    meq_dict[text] = eqn(text,eqid)
+    store = None
+    load_normalize_cache(args.norm_cache)
+    if is_equation_store(input_tsv):
+        # equations are only loaded as the JSON files refer to them
+        print("Opening equation store")
+        store = equation_store(input_tsv)
+        input_rows = []
+    else:
+        print("Loading TSV")
+        input_rows = read_tsv_rows(input_tsv)
+    for linesplit in input_rows:
+        if len(linesplit)==2:
+            eqid = linesplit[0]
+            text = linesplit[1].strip()
+            flat_eq = normalize_equation(text).flat
+            if flat_eq not in eq_dict:
+                eq_dict[flat_eq] = eqn(text,eqid)
+        if len(linesplit)==3:
+            eqid = linesplit[0]
+            text = linesplit[2].strip()
+            if text not in meq_dict:
+                meq_dict[text] = eqn(text,eqid)
     print("Loading complete")
     print("Finding JSON files...")
     for root, folders, files in os.walk(json_path):
@@ -94,15 +124,21 @@ def main():
     for eqlist in pool.imap(load_json,filelist):
         for jsoneq in eqlist:
             eqtext = jsoneq['text']
-            if is_multiline(eqtext):
+            if normalize_equation(eqtext).multiline:
                 try:
-                    eqnobj = meq_dict[eqtext]
+                    if store is not None:
+                        eqnobj = stored_eqn(meq_dict,store,eqtext)
+                    else:
+                        eqnobj = meq_dict[eqtext]
                 except:
                     print("{} - equation mismatch".format(jsoneq['file']))
                     continue
             else:
                 try:
-                    eqnobj = eq_dict[flatten_equation(eqtext)]
+                    if store is not None:
+                        eqnobj = stored_eqn(eq_dict,store,normalize_equation(eqtext).flat)
+                    else:
+                        eqnobj = eq_dict[normalize_equation(eqtext).flat]
                 except:
                     print("{} - equation mismatch".format(jsoneq['file']))
                     continue
@@ -111,13 +147,20 @@ def main():
             eqnobj.documents[jsoneq['file']] += 1
     pool.close()
     pool.join()
+    save_normalize_cache(args.norm_cache)
     print("Writing to file")
-    with open(output_tsv,'w') as fh:
-        for item in eq_dict:
+    if store is not None:
+        eq_keys = stored_keys(store)
+    else:
+        eq_keys = eq_dict
+    with open_tsv(output_tsv) as fh:
+        for item in eq_keys:
             try:
                 eqnobj = eq_dict[item]
-            except:
-                continue
+            except KeyError:
+                # in no JSON file, written with an empty MathML like the rest
+                fields = store.by_key(item,first=True)
+                eqnobj = eqn(fields[2].strip(),fields[0])
             line = []
             line.append(eqnobj.eqid)
             line.append(mask(eqnobj.text))
@@ -6,6 +6,8 @@ import re
 from collections import Counter
 import subprocess
 from core.funcs import *
+from core.schedule import *
+from core.manifest import *
 
 def mse(filename):
     global outpath
@@ -126,10 +128,10 @@ def main():
     pool = mp.Pool(processes=mp.cpu_count())
     doclist = getmathfiles(path)
     doclist = map(os.path.abspath,doclist)
-    tofile = pool.map(mse,doclist)
+    tofile = imap_scheduled(pool,mse,doclist)
     log_file = outpath[:-1] + '.log'
     with open(log_file,'w') as fh:
-        for x in tofile:
+        for filename, x in tofile:
             fh.write(x+'\n')
     pool.close()
     pool.join()
@@ -14,6 +14,8 @@ from subprocess import PIPE
 import json
 from core.texclasses import *
 from core.funcs import *
+from core.schedule import *
+from core.manifest import *
 path = ''
 eqoutpath = ''
 #FUNCTIONS
@@ -27,9 +29,12 @@ def makeobjs(filename):
     global eqoutpath
     global convertedpath
     global erroroutputpath
-    f1 = open(filename, mode='r', encoding='latin-1')
-    text = f1.read()
-    f1.close()
+    with mapped_document(filename) as data:
+        if not may_contain(data,body_start.encode()):
+            print("{}: Missing body".format(filename))
+            return "{}: Missing body".format(filename)
+        # only the body is used below
+        text = decode_body(data,body_offsets(data))
     clean_name = os.path.basename(os.path.splitext(filename)[0])
     convertedfilepath = os.path.join(convertedpath,clean_name+'.xhtml')
     if not os.path.isfile(convertedfilepath):
@@ -103,6 +108,8 @@ def main():
     parser.add_argument("tex_directory", help="Path to directory of .tex files")
     parser.add_argument("xhtml_directory", help="Path to directory of .tex files")
     parser.add_argument("output_dir", help="Path to output directory")
+    parser.add_argument("--costs",
+    help="Timings from a previous run (written back afterwards), used to start the slowest files first")
     args = parser.parse_args()
     path = os.path.abspath(args.tex_directory)
     convertedpath = os.path.abspath(args.xhtml_directory)
@@ -117,13 +124,12 @@ def main():
     print("Finding all files with math...")
     filelist= getmathfiles(path)
     print("Generating equation object JSONs...")
-    errormessages = pool.map(makeobjs,filelist)
-    print("JSON conversion complete")
-    print("Logging...")
+    errormessages = imap_scheduled(pool,makeobjs,filelist,args.costs)
     with open(os.path.normpath(eqoutpath)+'.log','w') as fh:
-        for message in errormessages:
+        for filename, message in errormessages:
             if message:
                 fh.write(message+'\n')
+    print("JSON conversion complete")
     print("Logging complete: {}".format(os.path.normpath(eqoutpath)+'.log'))
     print("{}: Finished".format(path))
     pool.close()
@@ -5,6 +5,8 @@ import re
 from collections import Counter
 import subprocess
 from core.funcs import *
+from core.tsvcodec import *
+from core.eqstore import *
 import argparse
 import tempfile
 
@@ -25,19 +27,30 @@ def tsvgrab(filename):
     global outpath
     global subset
     outlist = []
-    with open(filename,'r') as fh:
-        for line in fh:
-            linesplit = line.strip().split('\t')
-            if len(linesplit)==2:
-                eqid, eqtext = linesplit
-            elif len(linesplit)==3:
-                eqid, subeqs, eqtext = linesplit
-            eqtext = unmask(eqtext)
-            if subset:
-                if eqid.lower() in subset:
-                    outlist.append(cleantuple((eqid, eqtext)))
-            else:
+    if is_equation_store(filename):
+        store = equation_store(filename)
+        if subset:
+            # only the listed equations are read from the store
+            for item in subset:
+                fields = store.by_eqid(item)
+                if fields and fields[0].lower()==item:
+                    outlist.append(cleantuple((fields[0], fields[2])))
+        else:
+            for eqid, subeqs, eqtext, key in store:
+                outlist.append(cleantuple((eqid, eqtext)))
+        store.close()
+        print("Loaded {} equations".format(len(outlist)))
+        return(outlist)
+    for linesplit in read_tsv_rows(filename):
+        if len(linesplit)==2:
+            eqid, eqtext = linesplit
+        elif len(linesplit)==3:
+            eqid, subeqs, eqtext = linesplit
+        if subset:
+            if eqid.lower() in subset:
                 outlist.append(cleantuple((eqid, eqtext)))
+        else:
+            outlist.append(cleantuple((eqid, eqtext)))
     print("Loaded {} equations".format(len(outlist)))
     return(outlist)
 
@@ -74,7 +87,7 @@ def main():
     global subset
     parser = argparse.ArgumentParser(description='Options for rendering LaTeX images of files')
     parser.add_argument('--sql',action='store_true', help="Use when passing in a sqlite.out file")
-    parser.add_argument('--tsv', action='store_true', help="Use when passing in a tsv of the format EQID formula")
+    parser.add_argument('--tsv', action='store_true', help="Use when passing in a tsv of the format EQID formula, or an equation store")
     parser.add_argument('--sty', help="Optional parameter for .sty file for use with latexmlmath")
     parser.add_argument("--eqidlist",help="Optional parameter for text file with list of equation ids")
     parser.add_argument("fname",help="Input file/folder")
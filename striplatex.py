@@ -4,6 +4,7 @@ import argparse
 import os
 import multiprocessing as mp
 from core.funcs import *
+from core.schedule import *
 from multiprocessing import Manager
 import multiprocessing as mp
 from glob import glob
@@ -42,6 +43,8 @@ def main():
     parser = argparse.ArgumentParser(description='Usage for equation enumeration')
     parser.add_argument("input_directory",help="directory of .tex files to overwrite")
     parser.add_argument("output_directory",help="directory to place output files")
+    parser.add_argument("--costs",
+    help="Timings from a previous run (written back afterwards), used to start the slowest files first")
     args = parser.parse_args()
     directory = args.input_directory
     outpath = args.output_directory
@@ -49,7 +52,7 @@ def main():
     if not os.path.exists(outpath):
         os.makedirs(outpath)
     pool = mp.Pool(mp.cpu_count())
-    vals = pool.map(cleanfile,filelist)
+    vals = [val for filename, val in imap_scheduled(pool,cleanfile,filelist,args.costs)]
     print(sum(vals))
     pool.close()
     pool.join()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#bench_enumerate.py
+#compares enumerate_eqs with normalization in the parent (as it was) and in
+#the pool workers, over a range of worker counts
+import sys
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing as mp
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import enumerate_eqs
+from core.funcs import *
+
+pieces = ['x_{i}','^{2}','\\alpha','\\frac{a}{b}','+','-','=','\\sum_{k=0}^{n}','\\int_0^1','\\mathrm{d}t',
+    '\\label{eq:%d}','\\left(','\\right)','\\nonumber','\\;']
+
+def make_equation(rng):
+    body = ' '.join(rng.choice(pieces) for _ in range(rng.randint(3,20)))
+    if '%d' in body:
+        body = body.replace('%d',str(rng.randint(0,999)))
+    return body
+
+def make_paper(filename,equations,seed):
+    """A paper of about equations display equations, a tenth of them align
+    environments and a fifth of them repeated from elsewhere"""
+    rng = random.Random(seed)
+    common = random.Random(0)
+    lines = ['\\documentclass{article}','\\usepackage{amsmath}','\\begin{document}']
+    for i in range(equations):
+        lines.append('Some text $x_{%d}$ before the next equation.' % i)
+        source = common if rng.random()<0.2 else rng
+        if rng.random()<0.1:
+            rows = ' \\\\\n'.join(make_equation(source) for _ in range(rng.randint(2,5)))
+            lines.append('\\begin{align}\n'+rows+'\n\\end{align}')
+        else:
+            lines.append('\\begin{equation}\n'+make_equation(source)+'\n\\end{equation}')
+    lines.append('\\end{document}')
+    with open(filename,mode='w',encoding='latin-1') as fh:
+        fh.write('\n'.join(lines))
+
+def run_mode(mode,filelist,workers,outfile,queue):
+    """Runs in a fresh process, so no normalization is cached. Puts (wall
+    seconds, parent CPU seconds) on queue"""
+    ids = enumerate_eqs.equation_ids()
+    context = mp.get_context('fork')
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    with context.Pool(workers) as pool:
+        if mode=='parent':
+            for equations in pool.imap(grab_math_from_file,filelist):
+                ids.add(enumerate_eqs.normalized_equations(equations))
+        else:
+            for records, cached in pool.imap(enumerate_eqs.enumerate_file,filelist):
+                ids.add(records)
+    wall = time.perf_counter()-start
+    cpu = time.process_time()-cpu_start
+    ids.write(outfile)
+    queue.put((wall,cpu))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark where enumerate_eqs normalizes equations')
+    parser.add_argument('--papers',type=int,default=200,help='Number of synthetic papers')
+    parser.add_argument('--equations',type=int,default=300,help='Display equations per paper')
+    parser.add_argument('--workers',type=int,nargs='+',help='Worker counts to run (default: 1, 2, 4, ... up to the number of CPUs)')
+    args = parser.parse_args()
+    workers = args.workers
+    if not workers:
+        workers = [1]
+        while workers[-1]*2<=mp.cpu_count():
+            workers.append(workers[-1]*2)
+    tempdir = tempfile.mkdtemp()
+    try:
+        filelist = []
+        for i in range(args.papers):
+            filename = os.path.join(tempdir,'paper{}.tex'.format(i))
+            make_paper(filename,args.equations,i+1)
+            filelist.append(filename)
+        print("{} papers, {} equations each, {} CPUs".format(args.papers,args.equations,mp.cpu_count()))
+        print("{:>7} {:>7} {:>8} {:>10} {:>12} {:>9} {:>13}".format('mode','workers','wall s','files/s',
+            'parent CPU s','speedup','parent bound'))
+        context = mp.get_context('spawn')
+        outputs = []
+        for mode in ('parent','worker'):
+            base = None
+            for count in workers:
+                outfile = os.path.join(tempdir,'{}{}.tsv'.format(mode,count))
+                queue = context.Queue()
+                process = context.Process(target=run_mode,args=(mode,filelist,count,outfile,queue))
+                process.start()
+                wall, cpu = queue.get()
+                process.join()
+                with open(outfile,mode='rb') as fh:
+                    outputs.append(fh.read())
+                if base is None:
+                    base = wall
+                # the parent's share caps the speedup any number of workers can give
+                print("{:>7} {:>7} {:>8.2f} {:>10.1f} {:>12.2f} {:>8.2f}x {:>12.1f}x".format(mode,count,wall,
+                    len(filelist)/wall,cpu,base/wall,base/cpu))
+        if any(output!=outputs[0] for output in outputs):
+            print("Outputs differ")
+            sys.exit(1)
+        print("Outputs identical")
+    finally:
+        shutil.rmtree(tempdir)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#bench_eqdict.py
+#compares the memory of forked enumerate_docs workers looking equations up
+#in a dict built from the TSV and in a memory-mapped store (core.eqstore)
+import sys
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing as mp
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from core.eqstore import *
+
+pieces = ['x','y_{i}','^{2}','\\alpha','\\frac{a}{b}','+','-','=','\\sum_{k}','\\int','(',')']
+
+def make_body(i):
+    """A unique equation body that normalize_equation leaves as it is"""
+    return ''.join(pieces[(i*7+k*13)%len(pieces)] for k in range(4+i%12))+'_{'+str(i)+'}'
+
+def make_tsv(filename,count):
+    with open_tsv(filename) as fh:
+        for i in range(count):
+            fh.write(format_row(['EQDS{}Q'.format(i),'\\begin{equation}'+make_body(i)+'\\end{equation}']))
+
+def memory():
+    """(Pss, Private_Dirty) of this process in kB"""
+    values = {}
+    with open('/proc/self/smaps_rollup') as fh:
+        for line in fh:
+            fields = line.split()
+            if len(fields)==3 and fields[2]=='kB':
+                values[fields[0].rstrip(':')] = int(fields[1])
+    return values.get('Pss',0), values.get('Private_Dirty',0)
+
+def lookup_pass(seed):
+    """What substitute_eqid does per equation, for every equation in a
+    scattered order. Waits for the other workers so each one runs one pass"""
+    before = memory()[1]
+    start = time.perf_counter()
+    found = 0
+    # a prime step visits every equation once without a list of them
+    for step in range(count):
+        i = (seed+step*1000003)%count
+        if eqdict.get(make_body(i)) is not None:
+            found += 1
+    elapsed = time.perf_counter()-start
+    barrier.wait()
+    pss, private = memory()
+    return found, elapsed, pss, private-before
+
+def run_mode(mode,tsv,workers,queue):
+    """Runs in a fresh process: builds the lookup structure the way
+    enumerate_docs did (dict) or does (store), forks the workers and puts
+    the results on queue"""
+    global eqdict, count, barrier
+    start = time.perf_counter()
+    if mode=='dict':
+        eqdict = {}
+        for eqid, equation in read_tsv_rows(tsv):
+            eqdict[normalize_equation(equation).flat] = eqid
+        count = len(eqdict)
+    else:
+        eqdict = equation_store(tsv+'.eqs')
+        count = len(eqdict)
+    build = time.perf_counter()-start
+    context = mp.get_context('fork')
+    barrier = context.Barrier(workers)
+    with context.Pool(workers) as pool:
+        results = pool.map(lookup_pass,range(workers),chunksize=1)
+        parent = memory()[0]
+    queue.put((build,parent,results))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark worker memory of the enumerate_docs equation lookup')
+    parser.add_argument('--equations',type=int,default=200000,help='Number of equations in the synthetic TSV')
+    parser.add_argument('--workers',type=int,nargs='+',default=[1,8,28],help='Worker counts to run')
+    args = parser.parse_args()
+    tempdir = tempfile.mkdtemp()
+    try:
+        tsv = os.path.join(tempdir,'eqs.tsv')
+        make_tsv(tsv,args.equations)
+        start = time.perf_counter()
+        import_tsv(tsv,tsv+'.eqs')
+        print("{} equations, TSV {:.1f} MB, store {:.1f} MB (imported in {:.2f} s)".format(args.equations,
+            os.path.getsize(tsv)/1024/1024,os.path.getsize(tsv+'.eqs')/1024/1024,time.perf_counter()-start))
+        print("{:>6} {:>7} {:>8} {:>11} {:>10} {:>15} {:>10}".format('mode','workers','build s','lookups/s',
+            'parent MB','worker +MB mean','total MB'))
+        context = mp.get_context('spawn')
+        for mode in ('dict','store'):
+            for workers in args.workers:
+                queue = context.Queue()
+                process = context.Process(target=run_mode,args=(mode,tsv,workers,queue))
+                process.start()
+                build, parent, results = queue.get()
+                process.join()
+                if any(found!=args.equations for found, _, _, _ in results):
+                    print("{}: lookups failed".format(mode))
+                    sys.exit(1)
+                rate = sum(args.equations/elapsed for _, elapsed, _, _ in results)/len(results)
+                growth = sum(private for _, _, _, private in results)/len(results)/1024
+                total = (parent+sum(pss for _, _, pss, _ in results))/1024
+                print("{:>6} {:>7} {:>8.2f} {:>11.0f} {:>10.1f} {:>15.1f} {:>10.1f}".format(mode,workers,build,
+                    rate,parent/1024,growth,total))
+    finally:
+        shutil.rmtree(tempdir)
+
+if __name__=='__main__':
+    main()
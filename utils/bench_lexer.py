@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#bench_lexer.py
+#times the regex chain that grab_math, grab_inline_math and
+#generate_sanitized_document used to run against the lexer in core.funcs
+import sys
+import os
+import re
+import time
+import argparse
+from glob import glob
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from core import funcs
+
+# the regex implementations the lexer replaced
+
+def legacy_remove_comments(text):
+    text = re.sub(r'(?<=\n)%.+?\n','',text)
+    text = re.sub(r'(?<!\\)%\n','',text)
+    text = re.sub(r'(?<!\\)%.*?\n','\n',text)
+    text = re.sub(r'(?s)\\begin\{comment\}.*?\\end\{comment\}','',text)
+    return text
+
+def legacy_grab_body(text):
+    text = legacy_remove_comments(text)
+    match = re.search(funcs.body_pattern,text)
+    if match:
+        return match.group(0)
+    return ''
+
+def legacy_clean_inline_math(text):
+    text = legacy_remove_comments(text)
+    text = re.sub(r'(?<!\\)((?:\\\\)*)(\\\$)','\1escapeddollarsign',text)
+    for match in re.findall(funcs.inline_pattern,text):
+        sub_eqs = re.findall(r'(?s)\$.+?\$',match)
+        if len(sub_eqs)>0:
+            text = text.replace(match,' '.join(sub_eqs))
+    text = re.sub(funcs.ch,r' \1 ',text)
+    text = re.sub('escapeddollarsign',r'\\\$',text)
+    return text
+
+def legacy_grab_math(text):
+    text = legacy_clean_inline_math(legacy_grab_body(text))
+    return re.findall(funcs.non_capture_math,text)
+
+def legacy_grab_inline_math(text):
+    text = legacy_clean_inline_math(legacy_grab_body(text))
+    matchlist = []
+    for match in re.findall(funcs.inline_pattern,text):
+        matchlist.extend(re.findall(r'\$.+?\$',match))
+    return matchlist
+
+def legacy_sanitized_math(text):
+    text = legacy_remove_comments(text)
+    text = re.sub(funcs.inline_pattern,'',text)
+    return legacy_grab_math(text)
+
+def lexer_sanitized_math(text):
+    return funcs.grab_math(funcs.remove_inline_math(funcs.remove_comments(text)))
+
+pairs = [
+    ('remove_comments',legacy_remove_comments,funcs.remove_comments),
+    ('grab_math',legacy_grab_math,funcs.grab_math),
+    ('grab_inline_math',legacy_grab_inline_math,funcs.grab_inline_math),
+    ('sanitized math',legacy_sanitized_math,lexer_sanitized_math),
+]
+
+def best_time(func,texts,repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            func(text)
+        elapsed = time.perf_counter()-start
+        if best is None or elapsed<best:
+            best = elapsed
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LaTeX lexer against the old regex chain')
+    parser.add_argument('directory',help='Folder of .tex files (searched recursively)')
+    parser.add_argument('--limit',type=int,default=500,help='Number of papers to sample')
+    parser.add_argument('--repeat',type=int,default=3,help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+    filelist = sorted(glob(os.path.join(args.directory,'**','*.tex'),recursive=True))[:args.limit]
+    texts = []
+    for filename in filelist:
+        with open(filename,mode='r',encoding='latin-1') as fh:
+            texts.append(fh.read())
+    size = sum(len(text) for text in texts)
+    print("{} papers, {:.1f} MB".format(len(texts),size/1e6))
+    print("{:>18} {:>10} {:>10} {:>8} {:>10}".format('function','legacy s','lexer s','speedup','identical'))
+    for name, legacy, lexer in pairs:
+        # papers with escaped dollars are expected to differ (see core.funcs)
+        same = sum(1 for text in texts if legacy(text)==lexer(text))
+        old_time = best_time(legacy,texts,args.repeat)
+        new_time = best_time(lexer,texts,args.repeat)
+        print("{:>18} {:>10.3f} {:>10.3f} {:>7.1f}x {:>5}/{:<5}".format(name,old_time,new_time,old_time/new_time,same,len(texts)))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#bench_macroscan.py
+#times load_and_remove_macros on synthetic preambles with many definitions
+import sys
+import os
+import time
+import random
+import argparse
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import demacro
+
+def make_preamble(count,seed=0):
+    """Returns a document whose preamble holds count macro definitions of
+    every kind demacro understands"""
+    rng = random.Random(seed)
+    lines = ['\\documentclass{article}','\\usepackage{amsmath}']
+    for i in range(count):
+        name = '\\m' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(6)) + 'x'*(i%3)
+        kind = i%6
+        if kind==0:
+            lines.append('\\newcommand{%s}{\\mathbb{R}^{%d}}' % (name,i))
+        elif kind==1:
+            lines.append('\\newcommand*{%s}[2]{\\frac{#1}{#2}}' % name)
+        elif kind==2:
+            lines.append('\\renewcommand{%s}[2][0]{#1_{#2}}' % name)
+        elif kind==3:
+            lines.append('\\def%s#1#2{\\left(#1,#2\\right)}' % name)
+        elif kind==4:
+            lines.append('\\gdef%s[#1]{\\langle #1\\rangle}' % name)
+        else:
+            lines.append('\\DeclareMathOperator*{%s}{op%d}' % (name,i))
+        if i%10==0:
+            lines.append('% a comment line that is not a definition')
+    lines.append('\\begin{document}')
+    lines.append('Some text $x$ here.')
+    lines.append('\\end{document}')
+    return '\n'.join(lines)
+
+def time_scan(text,repeat):
+    best = None
+    for _ in range(repeat):
+        macrodict = {}
+        start = time.perf_counter()
+        _, remaining = demacro.load_and_remove_macros(macrodict,text)
+        elapsed = time.perf_counter()-start
+        if best is None or elapsed<best:
+            best = elapsed
+    return best, len(macrodict), len(remaining)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the macro definition scanner')
+    parser.add_argument('--sizes',type=int,nargs='+',default=[500,1000,2000,4000],
+    help='Numbers of definitions to put in the preamble')
+    parser.add_argument('--repeat',type=int,default=3,help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+    print("{:>8} {:>10} {:>10} {:>12} {:>14}".format('defs','bytes','loaded','seconds','us/definition'))
+    for size in args.sizes:
+        text = make_preamble(size)
+        elapsed, loaded, _ = time_scan(text,args.repeat)
+        print("{:>8} {:>10} {:>10} {:>12.4f} {:>14.1f}".format(size,len(text),loaded,elapsed,elapsed/size*1e6))
+
+if __name__=='__main__':
+    main()
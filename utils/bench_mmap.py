@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#bench_mmap.py
+#compares peak RSS and throughput of answering cheap questions about large
+#.tex files from decoded text and from an mmap of the file (core.funcs)
+import sys
+import os
+import re
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing as mp
+from glob import glob
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from core import funcs
+
+str_double_dollar = re.compile(r'\$\$')
+bytes_double_dollar = re.compile(rb'\$\$')
+
+def make_paper(filename,size,math,seed=0):
+    """Writes a synthetic paper of about size bytes, with or without math"""
+    rng = random.Random(seed)
+    words = ['the','flux','of','a','model','we','find','that','is','given','by','sample']
+    lines = ['\\documentclass{article}','\\usepackage{amsmath}','\\begin{document}']
+    length = 0
+    while length<size:
+        line = ' '.join(rng.choice(words) for _ in range(12))
+        if math:
+            choice = rng.random()
+            if choice<0.2:
+                line += ' $x_{%d}$ and $\\alpha$' % rng.randint(0,99)
+            elif choice<0.25:
+                line += '\n$$\\int_0^{%d} f(x)\\,dx$$' % rng.randint(0,99)
+            elif choice<0.28:
+                line += '\n\\begin{equation}E = mc^{%d}\\end{equation}' % rng.randint(0,9)
+        if rng.random()<0.05:
+            line += ' % a comment'
+        lines.append(line)
+        length += len(line)+1
+    lines.append('\\end{document}')
+    with open(filename,mode='w',encoding='latin-1') as fh:
+        fh.write('\n'.join(lines))
+
+def decoded_questions(filename):
+    with open(filename,mode='r',encoding='latin-1') as fh:
+        text = fh.read()
+    return (funcs.body_start in text,sum(1 for _ in str_double_dollar.finditer(text)))
+
+def mapped_questions(filename):
+    with funcs.mapped_document(filename) as data:
+        return (data.find(funcs.body_start.encode())!=-1,sum(1 for _ in bytes_double_dollar.finditer(data)))
+
+def decoded_hasmath(filename):
+    with open(filename,mode='r',encoding='latin-1') as fh:
+        text = fh.read()
+    return len(funcs.lex_latex(text).display)
+
+def mapped_hasmath(filename):
+    return funcs.hasmath(filename)[1]
+
+# (question, decoded version, mapped version)
+questions = [
+    ('body/$$',decoded_questions,mapped_questions),
+    ('hasmath',decoded_hasmath,mapped_hasmath),
+]
+
+def peak_rss():
+    """Peak resident set size of this process in kB. ru_maxrss survives
+    exec, so it would include the parent's peak; VmHWM does not"""
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_mode(func,filelist,repeat):
+    """Runs in a fresh process. Returns (answers, best seconds, peak RSS
+    growth in MB)"""
+    baseline = peak_rss()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        answers = [func(filename) for filename in filelist]
+        elapsed = time.perf_counter()-start
+        if best is None or elapsed<best:
+            best = elapsed
+    peak = peak_rss()
+    return (answers,best,(peak-baseline)/1024)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mmap scanning against decoding whole files')
+    parser.add_argument('directory',nargs='?',help='Folder of .tex files (default: synthetic papers)')
+    parser.add_argument('--size',type=float,default=8,help='Size of each synthetic paper in MB')
+    parser.add_argument('--count',type=int,default=4,help='Number of synthetic papers (half without math)')
+    parser.add_argument('--repeat',type=int,default=3,help='Timing repetitions (best is reported)')
+    args = parser.parse_args()
+    tempdir = None
+    if args.directory:
+        filelist = sorted(glob(os.path.join(args.directory,'*.tex')))
+    else:
+        tempdir = tempfile.mkdtemp()
+        filelist = []
+        for i in range(args.count):
+            filename = os.path.join(tempdir,'paper{}.tex'.format(i))
+            make_paper(filename,int(args.size*1024*1024),math=i%2==0,seed=i)
+            filelist.append(filename)
+    try:
+        size = sum(os.path.getsize(filename) for filename in filelist)
+        print("{} files, {:.1f} MB".format(len(filelist),size/1024/1024))
+        print("{:>8} {:>8} {:>10} {:>10} {:>14} {:>10}".format('question','mode','seconds','MB/s','peak RSS +MB','identical'))
+        context = mp.get_context('spawn')
+        for name, decoded, mapped in questions:
+            results = []
+            for mode, func in (('decoded',decoded),('mapped',mapped)):
+                with context.Pool(1) as pool:
+                    answers, seconds, rss = pool.apply(run_mode,(func,filelist,args.repeat))
+                results.append(answers)
+                print("{:>8} {:>8} {:>10.3f} {:>10.1f} {:>14.1f} {:>10}".format(name,mode,seconds,
+                    size/1024/1024/seconds,rss,str(results[0]==answers)))
+    finally:
+        if tempdir:
+            shutil.rmtree(tempdir)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#bench_tsv.py
+#checks that the TSV codec in core.tsvcodec round-trips (including old
+#repr-style files) and times it against the repr()/unicode-escape mask
+import sys
+import os
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from core.tsvcodec import *
+
+alphabet = ['a','x','1',' ','\\','\\\\','\t','\n','\r','\\n','\\t','{','}','$','^','_',
+    '\\frac','\\alpha','\xe9','\xb5','\u2211','\U0001d400','"',"'",'%','#','\x1f']
+
+def random_field(rng,length):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0,length)))
+
+def old_mask(text):
+    return repr(text)[1:-1]
+
+def old_unmask(text):
+    return text.encode().decode('unicode-escape')
+
+def check_round_trip(count,seed):
+    """Returns the number of fields that do not survive escape/unescape,
+    a written and re-read file, and an old repr-style file"""
+    rng = random.Random(seed)
+    rows = [[random_field(rng,8),random_field(rng,40),random_field(rng,40)] for _ in range(count)]
+    failures = sum(1 for row in rows for field in row if tsv_unescape(tsv_escape(field))!=field)
+    with tempfile.TemporaryDirectory() as folder:
+        new_file = os.path.join(folder,'new.tsv')
+        with open_tsv(new_file) as fh:
+            for row in rows:
+                fh.write(format_row(row))
+        for chunk_size in (7,4096):
+            read = list(read_tsv_rows(new_file,chunk_size=chunk_size))
+            failures += sum(1 for a, b in zip(read,rows) if a!=b)+abs(len(read)-len(rows))
+        old_file = os.path.join(folder,'old.tsv')
+        with open(old_file,mode='w',encoding='utf-8') as fh:
+            for row in rows:
+                fh.write('\t'.join(old_mask(field) for field in row)+'\n')
+        read = list(read_tsv_rows(old_file))
+        failures += sum(1 for a, b in zip(read,rows) if a!=b)+abs(len(read)-len(rows))
+    return failures
+
+def old_failures(count,seed):
+    """Fields garbled by the old mask, written as UTF-8 and read back as
+    latin-1 the way the scripts did"""
+    rng = random.Random(seed)
+    fields = [random_field(rng,40) for _ in range(count)]
+    return sum(1 for field in fields if old_unmask(old_mask(field).encode('utf-8').decode('latin-1'))!=field)
+
+def make_equations(count,seed):
+    rng = random.Random(seed)
+    pieces = ['\\frac{a}{b}','x^{2}','\\alpha','+','=','\\sum_{i=0}^{n}','\\mathrm{d}t','\\\\','\xb5','\\left(','\\right)']
+    return [('EQDS{}Q'.format(i),'\\begin{equation}'+''.join(rng.choice(pieces) for _ in range(rng.randint(3,30)))+'\\end{equation}')
+        for i in range(count)]
+
+def time_old(rows,filename):
+    start = time.perf_counter()
+    with open(filename,mode='w') as fh:
+        for eqid, equation in rows:
+            fh.write(eqid+'\t'+old_mask(equation)+'\n')
+    written = time.perf_counter()
+    with open(filename,mode='r',encoding='latin-1') as fh:
+        for line in fh:
+            eqid, equation = line.rstrip('\n').split('\t')
+            equation = old_unmask(equation)
+    return written-start, time.perf_counter()-written
+
+def time_new(rows,filename):
+    start = time.perf_counter()
+    with open_tsv(filename) as fh:
+        for eqid, equation in rows:
+            fh.write(format_row([eqid,equation]))
+    written = time.perf_counter()
+    for eqid, equation in read_tsv_rows(filename):
+        pass
+    return written-start, time.perf_counter()-written
+
+def main():
+    parser = argparse.ArgumentParser(description='Round-trip checks and throughput of the TSV codec')
+    parser.add_argument('--lines',type=int,default=1000000,help='Equations in the throughput test')
+    parser.add_argument('--checks',type=int,default=20000,help='Random rows in the round-trip test')
+    args = parser.parse_args()
+    failures = check_round_trip(args.checks,0)
+    print("Round trip: {} failures in {} rows".format(failures,args.checks))
+    print("Old mask/unmask: {} of {} fields garbled".format(old_failures(args.checks,0),args.checks))
+    rows = make_equations(args.lines,1)
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder,'eqs.tsv')
+        print("{:>6} {:>10} {:>10} {:>12}".format('codec','write s','read s','lines/s read'))
+        for name, func in (('repr',time_old),('tsv',time_new)):
+            write_time, read_time = func(rows,filename)
+            print("{:>6} {:>10.2f} {:>10.2f} {:>12.0f}".format(name,write_time,read_time,len(rows)/read_time))
+    if failures:
+        sys.exit(1)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+#eqstore.py
+#builds an equation store (core.eqstore) from an enumerate_eqs or
+#enumerate_inline_eqs TSV, and writes a store back out as a TSV
+import sys
+import os
+import time
+import argparse
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from core.eqstore import *
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert between equation TSVs and equation stores')
+    subparsers = parser.add_subparsers(dest='command')
+    import_parser = subparsers.add_parser('import',help='Build a store from a TSV')
+    import_parser.add_argument('tsv',help='Path to the TSV of enumerated equations')
+    import_parser.add_argument('store',help='Path to the store to write')
+    import_parser.add_argument('--inline',action='store_true',
+    help='Use if the TSV holds inline equations (enumerate_inline_eqs output)')
+    export_parser = subparsers.add_parser('export',help='Write a store back out as a TSV')
+    export_parser.add_argument('store',help='Path to the store')
+    export_parser.add_argument('tsv',help='Path to the TSV to write')
+    args = parser.parse_args()
+    start = time.time()
+    if args.command=='import':
+        count = import_tsv(args.tsv,args.store,args.inline)
+        print("Stored {} equations in {}".format(count,args.store))
+    elif args.command=='export':
+        count = export_tsv(args.store,args.tsv)
+        print("Wrote {} equations to {}".format(count,args.tsv))
+    else:
+        parser.print_help()
+        sys.exit(1)
+    print("{:.1f} s".format(time.time()-start))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#fake_latexml.py
+#stand-in for core/latexml_worker.pl that speaks the converter protocol of
+#core/converter.py without LaTeXML installed. Each display equation becomes
+#an XHTML <table> with a <math> element, and the text between equations
+#becomes a paragraph, as LaTeXML would lay them out. Equations containing
+#\fakehang, \fakecrash or \fakeerror hang, kill the converter or fail the
+#document, to exercise timeouts and restarts.
+#usage: python3 convertlatex.py in out --backend daemon --daemon-command "python3 utils/fake_latexml.py"
+import sys
+import os
+import re
+import time
+import argparse
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from core.funcs import *
+# imported after core.funcs, so no star import can shadow it
+from html import escape as html_escape
+
+numbered_pattern = re.compile(r'\\begin\{(equation|align|gather|multline|eqnarray|flalign)\}')
+grouped_kinds = ('align','gather','eqnarray','flalign')
+
+def equation_table(piece,tex,counters):
+    """The XHTML table of a display equation. As in LaTeXML, numbered
+    equations get ids S0.E1, S0.E2, ... and an equation number tag,
+    unnumbered ones S0.Ex1, S0.Ex2, ..., and every row of a numbered
+    align-like group a number of its own"""
+    math = ('<math id="{}.m1" xmlns="http://www.w3.org/1998/Math/MathML" alttext="{}" display="block">'
+        '<mtext>{}</mtext></math>')
+    match = numbered_pattern.match(piece)
+    if not match:
+        counters['Ex'] += 1
+        eqid = 'S0.Ex{}'.format(counters['Ex'])
+        return ('<table id="{}" class="ltx_equation ltx_eqn_table"><tr><td class="ltx_eqn_cell">'+math+
+            '</td></tr></table>').format(eqid,eqid,html_escape(tex),html_escape(tex))
+    rows = [tex]
+    if match.group(1) in grouped_kinds:
+        rows = [row for row in tex.split('\\\\') if row.strip()] or [tex]
+    cells = []
+    ids = []
+    for row in rows:
+        counters['E'] += 1
+        ids.append('S0.E{}'.format(counters['E']))
+        cells.append(('<tr{} class="ltx_equation ltx_eqn_row"><td class="ltx_eqn_cell">'+math+'</td>'
+            '<td class="ltx_eqn_cell ltx_eqn_eqno"><span class="ltx_tag ltx_tag_equation ltx_align_right">({})</span></td></tr>'
+            ).format(' id="{}"'.format(ids[-1]) if len(rows)>1 else '',ids[-1],html_escape(tex),html_escape(row),counters['E']))
+    if len(rows)==1:
+        return '<table id="{}" class="ltx_equation ltx_eqn_table">{}</table>'.format(ids[0],cells[0])
+    counters['EGx'] += 1
+    return '<table id="S0.EGx{}" class="ltx_equationgroup ltx_eqn_table">{}</table>'.format(counters['EGx'],''.join(cells))
+
+def convert(document,delay):
+    """Returns (xml, xhtml) for document, or raises ValueError"""
+    pieces = grab_math(document,split=True)
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>\n<document>']
+    xhtml = ['<?xml version="1.0" encoding="UTF-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><body>']
+    counters = {'E': 0, 'Ex': 0, 'EGx': 0}
+    for i, piece in enumerate(pieces):
+        if i%2==0:
+            if piece.strip():
+                xml.append('<para><p>{}</p></para>'.format(html_escape(piece.strip())))
+                xhtml.append('<div class="ltx_para"><p class="ltx_p">{}</p></div>'.format(html_escape(piece.strip())))
+            continue
+        if '\\fakehang' in piece:
+            time.sleep(1e6)
+        if '\\fakecrash' in piece:
+            os._exit(1)
+        if '\\fakeerror' in piece:
+            raise ValueError('Fatal:fake:error in {}'.format(piece))
+        time.sleep(delay)
+        # the label only shows in the ids LaTeXML would otherwise give
+        tex = ' '.join(re.sub(r'\\label\{[^{}]*\}','',piece).split())
+        xml.append('<equation><Math tex="{}"/></equation>'.format(html_escape(tex)))
+        xhtml.append(equation_table(piece,tex,counters))
+    xml.append('</document>\n')
+    xhtml.append('</body></html>\n')
+    return ''.join(xml), ''.join(xhtml)
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake persistent LaTeXML converter')
+    parser.add_argument('--startup',type=float,default=0,help='Seconds spent "loading bindings" before the first request')
+    parser.add_argument('--delay',type=float,default=0,help='Seconds spent on each equation')
+    args = parser.parse_args()
+    time.sleep(args.startup)
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    while True:
+        header = stdin.readline()
+        if not header:
+            return
+        document = stdin.read(int(header))
+        try:
+            parts = convert(document.decode('utf-8','surrogateescape'),args.delay)
+            status = b'ok'
+        except ValueError as error:
+            parts = (str(error),)
+            status = b'error'
+        parts = [part.encode('utf-8','surrogateescape') for part in parts]
+        stdout.write(b' '.join([status]+[str(len(part)).encode() for part in parts])+b'\n'+b''.join(parts))
+        stdout.flush()
+
+if __name__=='__main__':
+    main()